@@ -1,15 +1,34 @@
 # -*- coding: UTF-8 -*-
+import collections
+import os
 import re
 import six
 
 from budget_app.loaders import SimpleBudgetLoader
+from budget_app.models import BudgetItem
 
 if six.PY2:
+    from madrid_data_file_cache import MadridDataFileCache
+    from madrid_execution_delta import MadridExecutionDelta
+    from madrid_load_manifest import MadridLoadManifestMixin
     from madrid_utils import MadridUtils
 else:
+    from .madrid_data_file_cache import MadridDataFileCache
+    from .madrid_execution_delta import MadridExecutionDelta
+    from .madrid_load_manifest import MadridLoadManifestMixin
     from .madrid_utils import MadridUtils
 
-class MadridBudgetLoader(SimpleBudgetLoader):
+class MadridBudgetLoader(MadridLoadManifestMixin, SimpleBudgetLoader):
+
+    # Rows are processed in batches of this size, see parse_data_file below.
+    BATCH_SIZE = 5000
+
+    # Transfers to/from dependent organisations, which we eliminate before 2023.
+    INTERNAL_TRANSFER_ARTICLES = ['410', '710', '400', '700']
+
+    # Eliminated rows are summarized at the end of the parsing. Set the MADRID_VERBOSE_ELIMINATIONS
+    # environment variable to get also one line per eliminated row, as we used to do.
+    VERBOSE_ELIMINATIONS_VARIABLE = 'MADRID_VERBOSE_ELIMINATIONS'
 
     # Add elimination files to the loading process. See #1348.
     # We need them in Madrid because the eliminatins have stopped following
@@ -26,67 +45,142 @@ class MadridBudgetLoader(SimpleBudgetLoader):
             'ejecucion_gastos_eliminaciones.csv',
         ]
 
+    def _get_manifest_dataset(self):
+        return 'budget'
+
+    def _get_manifest_filenames(self):
+        return self._get_input_filenames()
+
+    # Monthly execution updates can be loaded as a delta. Note the same item (i.e. revenues
+    # from different centres) may appear more than once, see MadridExecutionDelta.
+    def _get_execution_delta(self, manifest, year):
+        return MadridExecutionDelta(
+            manifest,
+            year,
+            self._get_manifest_dataset(),
+            BudgetItem,
+            {
+                'actual': 'is_actual',
+                'expense': 'is_expense',
+                'item_number': 'item_number',
+                'description': 'description',
+                'amount': 'amount',
+            },
+            ('is_actual', 'is_expense', 'ic_code', 'fc_code', 'ec_code', 'item_number'),
+            {
+                'economic_category_id': ('is_expense', 'ec_code'),
+                'functional_category_id': ('fc_code', ),
+                'institutional_category_id': ('ic_code', ),
+                'funding_category_id': (),
+            })
+
+    def parse_budget_data(self, budget_items, path):
+        self._eliminations = collections.OrderedDict()
+        self._is_verbose = os.environ.get(self.VERBOSE_ELIMINATIONS_VARIABLE, '') not in ['', '0']
+
+        super(MadridBudgetLoader, self).parse_budget_data(budget_items, path)
+
+        self.print_eliminations_summary()
+
+    # Parse a whole data file. Everything that depends only on the filename (year, expense
+    # or revenue, budget or execution, elimination...) is worked out once per file, and the
+    # rows are then processed in batches, as columns, so that code mappings, amounts and
+    # descriptions don't have to be worked out row by row.
+    # Files already parsed in this process, i.e. for another language, are not parsed again.
+    # Otherwise lines are read as the base loader does, see MadridDataFileCache.filter_lines.
+    def parse_data_file(self, budget_items, filename):
+        if not os.path.isfile(filename):
+            return
+
+        print("Leyendo datos de %s..." % filename)
+        content, cache_key = MadridDataFileCache.read(filename)
+
+        cached_data = MadridDataFileCache.get(self, cache_key)
+        if cached_data is not None:
+            items, file_eliminations = cached_data
+            for key, (count, total) in file_eliminations.items():
+                self._add_eliminations(self._get_eliminations(), key, count, total)
+            budget_items.extend(items)
+            return
+
+        file_info = self._get_file_info(filename)
+        self._file_eliminations = collections.OrderedDict()
+
+        items = []
+        lines = []
+        for line in MadridDataFileCache.get_lines(content, self._get_data_files_encoding(), self._get_delimiter()):
+            lines.append(line)
+            if len(lines) == self.BATCH_SIZE:
+                items.extend(self.parse_lines(file_info, lines))
+                lines = []
+        items.extend(self.parse_lines(file_info, lines))
+
+        MadridDataFileCache.set(self, cache_key, items, self._file_eliminations)
+        self._file_eliminations = None
+        budget_items.extend(items)
+
+    # Kept for callers that still go row by row. Note it returns None for skipped rows.
     def parse_item(self, filename, line):
+        items = self.parse_lines(self._get_file_info(filename), [line])
+        return items[0] if items else None
+
+    def parse_lines(self, file_info, lines):
         # Skip first line
-        if line[0] == 'Centro':
-            return
+        lines = [line for line in lines if line[0] != 'Centro']
+        if not lines:
+            return []
 
-        # The format of numbers in data files have changed along the years:
-        # Up to 2016 (included) we converted Excel files using in2csv: English format
-        # From 2017 we use the original CSVs from the open data portal: Spanish format
-        year = re.search(r'municipio/(\d+)/', filename).group(1)
-        if int(year) < 2017:
-            parse_amount = self._read_english_number
+        if file_info['is_expense']:
+            return self._parse_expense_lines(file_info, lines)
         else:
-            parse_amount = self.parse_spanish_amount
-
-        is_expense = (filename.find('gastos') != -1)
-        is_actual = (filename.find('/ejecucion_') != -1)
-        is_elimination = (filename.find('eliminaciones') != -1)
-        if is_expense:
-            # Note: in the most recent 2016 data the leading zeros were missing,
-            # so add them back using zfill.
-            fc_code = MadridUtils.map_functional_code(line[4].zfill(5), int(year))
-            ec_code = line[8]
+            return self._parse_revenue_lines(file_info, lines)
+
+    def _parse_expense_lines(self, file_info, lines):
+        year = file_info['year']
+        is_actual = file_info['is_actual']
+        is_elimination = file_info['is_elimination']
+
+        # Note: in the most recent 2016 data the leading zeros were missing,
+        # so add them back using zfill.
+        fc_codes = MadridUtils.map_functional_codes([line[4].zfill(5) for line in lines], year)
 
-            # Select the amount column to use based on whether we are importing execution
-            # or budget data. In the latter case, sometimes we're dealing with the
-            # amended budget, sometimes with the just approved one, in which case
-            # there're less columns
-            budget_position = 12 if len(line) > 11 else 10
-            amount = parse_amount(line[15 if is_actual else budget_position])
+        # The original Madrid institutional code requires some mapping
+        # Note: in the most recent 2016 data the leading zeros were missing,
+        # so add them back using zfill.
+        ic_codes = MadridUtils.map_institutional_codes([line[0].zfill(3)+line[2].zfill(3) for line in lines], year)
 
-            # The original Madrid institutional code requires some mapping
-            # Note: in the most recent 2016 data the leading zeros were missing,
-            # so add them back using zfill.
-            ic_code = MadridUtils.map_institutional_code(line[0].zfill(3)+line[2].zfill(3), int(year))
+        # Select the amount column to use based on whether we are importing execution
+        # or budget data. In the latter case, sometimes we're dealing with the
+        # amended budget, sometimes with the just approved one, in which case
+        # there're less columns
+        amounts = MadridUtils.parse_amounts(
+            [line[15 if is_actual else (12 if len(line) > 11 else 10)] for line in lines],
+            file_info['is_spanish_format'],
+            True)
+
+        descriptions = self._get_descriptions([line[9] for line in lines])
+
+        items = []
+        for line, fc_code, ic_code, amount, description in zip(lines, fc_codes, ic_codes, amounts, descriptions):
+            ec_code = line[8]
 
             # Eliminations before 2023 followed a consistent pattern
-            if int(year) < 2023:
+            if year < 2023:
                 # We've been asked to ignore data for a special department, not really an organism (#756)
                 if ic_code == '200':
-                    print("Eliminando gasto (organismo %s, artículo %s): %12.2f €" % (line[0], ec_code, amount/100))
-                    return
+                    self._add_elimination(file_info, 'gasto', line[0], ec_code, amount)
+                    continue
 
                 # Ignore transfers to dependent organisations
-                if ec_code[:-2] in ['410', '710', '400', '700']:
-                    print("Eliminando gasto (organismo %s, artículo %s): %12.2f €" % (line[0], ec_code, amount/100))
-                    return
+                if ec_code[:-2] in self.INTERNAL_TRANSFER_ARTICLES:
+                    self._add_elimination(file_info, 'gasto', line[0], ec_code, amount)
+                    continue
 
             # From 2023, eliminations come in separate files, but amounts need to be reversed.
             if is_elimination:
                 amount = -amount
 
-            # The input files are encoded in ISO-8859-1, since we want to work with the files
-            # as they're published in the original open data portal. All the text fields are
-            # ignored, as we use the codes instead, but the description one.
-            if six.PY2:
-                description = self._spanish_titlecase(line[9].decode("iso-8859-1").encode("utf-8"))
-            else:
-                # In Python 3 we're handling the encoding at the file level, so we don't need to decode/encode here.
-                description = self._spanish_titlecase(line[9])
-
-            return {
+            items.append({
                 'is_expense': True,
                 'is_actual': is_actual,
                 'fc_code': fc_code,
@@ -95,39 +189,45 @@ class MadridBudgetLoader(SimpleBudgetLoader):
                 'item_number': ec_code[-2:],    # Last two digits
                 'description': description,
                 'amount': amount
-            }
+            })
 
-        else:
+        return items
+
+    def _parse_revenue_lines(self, file_info, lines):
+        year = file_info['year']
+        is_actual = file_info['is_actual']
+        is_elimination = file_info['is_elimination']
+
+        # Select the column from which to read amounts. See similar comment above.
+        amounts = MadridUtils.parse_amounts(
+            [line[9 if is_actual else (8 if len(line) > 7 else 6)] for line in lines],
+            file_info['is_spanish_format'],
+            True)
+
+        descriptions = self._get_descriptions([line[5] for line in lines])
+
+        items = []
+        for line, amount, description in zip(lines, amounts, descriptions):
             ec_code = line[4]
             ic_code = MadridUtils.get_institution_code(line[0].zfill(3)) + '00'
 
-            # Select the column from which to read amounts. See similar comment above.
-            budget_position = 8 if len(line) > 7 else 6
-            amount = parse_amount(line[9 if is_actual else budget_position])
-
             # Eliminations before 2023 followed a consistent pattern
-            if int(year) < 2023:
+            if year < 2023:
                 # We've been asked to ignore data for a special department, not really an organism (#756)
                 if ic_code == '200':
-                    return
+                    self._add_elimination(file_info, 'ingreso', line[0], ec_code, amount, False)
+                    continue
 
                 # Ignore transfers from parent organisation.
-                if ec_code[:-2] in ['410', '710', '400', '700']:
-                    print("Eliminando ingreso (organismo %s, artículo %s): %12.2f €" % (line[0], ec_code, amount/100))
+                if ec_code[:-2] in self.INTERNAL_TRANSFER_ARTICLES:
+                    self._add_elimination(file_info, 'ingreso', line[0], ec_code, amount)
                     amount = 0
 
             # From 2023, eliminations come in separate files, but amounts need to be reversed.
             if is_elimination:
                 amount = -amount
 
-            # See note above
-            if six.PY2:
-                description = self._spanish_titlecase(line[5].decode("iso-8859-1").encode("utf-8"))
-            else:
-                # In Python 3 we're handling the encoding at the file level, so we don't need to decode/encode here.
-                description = self._spanish_titlecase(line[5])
-
-            return {
+            items.append({
                 'is_expense': False,
                 'is_actual': is_actual,
                 'ec_code': ec_code[:-2],        # First three digits
@@ -135,19 +235,88 @@ class MadridBudgetLoader(SimpleBudgetLoader):
                 'item_number': ec_code[-2:],    # Last two digits
                 'description': description,
                 'amount': amount
+            })
+
+        return items
+
+    # Keep track of an eliminated row, grouped by organism, article and file.
+    # Note that revenues from the special department (#756) have never been printed.
+    def _add_elimination(self, file_info, kind, organism, ec_code, amount, is_printable=True):
+        if getattr(self, '_is_verbose', False) and is_printable:
+            print("Eliminando %s (organismo %s, artículo %s): %12.2f €" % (kind, organism, ec_code, amount/100))
+
+        key = (kind, organism, ec_code[:-2], file_info['filename'])
+        self._add_eliminations(self._get_eliminations(), key, 1, amount)
+
+        # Keep track also of the eliminations of the file being parsed, for the cache
+        if getattr(self, '_file_eliminations', None) is not None:
+            self._add_eliminations(self._file_eliminations, key, 1, amount)
+
+    def _add_eliminations(self, eliminations, key, count, amount):
+        previous_count, previous_total = eliminations.get(key, (0, 0))
+        eliminations[key] = (previous_count + count, previous_total + amount)
+
+    def _get_eliminations(self):
+        if not hasattr(self, '_eliminations'):
+            self._eliminations = collections.OrderedDict()
+        return self._eliminations
+
+    def print_eliminations_summary(self):
+        if not getattr(self, '_eliminations', None):
+            return
+
+        print("Resumen de eliminaciones:")
+        print("  %-8s %-10s %-9s %-40s %6s %18s" % ('Tipo', 'Organismo', 'Artículo', 'Fichero', 'Filas', 'Importe'))
+        for (kind, organism, article, filename), (count, total) in self._eliminations.items():
+            print("  %-8s %-10s %-9s %-40s %6d %16.2f €" % (kind, organism, article, filename, count, total/100))
+
+        total_count = sum(count for count, _ in self._eliminations.values())
+        print("  %d filas eliminadas en total." % total_count)
+
+    # Extract the metadata we need from the filename. This is done once per file.
+    def _get_file_info(self, filename):
+        if not hasattr(self, '_file_info_cache'):
+            self._file_info_cache = {}
+
+        file_info = self._file_info_cache.get(filename)
+        if file_info is None:
+            year = int(re.search(r'municipio/(\d+)/', filename).group(1))
+
+            file_info = {
+                'filename': os.path.basename(filename),
+                'year': year,
+                'is_expense': (filename.find('gastos') != -1),
+                'is_actual': (filename.find('/ejecucion_') != -1),
+                'is_elimination': (filename.find('eliminaciones') != -1),
+                # The format of numbers in data files have changed along the years:
+                # Up to 2016 (included) we converted Excel files using in2csv: English format
+                # From 2017 we use the original CSVs from the open data portal: Spanish format
+                'is_spanish_format': (year >= 2017),
             }
+            self._file_info_cache[filename] = file_info
+
+        return file_info
+
+    # The input files are encoded in ISO-8859-1, since we want to work with the files
+    # as they're published in the original open data portal. All the text fields are
+    # ignored, as we use the codes instead, but the description one.
+    # Descriptions repeat a lot, so we titlecase each distinct one only once.
+    def _get_descriptions(self, raw_descriptions):
+        descriptions = {}
+        for raw_description in raw_descriptions:
+            if raw_description not in descriptions:
+                if six.PY2:
+                    description = raw_description.decode("iso-8859-1").encode("utf-8")
+                else:
+                    # In Python 3 we're handling the encoding at the file level, so we don't need to decode/encode here.
+                    description = raw_description
+                descriptions[raw_description] = self._spanish_titlecase(description)
+        return [descriptions[raw_description] for raw_description in raw_descriptions]
 
+    # Read number in Spanish format (123.456,78), and return it as number of cents.
+    # Note that some Spanish files use a dot as decimal mark, see MadridUtils.parse_amount.
     def parse_spanish_amount(self, amount):
-        try:
-            fa = float(amount) 
-            if re.search(r"\d\.\d", amount) and fa > int(fa//1): # Número decimal que no lleva 
-                                                                 # comas y delimitador punto
-                amount = amount.replace('.', ',') # Ejemplo: 200234.78 --> 200234,78
-        except ValueError: # el número lleva comas.
-            amount = amount.replace('.', '') # Ejemplo: 1.245.300,26 --> 1245300,26
-        
-        amount = amount.replace('.', '')    # Remove thousands delimiters, if any
-        return self._read_english_number(amount.replace(',', '.'))
+        return MadridUtils.parse_amount(amount, True, True)
 
     def _get_delimiter(self):
         return ';'
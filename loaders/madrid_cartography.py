@@ -0,0 +1,322 @@
+# -*- coding: UTF-8 -*-
+import glob
+import gzip
+import hashlib
+import io
+import json
+import os
+
+# The district shapes of the main investments map used to come as a huge script,
+# with the raw GeoJSON, that every visitor had to download and parse. Instead, we build
+# from the GeoJSON (data/cartografia/distritos.geojson) a quantized TopoJSON file per
+# zoom level, simplified as much as it can be without the difference being visible at
+# that level, so the map only loads the level it needs, when it needs it.
+#
+# Files are stored, together with a gzipped copy, under generated/cartography, with a
+# hash of their content in their name, so they can be cached forever. index.json tells
+# the current name of each level. See the build_cartography command.
+#
+# Unlike the rest of generated/, they only depend on files in the repository, so they're
+# kept in it too, and deploys don't need to build them. Build them again, and commit them,
+# after changing the source GeoJSON or this code. The same input gives the same files.
+#
+# The TopoJSON is built here (quantization, shared borders as arcs, delta encoding) rather
+# than with the topojson npm tools, so it can be built with the rest of the data.
+class MadridCartography:
+
+    SOURCE_FILENAME = os.path.join('data', 'cartografia', 'distritos.geojson')
+    FOLDER = os.path.join('generated', 'cartography')
+    INDEX_FILENAME = 'index.json'
+
+    # Name of the TopoJSON object holding the districts
+    OBJECT_NAME = 'districts'
+
+    # Feature properties used by the map
+    PROPERTIES = ['COD_DIS', 'NOMBRE']
+
+    # Levels of detail, by the highest zoom level they're meant for. The last one, with
+    # no limit, is used when zooming in further.
+    LEVELS = [12, 14, 16]
+
+    # The map uses 512px tiles, as Mapbox GL does
+    TILE_SIZE = 512
+
+    # In pixels, at the highest zoom level of each level of detail
+    QUANTIZATION_STEP = 0.5
+    SIMPLIFICATION_TOLERANCE = 1.0
+
+    # The given path is the theme folder
+    def __init__(self, theme_path):
+        self.source_filename = os.path.join(theme_path, self.SOURCE_FILENAME)
+        self.path = os.path.join(theme_path, self.FOLDER)
+
+    # (Re)build the TopoJSON files, from the GeoJSON ones
+    def build(self):
+        with open(self.source_filename, 'r') as source_file:
+            collection = json.load(source_file)
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        levels = []
+        for max_zoom in self.LEVELS:
+            topology = self.get_topology(collection, max_zoom)
+            levels.append({
+                'max_zoom': max_zoom if max_zoom != self.LEVELS[-1] else None,
+                'filename': self._write('districts-z%d' % max_zoom, topology),
+            })
+
+        index = {'levels': levels}
+        self._write_index(index)
+        self._remove_old_files(index)
+        return index
+
+    # The current index of levels, or None
+    def get_index(self):
+        index_filename = os.path.join(self.path, self.INDEX_FILENAME)
+        if not os.path.isfile(index_filename):
+            return None
+        with open(index_filename, 'r') as index_file:
+            return json.load(index_file)
+
+    # The full path of a TopoJSON file, if it exists
+    def get_file_path(self, filename):
+        file_path = os.path.join(self.path, os.path.basename(filename))
+        return file_path if os.path.isfile(file_path) else None
+
+    # The TopoJSON topology of a GeoJSON feature collection of polygons, for the given zoom
+    def get_topology(self, collection, max_zoom):
+        step = 360.0 / (self.TILE_SIZE * 2 ** max_zoom) * self.QUANTIZATION_STEP
+        tolerance = self.SIMPLIFICATION_TOLERANCE / self.QUANTIZATION_STEP
+
+        # Quantize all the coordinates first, so shared borders match exactly
+        bbox = self._get_bbox(collection['features'])
+        polygons = []
+        for feature in collection['features']:
+            polygons.append([
+                [self._quantize_ring(ring, bbox, step) for ring in polygon]
+                for polygon in self._get_polygons(feature['geometry'])
+            ])
+
+        # Cut the rings where borders meet, so each border becomes an arc of its own,
+        # shared by the polygons on both sides, and simplify each arc as a whole.
+        junctions = self._get_junctions(ring for polygon in polygons for rings in polygon for ring in rings)
+        arcs = []
+        arc_ids = {}
+        geometries = []
+        for feature, feature_polygons in zip(collection['features'], polygons):
+            arc_polygons = [
+                [self._get_ring_arcs(ring, junctions, arcs, arc_ids) for ring in rings]
+                for rings in feature_polygons
+            ]
+            geometries.append({
+                'type': 'Polygon' if len(arc_polygons) == 1 else 'MultiPolygon',
+                'arcs': arc_polygons[0] if len(arc_polygons) == 1 else arc_polygons,
+                'properties': dict((key, feature['properties'].get(key)) for key in self.PROPERTIES),
+            })
+        arcs = self._simplify_arcs(arcs, geometries, tolerance)
+
+        return {
+            'type': 'Topology',
+            'bbox': bbox,
+            'transform': {
+                'scale': [step, step],
+                'translate': [bbox[0], bbox[1]],
+            },
+            'objects': {
+                self.OBJECT_NAME: {
+                    'type': 'GeometryCollection',
+                    'geometries': geometries,
+                },
+            },
+            'arcs': [self._encode_arc(arc) for arc in arcs],
+        }
+
+    # A GeoJSON feature collection from a topology, the same way the map decodes it
+    @staticmethod
+    def to_geojson(topology):
+        scale = topology['transform']['scale']
+        translate = topology['transform']['translate']
+
+        arcs = []
+        for encoded_arc in topology['arcs']:
+            x = y = 0
+            arc = []
+            for dx, dy in encoded_arc:
+                x += dx
+                y += dy
+                arc.append([x * scale[0] + translate[0], y * scale[1] + translate[1]])
+            arcs.append(arc)
+
+        def get_ring(arc_ids):
+            ring = []
+            for arc_id in arc_ids:
+                arc = arcs[arc_id] if arc_id >= 0 else arcs[~arc_id][::-1]
+                ring.extend(arc[1:] if ring else arc)
+            return ring
+
+        features = []
+        for geometry in topology['objects'][MadridCartography.OBJECT_NAME]['geometries']:
+            if geometry['type'] == 'Polygon':
+                coordinates = [get_ring(ring) for ring in geometry['arcs']]
+            else:
+                coordinates = [[get_ring(ring) for ring in polygon] for polygon in geometry['arcs']]
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': geometry['type'], 'coordinates': coordinates},
+                'properties': geometry['properties'],
+            })
+        return {'type': 'FeatureCollection', 'features': features}
+
+    def _get_polygons(self, geometry):
+        return [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+
+    def _get_bbox(self, features):
+        points = [
+            point
+            for feature in features
+            for polygon in self._get_polygons(feature['geometry'])
+            for ring in polygon
+            for point in ring
+        ]
+        return [
+            min(point[0] for point in points),
+            min(point[1] for point in points),
+            max(point[0] for point in points),
+            max(point[1] for point in points),
+        ]
+
+    # The ring as a list of points in the quantized grid, without repeated points,
+    # nor the closing one
+    def _quantize_ring(self, ring, bbox, step):
+        points = []
+        for point in ring:
+            point = (int(round((point[0] - bbox[0]) / step)), int(round((point[1] - bbox[1]) / step)))
+            if not points or points[-1] != point:
+                points.append(point)
+        if len(points) > 1 and points[0] == points[-1]:
+            points.pop()
+        return points
+
+    # Points where borders meet, i.e. those with different neighbours in different rings
+    def _get_junctions(self, rings):
+        neighbours = {}
+        junctions = set()
+        for ring in rings:
+            for i, point in enumerate(ring):
+                point_neighbours = tuple(sorted([ring[i - 1], ring[(i + 1) % len(ring)]]))
+                if neighbours.setdefault(point, point_neighbours) != point_neighbours:
+                    junctions.add(point)
+        return junctions
+
+    # The ids of the arcs making up the ring, adding the new ones to the list.
+    # Arcs used backwards, as a neighbour polygon does, have a negative id (~id).
+    def _get_ring_arcs(self, ring, junctions, arcs, arc_ids):
+        cuts = [i for i, point in enumerate(ring) if point in junctions]
+        if cuts:
+            ring = ring[cuts[0]:] + ring[:cuts[0]]
+            cuts = [i - cuts[0] for i in cuts]
+        else:
+            # Start from the same point always, so the same ring gives the same arc
+            start = ring.index(min(ring))
+            ring = ring[start:] + ring[:start]
+            cuts = [0]
+        ring = ring + ring[:1]
+
+        ring_arc_ids = []
+        for start, end in zip(cuts, cuts[1:] + [len(ring) - 1]):
+            arc = tuple(ring[start:end + 1])
+            if arc in arc_ids:
+                ring_arc_ids.append(arc_ids[arc])
+            elif arc[::-1] in arc_ids:
+                ring_arc_ids.append(~arc_ids[arc[::-1]])
+            else:
+                arc_ids[arc] = len(arcs)
+                ring_arc_ids.append(len(arcs))
+                arcs.append(arc)
+        return ring_arc_ids
+
+    # Simplify the arcs, keeping the junctions, so neighbour polygons still fit together.
+    # Rings that would get too small keep their original arcs.
+    def _simplify_arcs(self, arcs, geometries, tolerance):
+        simplified_arcs = [self._simplify(arc, tolerance) for arc in arcs]
+        for geometry in geometries:
+            polygons = [geometry['arcs']] if geometry['type'] == 'Polygon' else geometry['arcs']
+            for ring in (ring for polygon in polygons for ring in polygon):
+                arc_ids = [arc_id if arc_id >= 0 else ~arc_id for arc_id in ring]
+                if sum(len(simplified_arcs[arc_id]) - 1 for arc_id in arc_ids) < 3:
+                    for arc_id in arc_ids:
+                        simplified_arcs[arc_id] = arcs[arc_id]
+        return simplified_arcs
+
+    # Douglas-Peucker, iteratively
+    def _simplify(self, arc, tolerance):
+        is_kept = [False] * len(arc)
+        is_kept[0] = is_kept[-1] = True
+        pending = [(0, len(arc) - 1)]
+        while pending:
+            start, end = pending.pop()
+            max_distance, max_index = 0, None
+            for i in range(start + 1, end):
+                distance = self._get_distance(arc[i], arc[start], arc[end])
+                if distance > max_distance:
+                    max_distance, max_index = distance, i
+            if max_index is not None and max_distance > tolerance:
+                is_kept[max_index] = True
+                pending.append((start, max_index))
+                pending.append((max_index, end))
+        return [point for point, kept in zip(arc, is_kept) if kept]
+
+    # Distance from a point to a segment
+    def _get_distance(self, point, start, end):
+        dx, dy = end[0] - start[0], end[1] - start[1]
+        if dx == 0 and dy == 0:
+            return ((point[0] - start[0]) ** 2 + (point[1] - start[1]) ** 2) ** 0.5
+        t = ((point[0] - start[0]) * dx + (point[1] - start[1]) * dy) / float(dx * dx + dy * dy)
+        t = max(0, min(1, t))
+        return ((point[0] - start[0] - t * dx) ** 2 + (point[1] - start[1] - t * dy) ** 2) ** 0.5
+
+    # First point as is, then the differences with the previous one
+    def _encode_arc(self, arc):
+        encoded_arc = [list(arc[0])]
+        for previous, point in zip(arc, arc[1:]):
+            encoded_arc.append([point[0] - previous[0], point[1] - previous[1]])
+        return encoded_arc
+
+    # Write a file, and its gzipped copy. Returns its filename.
+    def _write(self, name, data):
+        content = json.dumps(data, ensure_ascii=False, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+        filename = "%s.%s.json" % (name, hashlib.sha1(content).hexdigest()[:12])
+        file_path = os.path.join(self.path, filename)
+        if not os.path.isfile(file_path):
+            self._write_file(file_path, content)
+
+            # No timestamp in the gzip header, so the same content gives the same file
+            compressed_content = io.BytesIO()
+            with gzip.GzipFile(filename='', mode='wb', fileobj=compressed_content, mtime=0) as gzip_file:
+                gzip_file.write(content)
+            self._write_file(file_path + '.gz', compressed_content.getvalue())
+
+        return filename
+
+    def _write_index(self, index):
+        self._write_file(
+            os.path.join(self.path, self.INDEX_FILENAME),
+            json.dumps(index, indent=2, sort_keys=True).encode('utf-8'))
+
+    # Write to a temporary file first, so a file is never seen half-written
+    def _write_file(self, file_path, content):
+        temp_file_path = file_path + '.tmp'
+        with open(temp_file_path, 'wb') as output_file:
+            output_file.write(content)
+        os.rename(temp_file_path, file_path)
+
+    def _remove_old_files(self, index):
+        current_filenames = set(level['filename'] for level in index['levels'])
+        for file_path in glob.glob(os.path.join(self.path, 'districts-*.json*')):
+            filename = os.path.basename(file_path)
+            if filename.endswith('.gz'):
+                filename = filename[:-len('.gz')]
+            if filename not in current_filenames:
+                os.remove(file_path)
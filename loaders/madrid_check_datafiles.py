@@ -6,21 +6,13 @@ import six
 import sys
 import re
 
-from decimal import *
-
-
-# Read number in English format (123,456.78), and return as number of cents
-def read_english_number(s):
-    if s.strip() == "":
-        return 0
-
-    return int(Decimal(s.replace(',', '')) * 100)
+# This script is run from the loaders folder, so we can import the shared utilities directly
+from madrid_utils import MadridUtils
 
 
 # Read number in Spanish format (123.456,78), and return as number of cents
 def parse_spanish_amount(amount):
-    amount = amount.replace('.', '')    # Remove thousands delimiters, if any
-    return read_english_number(amount.replace(',', '.'))
+    return MadridUtils.parse_amount(amount)
 
 
 def format_number_as_spanish(n):
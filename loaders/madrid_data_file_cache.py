@@ -0,0 +1,75 @@
+# -*- coding: UTF-8 -*-
+import collections
+import csv
+import hashlib
+import io
+import os
+import re
+import six
+
+# Loads are run for both languages, and the data files in data/es and data/en are usually
+# byte-identical copies. So we keep, per process, the items parsed from the most recent files,
+# indexed by their content: the second language gets a copy of the items parsed for the first
+# one, without reading, decoding or parsing the file again. Language-specific stuff, i.e. the
+# classification descriptions, is added later on, when writing to the database.
+class MadridDataFileCache:
+
+    # How many parsed files we keep around. A full year of budget data is eight files.
+    MAX_ENTRIES = 16
+
+    _entries = collections.OrderedDict()
+
+    # Read the raw content of a data file, and get the key to use when caching it.
+    # Parsing depends on the year and filename, not only on the content, so those are part
+    # of the key, but not the language.
+    @staticmethod
+    def read(filename):
+        with open(filename, 'rb') as data_file:
+            content = data_file.read()
+        return (content, MadridDataFileCache.get_key(filename, hashlib.sha1(content).hexdigest()))
+
+    # The key of a data file whose content has the given hash
+    @staticmethod
+    def get_key(filename, sha1):
+        return (os.path.basename(os.path.dirname(filename)), os.path.basename(filename), sha1)
+
+    # Returns a copy of the items stored for the given loader and key, plus any extra data
+    # the loader stored with them, or None. Items are flat dictionaries, and loaders may
+    # modify them when writing, so each caller gets its own copies.
+    @staticmethod
+    def get(loader, key):
+        entry = MadridDataFileCache._entries.get((loader.__class__.__name__, key))
+        if entry is None:
+            return None
+
+        items, extra = entry
+        return ([dict(item) for item in items], extra)
+
+    @staticmethod
+    def set(loader, key, items, extra=None):
+        entries = MadridDataFileCache._entries
+        entries[(loader.__class__.__name__, key)] = ([dict(item) for item in items], extra)
+        while len(entries) > MadridDataFileCache.MAX_ENTRIES:
+            entries.popitem(last=False)
+
+    # Split the raw content of a data file into lines, skipping comments and empty lines
+    @staticmethod
+    def get_lines(content, encoding, delimiter):
+        if six.PY2:
+            reader = csv.reader(content.splitlines(True), delimiter=delimiter)
+        else:
+            reader = csv.reader(io.StringIO(content.decode(encoding), newline=''), delimiter=delimiter)
+        return MadridDataFileCache.filter_lines(reader)
+
+    # The lines of a CSV reader, skipping comments and empty lines. These are the lines the
+    # budget_app loaders skip when reading a data file, so loaders overriding parse_data_file,
+    # to cache what they parse, or reading files on their own, get the same lines as the base
+    # loaders would. Keep them in sync.
+    @staticmethod
+    def filter_lines(reader):
+        for line in reader:
+            if not line or re.match("^#", line[0]):     # Ignore comments
+                continue
+            if re.match("^ +$", line[0]):               # Ignore empty lines
+                continue
+            yield line
@@ -0,0 +1,281 @@
+# -*- coding: UTF-8 -*-
+import collections
+import json
+import os
+import six
+import tempfile
+
+from django.core.exceptions import FieldError
+from django.db import transaction
+
+from budget_app.models import Budget
+
+# Monthly execution updates usually change only some amounts, but reloading means deleting
+# and inserting again the whole year. In delta mode, we compare the newly parsed items with
+# the ones loaded last time, by natural key, and apply only the needed inserts, updates and
+# deletes.
+#
+# To do that, after every full load we keep a snapshot of the loaded rows (database id,
+# natural key, amount, description and categories) next to the load manifest. The snapshot
+# is only saved if each database row can be paired with a parsed item (see _pair), so if
+# anything looks unexpected we just go back to full loads.
+class MadridExecutionDelta:
+
+    # Set this environment variable to enable delta loads
+    ENABLE_VARIABLE = 'MADRID_DELTA_LOAD'
+
+    STATE_FOLDER = 'load_state'
+
+    # - model: the Django model the loader writes to.
+    # - fields: model field -> item field, for the fields we can update or need to insert.
+    # - key_fields: item fields making up the natural key.
+    # - categories: model foreign key -> item fields identifying the category. To insert new
+    #   rows we reuse the category of an existing row with the same codes.
+    def __init__(self, manifest, year, dataset, model, fields, key_fields, categories):
+        self.model = model
+        self.fields = fields
+        self.key_fields = key_fields
+        self.categories = categories
+        self.filename = os.path.join(
+            os.path.dirname(manifest.filename),
+            self.STATE_FOLDER,
+            str(year),
+            "%s-%s.json" % (dataset, manifest.language))
+
+    @staticmethod
+    def is_enabled():
+        return os.environ.get(MadridExecutionDelta.ENABLE_VARIABLE, '') not in ['', '0']
+
+    # Called after a full load, with the items given to the loader
+    def save_snapshot(self, entity, year, items):
+        budget = Budget.objects.filter(entity=entity, year=year).order_by('-id').first()
+        rows = []
+        if budget is not None:
+            try:
+                rows = list(self.model.objects.filter(budget=budget).order_by('id').values('id', *self._get_row_fields()))
+            except FieldError:
+                # The data is already loaded, so don't fail because of this
+                rows = []
+
+        pairs = self._pair(rows, items)
+        if pairs is None:
+            print("No se han podido asociar las partidas cargadas a los datos leídos, "
+                  "la próxima carga de %s será completa." % (year, ))
+            self._remove_snapshot()
+            return
+
+        self._write_snapshot({
+            'budget_id': budget.id,
+            'rows': [self._get_snapshot_row(row['id'], item, row) for row, item in pairs],
+        })
+
+    # Apply the differences between the snapshot and the given items. Returns False, without
+    # touching the database, if that's not possible, so the caller can do a full load instead.
+    def apply(self, entity, year, items, status=None):
+        snapshot = self._read_snapshot()
+        if snapshot is None or not Budget.objects.filter(id=snapshot['budget_id'], entity=entity, year=year).exists():
+            return False
+
+        old_rows_by_key = collections.OrderedDict()
+        for row in snapshot['rows']:
+            old_rows_by_key.setdefault(tuple(row['key']), []).append(row)
+
+        new_items_by_key = collections.OrderedDict()
+        for item in items:
+            new_items_by_key.setdefault(self._get_key(item), []).append(item)
+
+        # Work out what needs to change. Rows sharing a natural key (it happens, i.e. with
+        # elimination files) are updated in place if their number hasn't changed, and
+        # replaced otherwise.
+        updates = []
+        deletes = []
+        inserts = []
+        for key in set(old_rows_by_key) | set(new_items_by_key):
+            old_rows = old_rows_by_key.get(key, [])
+            new_items = new_items_by_key.get(key, [])
+            if len(old_rows) == len(new_items):
+                for row, item in zip(old_rows, new_items):
+                    if row['values'] != self._get_values(item):
+                        updates.append((row, item))
+            else:
+                deletes.extend(old_rows)
+                inserts.extend(new_items)
+
+        categories = self._get_category_index(snapshot['rows'])
+        new_rows = []
+        for item in inserts:
+            category_ids = {}
+            for field, item_fields in self.categories.items():
+                category_id = categories[field].get(self._get_category_key(item, item_fields))
+                if category_id is None:
+                    print("La partida %s no tiene categoría conocida, hacemos una carga completa." % (self._get_key(item), ))
+                    return False
+                category_ids[field] = category_id
+            new_rows.append((item, category_ids))
+
+        with transaction.atomic():
+            for row, item in updates:
+                self.model.objects.filter(id=row['id']).update(**self._get_values(item))
+                row['values'] = self._get_values(item)
+
+            self.model.objects.filter(id__in=[row['id'] for row in deletes]).delete()
+
+            created_objects = self.model.objects.bulk_create([
+                self.model(budget_id=snapshot['budget_id'], **dict(self._get_values(item), **category_ids))
+                for item, category_ids in new_rows
+            ])
+
+            if status is not None:
+                Budget.objects.filter(id=snapshot['budget_id']).update(status=status)
+
+        print("Carga incremental: %d partidas nuevas, %d actualizadas y %d borradas, de %d." % (
+            len(inserts), len(updates), len(deletes), len(items)))
+
+        # Keep the snapshot up to date. Some databases don't give us back the ids of new rows,
+        # in which case next load will be a full one.
+        deleted_ids = set(row['id'] for row in deletes)
+        snapshot['rows'] = [row for row in snapshot['rows'] if row['id'] not in deleted_ids]
+        for created_object, (item, category_ids) in zip(created_objects, new_rows):
+            if created_object.pk is None:
+                self._remove_snapshot()
+                return True
+            snapshot['rows'].append(self._get_snapshot_row(created_object.pk, item, category_ids))
+        self._write_snapshot(snapshot)
+
+        return True
+
+    def _get_row_fields(self):
+        return list(self.fields.keys()) + list(self.categories.keys())
+
+    def _get_key(self, item):
+        return tuple(item.get(field) for field in self.key_fields)
+
+    def _get_values(self, item):
+        return dict((model_field, item.get(item_field)) for model_field, item_field in self.fields.items())
+
+    def _get_category_key(self, item, item_fields):
+        return "|".join(str(item.get(field)) for field in item_fields)
+
+    def _get_snapshot_row(self, id, item, categories):
+        return {
+            'id': id,
+            'key': list(self._get_key(item)),
+            'values': self._get_values(item),
+            'categories': dict((field, categories[field]) for field in self.categories),
+            'category_keys': dict((field, self._get_category_key(item, item_fields)) for field, item_fields in self.categories.items()),
+        }
+
+    def _get_category_index(self, rows):
+        index = dict((field, {}) for field in self.categories)
+        for row in rows:
+            for field in self.categories:
+                index[field][row['category_keys'][field]] = row['categories'][field]
+        return index
+
+    # Pair the database rows with the items we gave the loader, without relying on the order
+    # the loader inserted them in. Returns a list of (row, item), by row id, or None if some
+    # row can't be told apart from others, or doesn't match any item.
+    #
+    # Rows don't have the codes of their categories, only their ids. So we first pair the
+    # rows and items whose values (amount, item number...) are unique, and learn from them
+    # the id of each category. Rows sharing their values are then paired by their categories,
+    # learning the ids of the categories not seen before when there's no doubt about them.
+    def _pair(self, rows, items):
+        if len(rows) != len(items) or not rows:
+            return None
+
+        rows_by_values = collections.OrderedDict()
+        for row in rows:
+            rows_by_values.setdefault(self._get_match_values(row, self.fields.keys()), []).append(row)
+        items_by_values = collections.OrderedDict()
+        for item in items:
+            items_by_values.setdefault(self._get_match_values(item, self.fields.values()), []).append(item)
+
+        if set(rows_by_values) != set(items_by_values):
+            return None
+
+        pairs = []
+        category_ids = dict((field, {}) for field in self.categories)
+        for values, value_rows in rows_by_values.items():
+            value_items = items_by_values[values]
+            if len(value_rows) != len(value_items):
+                return None
+            if len(value_rows) > 1:
+                continue
+
+            row, item = value_rows[0], value_items[0]
+            for field, item_fields in self.categories.items():
+                category_key = self._get_category_key(item, item_fields)
+                if category_ids[field].setdefault(category_key, row[field]) != row[field]:
+                    return None
+            pairs.append((row, item))
+
+        # Pairing an item may teach us ids needed for another, so go on while we make progress
+        pending = [(value_rows, items_by_values[values]) for values, value_rows in rows_by_values.items()
+                   if len(value_rows) > 1]
+        while pending:
+            remaining = []
+            for value_rows, value_items in pending:
+                unpaired = []
+                for item in value_items:
+                    candidates = [row for row in value_rows if self._has_categories(row, item, category_ids)]
+                    if not candidates:
+                        return None
+
+                    # Rows with the same categories are interchangeable, but we can't choose among others
+                    row = candidates[0]
+                    if any(self._get_categories(candidate) != self._get_categories(row) for candidate in candidates):
+                        unpaired.append(item)
+                        continue
+
+                    for field, item_fields in self.categories.items():
+                        category_ids[field][self._get_category_key(item, item_fields)] = row[field]
+                    value_rows.remove(row)
+                    pairs.append((row, item))
+                if unpaired:
+                    remaining.append((value_rows, unpaired))
+
+            if len(remaining) == len(pending) and \
+                    all(len(old[1]) == len(new[1]) for old, new in zip(pending, remaining)):
+                return None
+            pending = remaining
+
+        return sorted(pairs, key=lambda pair: pair[0]['id'])
+
+    # Whether the row may have the categories of the item, as far as we know their ids
+    def _has_categories(self, row, item, category_ids):
+        for field, item_fields in self.categories.items():
+            category_id = category_ids[field].get(self._get_category_key(item, item_fields), row[field])
+            if category_id != row[field]:
+                return False
+        return True
+
+    def _get_categories(self, row):
+        return tuple(row[field] for field in sorted(self.categories))
+
+    # The values of a row or item we can compare. Loaders may change descriptions when
+    # writing them, i.e. to translate them, so those don't count.
+    def _get_match_values(self, row_or_item, fields):
+        return tuple(
+            row_or_item.get(field)
+            for model_field, field in zip(self.fields.keys(), fields)
+            if model_field != 'description')
+
+    def _read_snapshot(self):
+        if not os.path.isfile(self.filename):
+            return None
+        with open(self.filename, 'r') as snapshot_file:
+            return json.load(snapshot_file)
+
+    def _write_snapshot(self, snapshot):
+        if not os.path.exists(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.filename), prefix=os.path.basename(self.filename) + '.',
+                                         suffix='.tmp', delete=False) as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        (os.rename if six.PY2 else os.replace)(snapshot_file.name, self.filename)
+
+    def _remove_snapshot(self):
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
@@ -1,12 +1,49 @@
 # -*- coding: UTF-8 -*-
 import six
 import csv
+import os
 import re
 
 from budget_app.models import *
 from budget_app.loaders import InvestmentsLoader
 
-class MadridInvestmentsLoader(InvestmentsLoader):
+if six.PY2:
+    from madrid_data_file_cache import MadridDataFileCache
+    from madrid_execution_delta import MadridExecutionDelta
+    from madrid_load_manifest import MadridLoadManifestMixin
+    from madrid_utils import MadridUtils
+else:
+    from .madrid_data_file_cache import MadridDataFileCache
+    from .madrid_execution_delta import MadridExecutionDelta
+    from .madrid_load_manifest import MadridLoadManifestMixin
+    from .madrid_utils import MadridUtils
+
+class MadridInvestmentsLoader(MadridLoadManifestMixin, InvestmentsLoader):
+
+    def _get_manifest_dataset(self):
+        return 'investments'
+
+    def _get_manifest_filenames(self):
+        return ['inversiones.csv', 'ejecucion_inversiones.csv']
+
+    # Monthly execution updates can be loaded as a delta, see MadridExecutionDelta
+    def _get_execution_delta(self, manifest, year):
+        return MadridExecutionDelta(
+            manifest,
+            year,
+            self._get_manifest_dataset(),
+            Investment,
+            {
+                'actual': 'is_actual',
+                'project_id': 'project_id',
+                'description': 'description',
+                'amount': 'amount',
+            },
+            ('is_actual', 'project_id', 'gc_code', 'fc_code'),
+            {
+                'functional_category_id': ('fc_code', ),
+                'geographic_category_id': ('gc_code', ),
+            })
 
     # An artifact of the in2csv conversion of the original XLS files is a trailing '.0',
     # which we remove here
@@ -22,6 +59,28 @@ class MadridInvestmentsLoader(InvestmentsLoader):
             return 'NA'
         return s
 
+    # Files already parsed in this process, i.e. for another language, are not parsed again.
+    # Otherwise lines are read as the base loader does. See MadridDataFileCache for details.
+    def parse_data_file(self, items, filename):
+        if not os.path.isfile(filename):
+            return
+
+        print("Leyendo datos de %s..." % filename)
+        content, cache_key = MadridDataFileCache.read(filename)
+
+        cached_data = MadridDataFileCache.get(self, cache_key)
+        if cached_data is None:
+            file_items = []
+            for line in MadridDataFileCache.get_lines(content, self._get_data_files_encoding(), self._get_delimiter()):
+                item = self.parse_item(filename, line)
+                if item:
+                    file_items.append(item)
+            MadridDataFileCache.set(self, cache_key, file_items)
+        else:
+            file_items, _ = cached_data
+
+        items.extend(file_items)
+
     def parse_item(self, filename, line):
         # Skip empty/header/subtotal lines.
         # Careful with 2017 data, first two columns are usually empty
@@ -40,7 +99,7 @@ class MadridInvestmentsLoader(InvestmentsLoader):
             description = line[4]
             investment_line = self.clean(line[1])
             gc_code = self.map_geo_code(self.clean(line[0]).strip())
-            amount = self._read_english_number(line[5])
+            amount = MadridUtils.parse_amount(line[5], False)
         else:
             # Investment data comes in two very different formats: when the budget is
             # approved and when provided as part of an execution update.
@@ -49,14 +108,14 @@ class MadridInvestmentsLoader(InvestmentsLoader):
                 description = self._safe_to_utf8(line[8])
                 investment_line = line[11]
                 gc_code = self.map_geo_code(line[9])
-                amount = self._read_spanish_number(line[28 if is_actual else 23])
+                amount = MadridUtils.parse_amount(line[28 if is_actual else 23])
 
             else:
                 project_id = line[0]
                 description = self._safe_to_utf8(line[1])
                 investment_line = line[7]
                 gc_code = self.map_geo_code(line[11])
-                amount = self._read_spanish_number(line[6])
+                amount = MadridUtils.parse_amount(line[6])
 
         # Note we implement the investment lines as an extension of functional policies.
         # See #527 for further information.
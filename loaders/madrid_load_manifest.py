@@ -0,0 +1,239 @@
+# -*- coding: UTF-8 -*-
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import six
+import tempfile
+
+from budget_app.models import Budget
+
+if six.PY2:
+    from madrid_data_file_cache import MadridDataFileCache
+    from madrid_execution_delta import MadridExecutionDelta
+else:
+    from .madrid_data_file_cache import MadridDataFileCache
+    from .madrid_execution_delta import MadridExecutionDelta
+
+# Keeps track of what has been loaded: for each year, dataset and language, a hash of the
+# input files, plus their row counts and totals. Historical years almost never change, so
+# loaders use it to skip data that hasn't changed since the last successful load. The hash
+# covers the loaders' code too, so changing how the data is parsed loads it again.
+#
+# Each entry also keeps the id of the budget the data was loaded into. Loading a budget
+# again replaces it, and so deletes all the data linked to it (investments, payments...),
+# so data loaded into a budget that's gone is loaded again, even if its files didn't change.
+# The manifest is stored next to the data folder, as load_manifest.json.
+class MadridLoadManifest:
+
+    FILENAME = 'load_manifest.json'
+
+    # Set this environment variable to load the data even if it hasn't changed
+    FORCE_RELOAD_VARIABLE = 'MADRID_FORCE_RELOAD'
+
+    # Bump this to load everything again for reasons other than changes in the data files
+    # or in the loaders, e.g. a new version of budget_app
+    VERSION = 1
+
+    _code_version = None
+
+    # The given path is a year folder, i.e. data/<language>/<level>/<year>
+    def __init__(self, path):
+        year_path = os.path.normpath(os.path.abspath(path))
+        level_path = os.path.dirname(year_path)
+        language_path = os.path.dirname(level_path)
+        data_path = os.path.dirname(language_path)
+
+        self.language = os.path.basename(language_path)
+        self.filename = os.path.join(os.path.dirname(data_path), self.FILENAME)
+
+    @staticmethod
+    def is_forced():
+        return os.environ.get(MadridLoadManifest.FORCE_RELOAD_VARIABLE, '') not in ['', '0']
+
+    # Hash of the given input files, in order, and of the loaders' code. Missing files count,
+    # since they may appear later. Returns the hash, plus the hash and row count of each file,
+    # which is what gets recorded after the load, so files are read only once for this.
+    @staticmethod
+    def get_fingerprint(loader, path, filenames):
+        encoding = getattr(loader, '_get_data_files_encoding', lambda: 'utf-8')()
+        delimiter = getattr(loader, '_get_delimiter', lambda: ',')()
+
+        fingerprint = hashlib.sha1(MadridLoadManifest.get_code_version().encode('utf-8'))
+        files = {}
+        for filename in filenames:
+            fingerprint.update(filename.encode('utf-8'))
+            file_path = os.path.join(path, filename)
+            if os.path.isfile(file_path):
+                content, cache_key = MadridDataFileCache.read(file_path)
+                fingerprint.update(cache_key[2].encode('utf-8'))
+                files[filename] = {
+                    'sha1': cache_key[2],
+                    'rows': sum(1 for _ in MadridDataFileCache.get_lines(content, encoding, delimiter)),
+                }
+            else:
+                fingerprint.update(b'-')
+        return (fingerprint.hexdigest(), files)
+
+    # Hash of the code of all the loaders, plus VERSION. Any change in them loads all the data
+    # again, which is slow, but safer than guessing which changes affect which data.
+    @staticmethod
+    def get_code_version():
+        if MadridLoadManifest._code_version is None:
+            code_version = hashlib.sha1(str(MadridLoadManifest.VERSION).encode('utf-8'))
+            loaders_path = os.path.dirname(os.path.abspath(__file__))
+            for filename in sorted(glob.glob(os.path.join(loaders_path, '*.py'))):
+                code_version.update(os.path.basename(filename).encode('utf-8'))
+                with open(filename, 'rb') as code_file:
+                    code_version.update(hashlib.sha1(code_file.read()).hexdigest().encode('utf-8'))
+            MadridLoadManifest._code_version = code_version.hexdigest()
+        return MadridLoadManifest._code_version
+
+    # Number of items and total amount of the given parsed items
+    @staticmethod
+    def get_totals(items):
+        return (len(items), sum(item.get('amount') or 0 for item in items))
+
+    # The budget of the given year, the last one loaded, or None if there isn't one
+    @staticmethod
+    def get_budget(entity, year):
+        return Budget.objects.filter(entity=entity, year=year).order_by('-id').first()
+
+    @staticmethod
+    def get_budget_id(entity, year):
+        budget = MadridLoadManifest.get_budget(entity, year)
+        return budget.id if budget is not None else None
+
+    # Whether the budget the data was loaded into is still there
+    def is_loaded(self, entity, year, dataset):
+        entry = self._read().get(self._get_key(year, dataset))
+        return entry is not None and \
+            entry.get('budget_id') is not None and \
+            Budget.objects.filter(id=entry['budget_id'], entity=entity, year=year).exists()
+
+    def is_up_to_date(self, entity, year, dataset, fingerprint):
+        entry = self._read().get(self._get_key(year, dataset))
+        return entry is not None and entry['fingerprint'] == fingerprint and self.is_loaded(entity, year, dataset)
+
+    # Record a successful load. Files are as returned by get_fingerprint, and the budget id
+    # is the one of the budget the data was loaded into, see get_budget_id. The number of
+    # items and their total, if known, are recorded too.
+    def record(self, year, dataset, fingerprint, files, budget_id, items=None, total=None):
+        entry = {
+            'fingerprint': fingerprint,
+            'code_version': MadridLoadManifest.get_code_version(),
+            'budget_id': budget_id,
+            'files': files,
+        }
+        if items is not None:
+            entry['items'] = items
+        if total is not None:
+            entry['total'] = total
+
+        # Each loader runs in its own process, and they may run at the same time, so hold
+        # a lock while updating the manifest, not to lose each other's entries
+        with open(self.filename + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            manifest = self._read()
+            manifest[self._get_key(year, dataset)] = entry
+            self._write(manifest)
+
+    def _get_key(self, year, dataset):
+        return "%s/%s/%s" % (year, dataset, self.language)
+
+    def _read(self):
+        if not os.path.isfile(self.filename):
+            return {}
+        with open(self.filename, 'r') as manifest_file:
+            return json.load(manifest_file)
+
+    # Write to a temporary file first, so an interrupted load doesn't leave a broken manifest
+    def _write(self, manifest):
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.filename), prefix=self.FILENAME + '.',
+                                         suffix='.tmp', delete=False) as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        os.chmod(manifest_file.name, 0o644)
+        (os.rename if six.PY2 else os.replace)(manifest_file.name, self.filename)
+
+
+# Add this to a loader to skip loads whose input files haven't changed since the last time.
+# Loaders must implement _get_manifest_dataset and _get_manifest_filenames. Loaders whose
+# parsed items are not kept in MadridDataFileCache should call _count_manifest_item for
+# each item they parse, so the manifest gets their totals.
+# Loaders may also implement _get_execution_delta, to support delta loads of data that has
+# changed, see MadridExecutionDelta.
+class MadridLoadManifestMixin(object):
+
+    def load(self, entity, year, path, *args, **kwargs):
+        manifest = MadridLoadManifest(path)
+        dataset = self._get_manifest_dataset()
+        filenames = self._get_manifest_filenames()
+        fingerprint, files = MadridLoadManifest.get_fingerprint(self, path, filenames)
+        self._manifest_items = 0
+        self._manifest_total = None
+
+        # Just in case the database has been reset, or the budget loaded again, since the last load
+        is_loaded = manifest.is_loaded(entity, year, dataset)
+
+        if is_loaded and not MadridLoadManifest.is_forced() and manifest.is_up_to_date(entity, year, dataset, fingerprint):
+            print("Los datos de %s (%s, %s) no han cambiado desde la última carga, los ignoramos. "
+                  "Usa %s=1 para cargarlos igualmente." % (dataset, year, manifest.language, MadridLoadManifest.FORCE_RELOAD_VARIABLE))
+            return
+
+        delta = self._get_execution_delta(manifest, year)
+
+        if is_loaded and delta is not None and MadridExecutionDelta.is_enabled() and not MadridLoadManifest.is_forced():
+            # Budget loaders get the budget status right after the path
+            items = self._parse_manifest_files(path, filenames)
+            if delta.apply(entity, year, items, *args[:1]):
+                manifest.record(year, dataset, fingerprint, files, MadridLoadManifest.get_budget_id(entity, year),
+                                *MadridLoadManifest.get_totals(items))
+                return
+
+        self._load_data(entity, year, path, *args, **kwargs)
+
+        items = self._get_cached_items(path, filenames, files)
+        if items is not None:
+            totals = MadridLoadManifest.get_totals(items)
+        else:
+            totals = (self._manifest_items, self._manifest_total)
+        manifest.record(year, dataset, fingerprint, files, MadridLoadManifest.get_budget_id(entity, year), *totals)
+
+        if delta is not None and items is not None:
+            delta.save_snapshot(entity, year, items)
+
+    # The actual load, by default the one of the base loader
+    def _load_data(self, entity, year, path, *args, **kwargs):
+        super(MadridLoadManifestMixin, self).load(entity, year, path, *args, **kwargs)
+
+    # Count a parsed item, and its amount, if it has one, for the totals in the manifest
+    def _count_manifest_item(self, amount=None):
+        self._manifest_items = getattr(self, '_manifest_items', 0) + 1
+        if amount is not None:
+            self._manifest_total = (getattr(self, '_manifest_total', None) or 0) + amount
+
+    # No delta loads by default
+    def _get_execution_delta(self, manifest, year):
+        return None
+
+    def _parse_manifest_files(self, path, filenames):
+        items = []
+        for filename in filenames:
+            self.parse_data_file(items, os.path.join(path, filename))
+        return items
+
+    # The items just loaded, in order, as kept in MadridDataFileCache, or None if not available.
+    # Files are as returned by get_fingerprint, so we don't need to read them again.
+    def _get_cached_items(self, path, filenames, files):
+        items = []
+        for filename in filenames:
+            if filename not in files:
+                continue
+
+            cache_key = MadridDataFileCache.get_key(os.path.join(path, filename), files[filename]['sha1'])
+            cached_data = MadridDataFileCache.get(self, cache_key)
+            if cached_data is None:
+                return None
+            items.extend(cached_data[0])
+        return items
@@ -0,0 +1,202 @@
+# -*- coding: UTF-8 -*-
+import collections
+import glob
+import gzip
+import hashlib
+import io
+import json
+import os
+import six
+
+from budget_app.models import MainInvestment
+
+if six.PY2:
+    from madrid_main_investments_search import MadridMainInvestmentsSearch
+else:
+    from .madrid_main_investments_search import MadridMainInvestmentsSearch
+
+# The main investments map used to get the whole dataset embedded in the page, as inline
+# JSON. Instead, when loading the data, we build a GeoJSON bundle per year, plus a combined
+# one with all the years, which is what the map uses. Bundles are stored, together with a
+# gzipped copy, under generated/main_investments/<language>, with a hash of their content
+# in their name, so they can be cached forever. index.json tells the current name of each.
+# A text search index is built too, see MadridMainInvestmentsSearch.
+#
+# Feature properties are the same fields, and formats, the map page used to embed,
+# including the HTML escaping of texts, since the map shows them as HTML.
+#
+# An investment shows up once per year, so each bundle comes also with an index of the
+# records of each project, by year (see _get_projects), so the map doesn't have to
+# search for them, nor rely on the order of the features.
+class MadridMainInvestmentsBundle:
+
+    FOLDER = os.path.join('generated', 'main_investments')
+    INDEX_FILENAME = 'index.json'
+
+    # The combined bundle, with all the years
+    ALL_YEARS = 'all'
+
+    # The text search index
+    SEARCH = 'search'
+
+    # The given path is the theme folder
+    def __init__(self, theme_path, language):
+        self.path = os.path.join(theme_path, self.FOLDER, language)
+
+    # (Re)build the bundles, from the main investments in the database
+    def build(self, entity):
+        main_investments = MainInvestment.objects \
+            .filter(budget__entity=entity) \
+            .select_related('budget', 'functional_category') \
+            .order_by('budget__year', 'id')
+
+        # Sorted by year ascending, as the map expects
+        features_by_year = collections.OrderedDict()
+        features = []
+        for main_investment in main_investments:
+            feature = self._get_feature(len(features), main_investment)
+            features.append(feature)
+            features_by_year.setdefault(str(main_investment.budget.year), []).append(feature)
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        index = {self.ALL_YEARS: self._write('main_investments', self._get_collection(features))}
+        for year, year_features in features_by_year.items():
+            index[year] = self._write('main_investments-%s' % year, self._get_collection(year_features))
+        index[self.SEARCH] = self._write('main_investments_search', MadridMainInvestmentsSearch(features).to_json())
+
+        self._write_index(index)
+        self._remove_old_bundles(index)
+        return index
+
+    # The filename of the current bundle for the given year, or all of them, or an index, or None
+    def get_filename(self, year=ALL_YEARS):
+        index_filename = os.path.join(self.path, self.INDEX_FILENAME)
+        if not os.path.isfile(index_filename):
+            return None
+        with open(index_filename, 'r') as index_file:
+            return json.load(index_file).get(str(year))
+
+    # The full path of a bundle file, if it exists
+    def get_file_path(self, filename):
+        file_path = os.path.join(self.path, os.path.basename(filename))
+        return file_path if os.path.isfile(file_path) else None
+
+    def _get_collection(self, features):
+        return {
+            'type': 'FeatureCollection',
+            'features': features,
+            'projects': self._get_projects(features),
+        }
+
+    # The position of the feature of each project for each year, by project id and year.
+    # If a project shows up more than once in a year, the last one is the one that counts,
+    # as it used to be the one shown on top in the map.
+    def _get_projects(self, features):
+        projects = collections.defaultdict(dict)
+        for position, feature in enumerate(features):
+            properties = feature['properties']
+            projects[properties['project_id']][properties['year']] = position
+        return dict(projects)
+
+    def _get_feature(self, id, main_investment):
+        latitude = self._clean_coordinate(main_investment.latitude, 90)
+        longitude = self._clean_coordinate(main_investment.longitude, 180)
+        if latitude == '' or longitude == '':
+            latitude = longitude = ''
+
+        entity_name = main_investment.entity_name
+        if entity_name == "AYUNTAMIENTO":
+            entity_name = main_investment.section_name
+
+        description = main_investment.description
+        if main_investment.status != "EN PROCESO":
+            description += u" ✔️"
+
+        return {
+            'type': 'Feature',
+            'id': id,
+            'geometry': {
+                'type': 'Point',
+                'coordinates': [float(longitude), float(latitude)],
+            } if latitude != '' else None,
+            'properties': {
+                'project_id': self._escape(main_investment.project_id),
+                'year': str(main_investment.budget.year),
+                'description': self._escape(description),
+                'start_year': str(main_investment.start_year),
+                'expected_end_year': str(main_investment.expected_end_year),
+                'actual_end_year': '' if main_investment.actual_end_year is None else str(main_investment.actual_end_year),
+                'area_name': self._escape(main_investment.area_name),
+                'address': self._escape(main_investment.address),
+                'latitude': latitude,
+                'longitude': longitude,
+                'entity_name': self._escape(entity_name),
+                'functional_category': self._escape(main_investment.functional_category.description),
+                'already_spent_amount': main_investment.already_spent_amount / 100.0,
+                'current_year_expected_amount': main_investment.current_year_expected_amount / 100.0,
+                'current_year_spent_amount': main_investment.current_year_spent_amount / 100.0,
+                'total_expected_amount': main_investment.total_expected_amount / 100.0,
+                'status': self._escape(main_investment.status),
+                'image_URL': self._escape(main_investment.image_URL),
+            },
+        }
+
+    # Same escaping as the templates
+    def _escape(self, text):
+        return text \
+            .replace('&', '&amp;') \
+            .replace('<', '&lt;') \
+            .replace('>', '&gt;') \
+            .replace('"', '&#34;') \
+            .replace('\'', '&#39;')
+
+    # Coordinates come as text, and sometimes dirty. Returns '' if not valid.
+    def _clean_coordinate(self, coordinate, limit):
+        coordinate = (coordinate or '').strip().replace('\'', '').replace(',', '.')
+        try:
+            value = float(coordinate)
+        except ValueError:
+            return ''
+        if value == 0 or abs(value) > limit:
+            return ''
+        return str(round(value, 6))
+
+    # Write a bundle, and its gzipped copy. Returns its filename.
+    def _write(self, name, data):
+        content = json.dumps(data, ensure_ascii=False, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+        filename = "%s.%s.json" % (name, hashlib.sha1(content).hexdigest()[:12])
+        file_path = os.path.join(self.path, filename)
+        if not os.path.isfile(file_path):
+            self._write_file(file_path, content)
+
+            # No timestamp in the gzip header, so the same content gives the same file
+            compressed_content = io.BytesIO()
+            with gzip.GzipFile(filename='', mode='wb', fileobj=compressed_content, mtime=0) as gzip_file:
+                gzip_file.write(content)
+            self._write_file(file_path + '.gz', compressed_content.getvalue())
+
+        return filename
+
+    def _write_index(self, index):
+        self._write_file(
+            os.path.join(self.path, self.INDEX_FILENAME),
+            json.dumps(index, indent=2, sort_keys=True).encode('utf-8'))
+
+    # Write to a temporary file first, so a bundle is never seen half-written
+    def _write_file(self, file_path, content):
+        temp_file_path = file_path + '.tmp'
+        with open(temp_file_path, 'wb') as output_file:
+            output_file.write(content)
+        os.rename(temp_file_path, file_path)
+
+    def _remove_old_bundles(self, index):
+        current_filenames = set(index.values())
+        for file_path in glob.glob(os.path.join(self.path, 'main_investments*.json*')):
+            filename = os.path.basename(file_path)
+            if filename.endswith('.gz'):
+                filename = filename[:-len('.gz')]
+            if filename not in current_filenames:
+                os.remove(file_path)
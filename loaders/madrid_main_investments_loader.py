@@ -1,10 +1,37 @@
 # -*- coding: UTF-8 -*-
+from django.utils import translation
 from budget_app.models import *
 from budget_app.loaders import MainInvestmentsLoader
 import csv
+import os
 import re
+import six
+
+if six.PY2:
+    from madrid_load_manifest import MadridLoadManifest, MadridLoadManifestMixin
+    from madrid_main_investments_bundle import MadridMainInvestmentsBundle
+    from madrid_utils import MadridUtils
+else:
+    from .madrid_load_manifest import MadridLoadManifest, MadridLoadManifestMixin
+    from .madrid_main_investments_bundle import MadridMainInvestmentsBundle
+    from .madrid_utils import MadridUtils
+
+class MadridMainInvestmentsLoader(MadridLoadManifestMixin, MainInvestmentsLoader):
+
+    def _get_manifest_dataset(self):
+        return 'main_investments'
+
+    def _get_manifest_filenames(self):
+        return ['inversiones_principales.csv']
+
+    def load(self, entity, year, path, *args, **kwargs):
+        super(MadridMainInvestmentsLoader, self).load(entity, year, path, *args, **kwargs)
+
+        # Rebuild the bundles the map uses, see MadridMainInvestmentsBundle
+        manifest = MadridLoadManifest(path)
+        with translation.override(manifest.language):
+            MadridMainInvestmentsBundle(os.path.dirname(manifest.filename), manifest.language).build(entity)
 
-class MadridMainInvestmentsLoader(MainInvestmentsLoader):
     def read_nullable_integer(self, s):
         return None if s==None or s=='' else int(s)
 
@@ -37,7 +64,7 @@ class MadridMainInvestmentsLoader(MainInvestmentsLoader):
 
         # Note we implement the investment lines as an extension of functional policies.
         # See #527 for further information.
-        return {
+        item = {
             'project_id': project_id,
             'description': line[5].strip(),
             'image_URL': self.get_image_URL(line[30]),
@@ -51,15 +78,17 @@ class MadridMainInvestmentsLoader(MainInvestmentsLoader):
             'start_year': self.read_nullable_integer(line[6]),
             'expected_end_year': self.read_nullable_integer(line[7].strip()),
             'actual_end_year': self.read_nullable_integer(line[8].strip()),
-            'total_expected_amount': self._read_spanish_number(line[27].strip()),
-            'already_spent_amount': self._read_spanish_number(line[19].strip()),
-            'current_year_expected_amount': self._read_spanish_number(line[20].strip()),
-            'current_year_spent_amount': self._read_spanish_number(line[21].strip()),
+            'total_expected_amount': MadridUtils.parse_amount(line[27]),
+            'already_spent_amount': MadridUtils.parse_amount(line[19]),
+            'current_year_expected_amount': MadridUtils.parse_amount(line[20]),
+            'current_year_spent_amount': MadridUtils.parse_amount(line[21]),
             'gc_code': gc_code,
             'fc_code': 'X'+investment_line.zfill(2),
             'fc_area': 'X',
             'fc_policy': 'X'+investment_line.zfill(2),
         }
+        self._count_manifest_item(item['total_expected_amount'])
+        return item
 
     def _get_delimiter(self):
         return ';'
@@ -0,0 +1,52 @@
+# -*- coding: UTF-8 -*-
+import collections
+import re
+import six
+import unicodedata
+
+# Text search index of the main investments, so the map doesn't have to go through all
+# the features on each keystroke. For each trigram, the ids of the features (of the combined
+# bundle, see MadridMainInvestmentsBundle) with a text containing it. A search is then the
+# intersection of the features of the trigrams of the query, which the map still checks
+# against the actual texts, since having all the trigrams doesn't mean having all the query.
+#
+# Texts are normalized as the map does (see normalizeString in investments-map.js):
+# lower case, without accents. Lists of ids are sorted, and stored as the differences
+# between consecutive ids, which makes the index much smaller.
+class MadridMainInvestmentsSearch:
+
+    FIELDS = ['description', 'address', 'area_name', 'entity_name']
+
+    TRIGRAM_LENGTH = 3
+
+    ACCENTS = re.compile(u'[\u0300-\u036f]')
+
+    def __init__(self, features):
+        self.trigrams = self._build_trigrams(features)
+
+    def to_json(self):
+        return {
+            'fields': self.FIELDS,
+            'trigrams': self.trigrams,
+        }
+
+    @staticmethod
+    def normalize(text):
+        return MadridMainInvestmentsSearch.ACCENTS.sub('', unicodedata.normalize('NFD', six.text_type(text).lower()))
+
+    def _build_trigrams(self, features):
+        trigrams = collections.defaultdict(list)
+        for feature in features:
+            feature_trigrams = set()
+            for field in self.FIELDS:
+                feature_trigrams.update(self._get_trigrams(self.normalize(feature['properties'][field])))
+            for trigram in feature_trigrams:
+                trigrams[trigram].append(feature['id'])
+        return dict((trigram, self._encode_ids(sorted(ids))) for trigram, ids in trigrams.items())
+
+    def _get_trigrams(self, text):
+        return set(text[i:i + self.TRIGRAM_LENGTH] for i in range(len(text) - self.TRIGRAM_LENGTH + 1))
+
+    # First id as is, then the differences with the previous one
+    def _encode_ids(self, ids):
+        return ids[:1] + [id - previous_id for previous_id, id in zip(ids, ids[1:])]
@@ -1,5 +1,7 @@
 # -*- coding: UTF-8 -*-
+import collections
 import csv
+import os
 import re
 import six
 
@@ -7,11 +9,41 @@ from budget_app.models import *
 from budget_app.loaders import MonitoringLoader
 
 if six.PY2:
+    from madrid_data_file_cache import MadridDataFileCache
+    from madrid_load_manifest import MadridLoadManifestMixin
+    from madrid_monitoring_scores import MadridMonitoringScores
     from madrid_utils import MadridUtils
 else:
+    from .madrid_data_file_cache import MadridDataFileCache
+    from .madrid_load_manifest import MadridLoadManifestMixin
+    from .madrid_monitoring_scores import MadridMonitoringScores
     from .madrid_utils import MadridUtils
 
-class MadridMonitoringLoader(MonitoringLoader):
+# The codes of each goal are worked out once, so activities and indicators find their goal
+# without working out its codes again, and rows without a goal are reported (see _is_orphan).
+# Note the rows are still written to the database by the base MonitoringLoader, one by one.
+class MadridMonitoringLoader(MadridLoadManifestMixin, MonitoringLoader):
+
+    def _get_manifest_dataset(self):
+        return 'monitoring'
+
+    def _get_manifest_filenames(self):
+        return ['objetivos.csv', 'actividades.csv', 'indicadores.csv']
+
+    def load(self, entity, year, path, *args, **kwargs):
+        self._goal_keys = {}
+        self._goal_codes = {}
+        self._goal_uids = {}
+        self._orphans = collections.OrderedDict()
+        self._scores = MadridMonitoringScores()
+
+        super(MadridMonitoringLoader, self).load(entity, year, path, *args, **kwargs)
+
+        self.print_orphans_summary()
+
+        # Nothing has been parsed if the data hasn't changed since the last load
+        if not self._scores.is_empty():
+            self._scores.save(path, year)
 
     def parse_goal(self, filename, line, year):
         # Skip empty/header/subtotal lines.
@@ -19,20 +51,20 @@ class MadridMonitoringLoader(MonitoringLoader):
             return
 
         # Get key fields.
-        # The original Madrid institutional code requires some mapping.
-        ic_code = MadridUtils.map_institutional_code(line[0], int(year))
-        fc_code = MadridUtils.map_functional_code(line[1], int(year))
-        goal_number = line[2]
+        ic_code, fc_code, uid = self._get_goal_key(year, line[0], line[1], line[2])
 
-        return {
-            'uid': self._get_goal_uid(year, ic_code, fc_code, goal_number),
+        goal = {
+            'uid': uid,
             'ic_code': ic_code,
             'fc_code': fc_code,
-            'goal_number': goal_number,
+            'goal_number': line[2],
             'description': self._decode_utf8(line[3]),
             'report': re.sub(r'<U>|</>', '', line[4])
         }
 
+        self._count_manifest_item()
+        return goal
+
 
     def parse_activity(self, filename, line, year):
         # Skip empty/header/subtotal lines.
@@ -40,13 +72,13 @@ class MadridMonitoringLoader(MonitoringLoader):
             return
 
         # Get key fields to identify the parent goal.
-        # The original Madrid institutional code requires some mapping.
-        ic_code = MadridUtils.map_institutional_code(line[0], int(year))
-        fc_code = MadridUtils.map_functional_code(line[1], int(year))
-        goal_number = line[2]
+        goal_uid = self._get_goal_key(year, line[0], line[1], line[2])[2]
+        if self._is_orphan(filename, year, goal_uid, 'actividad'):
+            return
 
+        self._count_manifest_item()
         return {
-            'goal_uid': self._get_goal_uid(year, ic_code, fc_code, goal_number),
+            'goal_uid': goal_uid,
             'activity_number': line[3],
             'description': self._decode_utf8(line[4]),
         }
@@ -58,10 +90,9 @@ class MadridMonitoringLoader(MonitoringLoader):
             return
 
         # Get key fields to identify the parent goal.
-        # The original Madrid institutional code requires some mapping.
-        ic_code = MadridUtils.map_institutional_code(line[0], int(year))
-        fc_code = MadridUtils.map_functional_code(line[1], int(year))
-        goal_number = line[2]
+        goal_uid = self._get_goal_key(year, line[0], line[1], line[2])[2]
+        if self._is_orphan(filename, year, goal_uid, 'indicador'):
+            return
 
         # Some other basic fields
         description = self._decode_utf8(line[4])
@@ -94,8 +125,13 @@ class MadridMonitoringLoader(MonitoringLoader):
                     # Note: we assume negative values do not exist, simpler this way.
                     score = min(float(actual)/float(target), 1.0)
 
+        # Keep track of the scores, see MadridMonitoringScores
+        ic_code, fc_code = self._goal_codes[goal_uid]
+        self._get_scores().add(ic_code, fc_code, score, _is_inverse_indicator)
+
+        self._count_manifest_item()
         return {
-            'goal_uid': self._get_goal_uid(year, ic_code, fc_code, goal_number),
+            'goal_uid': goal_uid,
             'indicator_number': line[3][0:2],   # Some weird extra characters in the data sometimes
             'description': description,
             'unit': unit,
@@ -117,6 +153,71 @@ class MadridMonitoringLoader(MonitoringLoader):
     def _get_goal_uid(self, year, ic_code, fc_code, goal_number):
         return "%s-%s-%s-%s" % (year, ic_code, fc_code, goal_number)
 
+    # The mapped codes and uid of a goal, worked out once for each goal, no matter how many
+    # activities and indicators it has.
+    def _get_goal_key(self, year, raw_ic_code, raw_fc_code, goal_number):
+        if not hasattr(self, '_goal_keys'):
+            self._goal_keys = {}
+            self._goal_codes = {}
+
+        key = (year, raw_ic_code, raw_fc_code, goal_number)
+        goal_key = self._goal_keys.get(key)
+        if goal_key is None:
+            # The original Madrid institutional code requires some mapping.
+            ic_code = MadridUtils.map_institutional_code(raw_ic_code, int(year))
+            fc_code = MadridUtils.map_functional_code(raw_fc_code, int(year))
+            goal_key = (ic_code, fc_code, self._get_goal_uid(year, ic_code, fc_code, goal_number))
+            self._goal_keys[key] = goal_key
+            self._goal_codes[goal_key[2]] = (ic_code, fc_code)
+
+        return goal_key
+
+    def _get_scores(self):
+        if not hasattr(self, '_scores'):
+            self._scores = MadridMonitoringScores()
+        return self._scores
+
+    # The uids of the goals in the objetivos.csv file of the given year folder, or None if
+    # there's no such file. The file is read on its own, the first time it's needed, so
+    # this doesn't depend on the order the files are parsed in.
+    def _get_goal_uids(self, year, path):
+        if not hasattr(self, '_goal_uids'):
+            self._goal_uids = {}
+
+        if path not in self._goal_uids:
+            filename = os.path.join(path, 'objetivos.csv')
+            goal_uids = None
+            if os.path.isfile(filename):
+                content = MadridDataFileCache.read(filename)[0]
+                encoding = getattr(self, '_get_data_files_encoding', lambda: 'utf-8')()
+                goal_uids = set(
+                    self._get_goal_key(year, line[0], line[1], line[2])[2]
+                    for line in MadridDataFileCache.get_lines(content, encoding, self._get_delimiter())
+                    if line[0]!='' and line[0]!='CeGe')
+            self._goal_uids[path] = goal_uids
+        return self._goal_uids[path]
+
+    # Activities and indicators whose goal is not in objetivos.csv are left out, and reported
+    # at the end of the load. Most years come without goals file, though, so there's nothing
+    # to check against then.
+    def _is_orphan(self, filename, year, goal_uid, kind):
+        goal_uids = self._get_goal_uids(year, os.path.dirname(filename))
+        if goal_uids is None or goal_uid in goal_uids:
+            return False
+
+        if not hasattr(self, '_orphans'):
+            self._orphans = collections.OrderedDict()
+        self._orphans[(kind, goal_uid)] = self._orphans.get((kind, goal_uid), 0) + 1
+        return True
+
+    def print_orphans_summary(self):
+        if not getattr(self, '_orphans', None):
+            return
+
+        print("Filas sin objetivo en objetivos.csv, que no se cargan:")
+        for (kind, goal_uid), count in self._orphans.items():
+            print("  %-10s %-30s %6d" % (kind, goal_uid, count))
+
     def _get_delimiter(self):
         return ';'
 
@@ -0,0 +1,85 @@
+# -*- coding: UTF-8 -*-
+import json
+import os
+import six
+import tempfile
+
+# Summaries of the indicator scores of a year, by functional programme, policy and
+# institutional section, so pages don't have to go through every indicator of a goal set
+# to show them. They're worked out while loading the monitoring data, and stored as
+# generated/monitoring_scores/<language>/<year>.json, next to the data folder, since
+# each language has its own data files. The monitoring pages belong to budget_app,
+# which would read them with MadridMonitoringScores.read.
+class MadridMonitoringScores:
+
+    FOLDER = os.path.join('generated', 'monitoring_scores')
+
+    # Scores go from 0 to 1, and are grouped in buckets of this size: [0, 0.2), [0.2, 0.4)...
+    # The last one includes 1.
+    BUCKET_COUNT = 5
+
+    def __init__(self):
+        self.summaries = {'programme': {}, 'policy': {}, 'section': {}}
+
+    def add(self, ic_code, fc_code, score, is_inverse):
+        for level, code in [('programme', fc_code), ('policy', fc_code[:2]), ('section', ic_code)]:
+            summary = self.summaries[level].get(code)
+            if summary is None:
+                summary = {'indicators': 0, 'scored': 0, 'total': 0.0, 'buckets': [0] * self.BUCKET_COUNT, 'inverse': 0}
+                self.summaries[level][code] = summary
+
+            summary['indicators'] += 1
+            if is_inverse:
+                summary['inverse'] += 1
+            if score is not None:
+                summary['scored'] += 1
+                summary['total'] += score
+                summary['buckets'][min(int(score * self.BUCKET_COUNT), self.BUCKET_COUNT - 1)] += 1
+
+    def is_empty(self):
+        return not self.summaries['programme']
+
+    # The summaries, with the mean score of each code, if any indicator has a score
+    def get_summaries(self):
+        summaries = {}
+        for level, codes in self.summaries.items():
+            summaries[level] = {}
+            for code, summary in codes.items():
+                summaries[level][code] = {
+                    'indicators': summary['indicators'],
+                    'scored': summary['scored'],
+                    'mean': round(summary['total'] / summary['scored'], 4) if summary['scored'] else None,
+                    'buckets': summary['buckets'],
+                    'inverse': summary['inverse'],
+                }
+        return summaries
+
+    # The given path is a year folder, i.e. data/<language>/<level>/<year>.
+    # Write to a temporary file first, so readers never see a half-written file.
+    def save(self, path, year):
+        year_path = os.path.normpath(os.path.abspath(path))
+        language_path = os.path.dirname(os.path.dirname(year_path))
+        theme_path = os.path.dirname(os.path.dirname(language_path))
+
+        filename = MadridMonitoringScores.get_filename(theme_path, os.path.basename(language_path), year)
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(filename), prefix=os.path.basename(filename) + '.',
+                                         suffix='.tmp', delete=False) as scores_file:
+            json.dump(self.get_summaries(), scores_file, sort_keys=True)
+        os.chmod(scores_file.name, 0o644)
+        (os.rename if six.PY2 else os.replace)(scores_file.name, filename)
+
+    @staticmethod
+    def get_filename(theme_path, language, year):
+        return os.path.join(theme_path, MadridMonitoringScores.FOLDER, language, '%s.json' % year)
+
+    # Returns the summaries stored for the given language and year, or None
+    @staticmethod
+    def read(theme_path, language, year):
+        filename = MadridMonitoringScores.get_filename(theme_path, language, year)
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'r') as scores_file:
+            return json.load(scores_file)
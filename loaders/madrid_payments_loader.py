@@ -1,41 +1,166 @@
 # -*- coding: UTF-8 -*-
+import csv
+import io
+import os
 import re
+import resource
 import six
+import time
+
+from django.db import transaction
 
 from budget_app.loaders import PaymentsLoader
-from budget_app.models import Budget
+from budget_app.models import Budget, InstitutionalCategory, Payment
 
 if six.PY2:
+    from madrid_data_file_cache import MadridDataFileCache
+    from madrid_load_manifest import MadridLoadManifest, MadridLoadManifestMixin
     from madrid_utils import MadridUtils
 else:
+    from .madrid_data_file_cache import MadridDataFileCache
+    from .madrid_load_manifest import MadridLoadManifest, MadridLoadManifestMixin
     from .madrid_utils import MadridUtils
 
-class MadridPaymentsLoader(PaymentsLoader):
+class MadridPaymentsLoader(MadridLoadManifestMixin, PaymentsLoader):
+
+    # Some non-ASCII characters are messed up in payee names
+    PAYEE_REPLACEMENTS = [('Ð', 'Ñ'), ('Ë', 'Ó'), ('\'-', 'Á')]
+
+    # And some payee names have bizarre punctuation marks:
+    PAYEE_TRAILING_DOTS = re.compile(r'( \.)+$')   # trailing 1-2 instances of " ."
+    PAYEE_LEADING_DOTS = re.compile(r'^[\. ]+')    # leading dot or spaces
+
+    # Payments are parsed and written in batches of this size, so memory use doesn't depend
+    # on the size of the year. Can be changed with the MADRID_PAYMENTS_BATCH_SIZE variable.
+    BATCH_SIZE = 2000
+    BATCH_SIZE_VARIABLE = 'MADRID_PAYMENTS_BATCH_SIZE'
+
+    def _get_manifest_dataset(self):
+        return 'payments'
+
+    def _get_manifest_filenames(self):
+        return ['pagos.csv']
+
+    def load(self, entity, year, path, *args, **kwargs):
+        self._reset_caches()
+
+        super(MadridPaymentsLoader, self).load(entity, year, path, *args, **kwargs)
+
+        self.print_cache_summary()
+
+    # Stream the payments from the data file to the database, one batch at a time, instead
+    # of parsing the whole year first. The whole year is written in a single transaction.
+    def _load_data(self, entity, year, path, *args, **kwargs):
+        budget = MadridLoadManifest.get_budget(entity, year)
+        if budget is None:
+            raise Exception("No se ha encontrado el presupuesto de %s para %s." % (entity.name, year))
+
+        filename = os.path.join(path, 'pagos.csv')
+        print("Leyendo datos de %s..." % filename)
+
+        start_time = time.time()
+        count = 0
+        with transaction.atomic():
+            Payment.objects.filter(budget=budget).delete()
+
+            for items in self._get_batches(self._parse_payments(budget, filename)):
+                self._create_payments(budget, items)
+                count += len(items)
+
+        elapsed_time = max(time.time() - start_time, 0.001)
+        print("Cargados %d pagos en %.1fs (%d filas/s, lotes de %d, memoria máxima %.1f MB)." % (
+            count, elapsed_time, count / elapsed_time, self._get_batch_size(), self._get_peak_memory()))
+
+    # The base loader saves each payment on its own, one query per payment, so we build
+    # them here and insert the whole batch at once. Payments only have an institutional
+    # category (see parse_item), which we look up once per code.
+    def _create_payments(self, budget, items):
+        Payment.objects.bulk_create([
+            Payment(
+                budget=budget,
+                area=item['area'],
+                functional_category=None,
+                economic_category=None,
+                institutional_category=self._get_institutional_category(budget, item['ic_code']),
+                date=item['date'],
+                payee=item['payee'],
+                payee_fiscal_id=item['payee_fiscal_id'],
+                description=item['description'],
+                amount=item['amount'])
+            for item in items
+        ])
+
+    def _get_institutional_category(self, budget, ic_code):
+        if self._institutional_categories_budget_id != budget.id:
+            self._institutional_categories = {}
+            self._institutional_categories_budget_id = budget.id
+
+        if ic_code not in self._institutional_categories:
+            institutional_category = InstitutionalCategory.objects.filter(
+                institution=ic_code[0],
+                section=ic_code[0:3],
+                department=ic_code,
+                budget=budget).first()
+            if institutional_category is None:
+                print("ERROR: No se encuentra la categoría institucional '%s' de los pagos." % ic_code)
+            self._institutional_categories[ic_code] = institutional_category
+
+        return self._institutional_categories[ic_code]
+
+    # Payment files are big, so they're read as a stream, rather than whole, as
+    # MadridDataFileCache.get_lines does, but skipping the same lines
+    def _parse_payments(self, budget, filename):
+        if six.PY2:
+            data_file = open(filename, 'rb')
+        else:
+            data_file = io.open(filename, 'r', encoding=self._get_data_files_encoding(), newline='')
+
+        with data_file:
+            for line in MadridDataFileCache.filter_lines(csv.reader(data_file, delimiter=self._get_delimiter())):
+                item = self.parse_item(budget, line)
+                if item:
+                    self._count_manifest_item(item['amount'])
+                    yield item
+
+    def _get_batches(self, items):
+        batch_size = self._get_batch_size()
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _get_batch_size(self):
+        return int(os.environ.get(self.BATCH_SIZE_VARIABLE, '') or self.BATCH_SIZE)
+
+    # In MB. Note Linux reports kilobytes, but macOS bytes.
+    def _get_peak_memory(self):
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_memory / (1024.0 * 1024.0 if os.uname()[0] == 'Darwin' else 1024.0)
+
     # Parse an input line into fields
     def parse_item(self, budget, line):
+        descriptions = self._get_descriptions(budget)
+
         # What we want as area is the programme description
         # Note: in the most recent 2018 data leading zeros were missing in some rows,
         # so add them back using zfill.
         fc_code = line[1].zfill(5)
         policy_id = fc_code[:2]
-        policy = Budget.objects.get_all_descriptions(budget.entity)['functional'][policy_id]
+        policy = descriptions['functional'][policy_id]
 
         # Some descriptions are missing in early years. Per #685, we use the heading text then.
         description = line[3].strip()
         if description == "":
             heading_id = line[2][0:3]
-            description = Budget.objects.get_all_descriptions(budget.entity)['expense'][heading_id]
-
-        # Get the payee name and clean it up a bit, as some non-ASCII characters are messed up.
-        payee = line[5].strip()
-        payee = payee.replace('Ð', 'Ñ').replace('Ë', 'Ó').replace('\'-', 'Á')
-        # And some payee names have bizarre punctuation marks:
-        payee = re.sub(r'( \.)+$', '', payee)  # trailing 1-2 instances of " ."
-        payee = re.sub(r'^[\. ]+', '', payee)  # leading dot or spaces
+            description = descriptions['expense'][heading_id]
 
         # Madrid wants to include the fiscal id trailing the payee name.
         fiscal_id = line[4]
-        payee = payee + ' (' + fiscal_id + ')'
+        payee = self._clean_payee(line[5]) + ' (' + fiscal_id + ')'
 
         # The original Madrid institutional code requires some mapping.
         # Note: in the most recent 2018 data leading zeros were missing in some rows,
@@ -51,9 +176,64 @@ class MadridPaymentsLoader(PaymentsLoader):
             'payee': payee,
             'payee_fiscal_id': fiscal_id[:15],
             'description': description + ' (' + str(budget.year) + ')',
-            'amount': self._read_english_number(line[6]),
+            'amount': MadridUtils.parse_amount(line[6], False),
         }
 
+    # Getting all the descriptions is expensive, so we do it once per budget, not per row
+    def _get_descriptions(self, budget):
+        if not hasattr(self, '_cache_stats'):
+            self._reset_caches()
+
+        if self._descriptions_budget_id != budget.id:
+            all_descriptions = Budget.objects.get_all_descriptions(budget.entity)
+            self._descriptions = {
+                'functional': all_descriptions['functional'],
+                'expense': all_descriptions['expense'],
+            }
+            self._descriptions_budget_id = budget.id
+            self._cache_stats['descriptions'][1] += 1
+        else:
+            self._cache_stats['descriptions'][0] += 1
+
+        return self._descriptions
+
+    # Get the payee name and clean it up a bit. Payees repeat a lot, so we clean up
+    # each distinct name only once.
+    def _clean_payee(self, raw_payee):
+        if not hasattr(self, '_cache_stats'):
+            self._reset_caches()
+
+        payee = self._payees.get(raw_payee)
+        if payee is not None:
+            self._cache_stats['payees'][0] += 1
+            return payee
+
+        payee = raw_payee.strip()
+        for old, new in self.PAYEE_REPLACEMENTS:
+            payee = payee.replace(old, new)
+        payee = self.PAYEE_TRAILING_DOTS.sub('', payee)
+        payee = self.PAYEE_LEADING_DOTS.sub('', payee)
+
+        self._payees[raw_payee] = payee
+        self._cache_stats['payees'][1] += 1
+        return payee
+
+    def _reset_caches(self):
+        self._descriptions = None
+        self._descriptions_budget_id = None
+        self._payees = {}
+        self._institutional_categories = {}
+        self._institutional_categories_budget_id = None
+        # Hits and misses of each cache
+        self._cache_stats = {'descriptions': [0, 0], 'payees': [0, 0]}
+
+    def print_cache_summary(self):
+        cache_names = {'descriptions': 'descripciones', 'payees': 'beneficiarios'}
+        for name, (hits, misses) in sorted(getattr(self, '_cache_stats', {}).items()):
+            if hits + misses:
+                print("Caché de %s: %d aciertos de %d consultas (%.1f%%)." % (
+                    cache_names[name], hits, hits + misses, 100.0 * hits / (hits + misses)))
+
     # We expect the organization code to be one digit, but Madrid has a 3-digit code.
     # We can _almost_ pick the last digit, except for one case.
     def get_institution_code(self, madrid_code):
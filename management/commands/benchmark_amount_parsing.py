@@ -0,0 +1,173 @@
+# -*- coding: UTF-8 -*-
+
+# Compare MadridUtils.parse_amount(s) with the Decimal-based parsers we used to have in the
+# loaders, both in results and in time.
+#
+# Usage: python manage.py benchmark_amount_parsing [--language=es] [--repeat=5]
+#
+# It uses the amounts of every year's budget and payments data files, read as the loaders
+# do, plus a list of amounts out of the ordinary. An amount parsed differently, or rejected
+# by the new parser but not by the old ones, is an error. Amounts the old parsers rejected
+# but the new one accepts are listed.
+
+from decimal import Decimal
+import os
+import re
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from project.settings import THEME_PATH
+
+from ...loaders.madrid_data_file_cache import MadridDataFileCache
+from ...loaders.madrid_utils import MadridUtils
+
+
+# Formats of the amounts: (Spanish, dot allowed as decimal mark)
+ENGLISH = (False, False)
+SPANISH = (True, False)
+BUDGET_SPANISH = (True, True)
+
+EDGE_CASES = [
+    '', ' ', '.', '..', ' . ', ',', '-', '+', '0', '-0', '-0,5', '-0.5', '03', '+5', '--5',
+    '1.234', '1.234,5', '1.234,56', '1.234,567', '-1.234,56', '1.000.000', '1,5', '1.5',
+    '1.50', '1.05', '3.0', '200234.78', '68.8,', '1,234.56', '-1,234.56', '1,000,000',
+    '1e5', '1E-2', '3.106e1', '1.5e400', 'nan', 'inf', '-inf', 'abc', '0x10', '1 234',
+    '1_000', '1..2', '1,,2', '1,2,3', '1.2.3', ',5', '.5', '-.5', '-,5', '5.', '5,', '.,',
+    ',.', ' 12 ', ' -1,5', '\t3,4\n', '12 ,5', '12 .5', '12,3a', '1.2a',
+]
+
+
+class Command(BaseCommand):
+    help = u"Compara la lectura de importes con los métodos basados en Decimal que usábamos"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--language', default='es', help=u"Idioma de los ficheros de datos")
+        parser.add_argument('--repeat', type=int, default=5, help=u"Veces que se lee cada columna")
+
+    def handle(self, *args, **options):
+        path = os.path.join(THEME_PATH, 'data', options['language'], settings.MAIN_ENTITY_LEVEL)
+        years = sorted(int(year) for year in os.listdir(path) if year.isdigit())
+        if not years:
+            raise CommandError(u"No hay datos en %s" % path)
+
+        accepted = []
+        for amount_format in (ENGLISH, SPANISH, BUDGET_SPANISH):
+            accepted.extend(self._check(u"casos especiales", EDGE_CASES, amount_format))
+
+        self.stdout.write(u"%-6s %-18s %8s %8s %12s %12s" % (
+            u"Año", u"Ficheros", u"Importes", u"Únicos", u"Antes", u"Ahora"))
+        for year in years:
+            for name, amounts, amount_format in self._read_amounts(os.path.join(path, str(year)), year):
+                if not amounts:
+                    continue
+                accepted.extend(self._check(u"%s (%s)" % (name, year), amounts, amount_format))
+                self.stdout.write(u"%-6s %-18s %8d %8d %10.2fms %10.2fms" % (
+                    year,
+                    name,
+                    len(amounts),
+                    len(set(amounts)),
+                    self._time(options['repeat'], lambda: [self._parse_amount(amount, amount_format) for amount in amounts]),
+                    self._time(options['repeat'], lambda: MadridUtils.parse_amounts(amounts, *amount_format))))
+
+        self.stdout.write(u"Importes que antes se rechazaban y ahora se aceptan: %d" % len(accepted))
+        for name, amount, amount_format, cents in accepted:
+            self.stdout.write(u"  %s, %s: %r -> %d" % (name, self._get_format_name(amount_format), amount, cents))
+
+    # The amount columns of the year's data files, as the loaders read them
+    def _read_amounts(self, year_path, year):
+        budget_amounts = []
+        for filename in ['gastos.csv', 'gastos_eliminaciones.csv', 'ejecucion_gastos.csv', 'ejecucion_gastos_eliminaciones.csv',
+                         'ingresos.csv', 'ingresos_eliminaciones.csv', 'ejecucion_ingresos.csv', 'ejecucion_ingresos_eliminaciones.csv']:
+            is_expense = (filename.find('gastos') != -1)
+            is_actual = (filename.find('ejecucion_') != -1)
+            for line in self._read_lines(os.path.join(year_path, filename), 'iso-8859-1', ';'):
+                if line[0] == 'Centro':
+                    continue
+                if is_expense:
+                    budget_amounts.append(line[15 if is_actual else (12 if len(line) > 11 else 10)])
+                else:
+                    budget_amounts.append(line[9 if is_actual else (8 if len(line) > 7 else 6)])
+
+        payment_amounts = [line[6] for line in self._read_lines(os.path.join(year_path, 'pagos.csv'), 'utf-8', ',')]
+
+        return [
+            (u"gastos e ingresos", budget_amounts, BUDGET_SPANISH if year >= 2017 else ENGLISH),
+            (u"pagos", payment_amounts, ENGLISH),
+        ]
+
+    def _read_lines(self, file_path, encoding, delimiter):
+        if not os.path.isfile(file_path):
+            return []
+        content, _ = MadridDataFileCache.read(file_path)
+        return list(MadridDataFileCache.get_lines(content, encoding, delimiter))
+
+    # The amounts the old parsers rejected but the new one accepts
+    def _check(self, name, amounts, amount_format):
+        accepted = []
+        for amount in sorted(set(amounts)):
+            expected_cents = self._get_result(lambda: self._parse_amount(amount, amount_format))
+            cents = self._get_result(lambda: MadridUtils.parse_amount(amount, *amount_format))
+            if cents == expected_cents:
+                continue
+
+            if expected_cents is None:
+                accepted.append((name, amount, amount_format, cents))
+            else:
+                raise CommandError(u"Importe distinto en %s, %s: %r -> %s, antes %s" % (
+                    name, self._get_format_name(amount_format), amount, cents, expected_cents))
+
+        # Parsing a whole column must give the same as one amount at a time
+        column_cents = self._get_result(lambda: MadridUtils.parse_amounts(amounts, *amount_format))
+        if column_cents != self._get_result(lambda: [MadridUtils.parse_amount(amount, *amount_format) for amount in amounts]):
+            raise CommandError(u"Importes distintos en %s al leerlos por columnas" % name)
+        return accepted
+
+    # The parsed amount, or None if it's rejected
+    def _get_result(self, function):
+        try:
+            return function()
+        except (ArithmeticError, ValueError):
+            return None
+
+    def _get_format_name(self, amount_format):
+        return {ENGLISH: u"inglés", SPANISH: u"español", BUDGET_SPANISH: u"español con punto decimal"}[amount_format]
+
+    def _time(self, repeat, function):
+        start_time = time.time()
+        for _ in range(repeat):
+            function()
+        return (time.time() - start_time) * 1000 / repeat
+
+    # The way we used to do it
+    def _parse_amount(self, amount, amount_format):
+        if amount_format == ENGLISH:
+            return self._read_english_number(amount)
+        elif amount_format == SPANISH:
+            return self._read_spanish_number(amount)
+        else:
+            return self._parse_spanish_amount(amount)
+
+    # Read number in English format (123,456.78), and return it as number of cents
+    def _read_english_number(self, s):
+        if s.strip() == "":
+            return 0
+        return int(Decimal(s.replace(',', '')) * 100)
+
+    # Read number in Spanish format (123.456,78), and return it as number of cents
+    def _read_spanish_number(self, s):
+        if s.strip() == "":
+            return 0
+        return self._read_english_number(s.replace('.', '').replace(',', '.'))
+
+    # The budget loader's, for Spanish files which may use a dot as decimal mark
+    def _parse_spanish_amount(self, amount):
+        try:
+            fa = float(amount)
+            if re.search(r"\d\.\d", amount) and fa > int(fa//1):
+                amount = amount.replace('.', ',')
+        except ValueError:
+            amount = amount.replace('.', '')
+
+        amount = amount.replace('.', '')
+        return self._read_english_number(amount.replace(',', '.'))
@@ -0,0 +1,139 @@
+# -*- coding: UTF-8 -*-
+
+# Compare the functional and institutional code mappings of MadridUtils, which are compiled
+# into a lookup table per year, with the chain of mappings we used to apply for each code,
+# both in results and in time.
+#
+# Usage: python manage.py benchmark_code_mappings [--language=es] [--repeat=5]
+#
+# It uses the codes of every year's expense data files, plus all the codes appearing in the
+# mappings themselves, for each year.
+
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from project.settings import THEME_PATH
+
+from ...loaders.madrid_data_file_cache import MadridDataFileCache
+from ...loaders.madrid_utils import MadridUtils, \
+    PROGRAMME_MAPPING_2011, PROGRAMME_MAPPING_2012, PROGRAMME_MAPPING_2013, PROGRAMME_MAPPING_2015, \
+    PROGRAMME_MAPPING_PRE_2015, PROGRAMME_MAPPING_PRE_2019, PROGRAMME_MAPPING_RULES, \
+    INSTITUTIONAL_MAPPING_2015, INSTITUTIONAL_MAPPING_PRE_2019, INSTITUTIONAL_MAPPING_PRE_2020, \
+    INSTITUTIONAL_MAPPING_2023, INSTITUTIONAL_MAPPING_RULES
+
+
+class Command(BaseCommand):
+    help = u"Compara las tablas de conversión de códigos con la conversión encadenada original"
+
+    FILENAMES = [
+        'gastos.csv',
+        'gastos_eliminaciones.csv',
+        'ejecucion_gastos.csv',
+        'ejecucion_gastos_eliminaciones.csv',
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument('--language', default='es', help=u"Idioma de los ficheros de datos")
+        parser.add_argument('--repeat', type=int, default=5, help=u"Veces que se convierte cada columna")
+
+    def handle(self, *args, **options):
+        path = os.path.join(THEME_PATH, 'data', options['language'], settings.MAIN_ENTITY_LEVEL)
+        years = sorted(int(year) for year in os.listdir(path) if year.isdigit())
+        if not years:
+            raise CommandError(u"No hay datos en %s" % path)
+
+        self.stdout.write(u"%-6s %8s %8s %12s %12s %12s %12s" % (
+            u"Año", u"Filas", u"Códigos", u"Func. antes", u"Func. ahora", u"Inst. antes", u"Inst. ahora"))
+        for year in years:
+            fc_codes, ic_codes = self._read_codes(os.path.join(path, str(year)))
+            self._check(year, fc_codes, ic_codes)
+
+            repeat = options['repeat']
+            self.stdout.write(u"%-6s %8d %8d %10.2fms %10.2fms %10.2fms %10.2fms" % (
+                year,
+                len(fc_codes),
+                len(set(fc_codes)) + len(set(ic_codes)),
+                self._time(repeat, lambda: [self._map_functional_code(code, year) for code in fc_codes]),
+                self._time(repeat, lambda: MadridUtils.map_functional_codes(fc_codes, year)),
+                self._time(repeat, lambda: [self._map_institutional_code(code, year) for code in ic_codes]),
+                self._time(repeat, lambda: MadridUtils.map_institutional_codes(ic_codes, year))))
+
+    # The codes of the year's expense files, as MadridBudgetLoader reads them
+    def _read_codes(self, year_path):
+        fc_codes = []
+        ic_codes = []
+        for filename in self.FILENAMES:
+            file_path = os.path.join(year_path, filename)
+            if not os.path.isfile(file_path):
+                continue
+
+            content, _ = MadridDataFileCache.read(file_path)
+            for line in MadridDataFileCache.get_lines(content, 'iso-8859-1', ';'):
+                if line[0] == 'Centro':
+                    continue
+                fc_codes.append(line[4].zfill(5))
+                ic_codes.append(line[0].zfill(3) + line[2].zfill(3))
+        return (fc_codes, ic_codes)
+
+    # Same codes as the chained mappings, for every code in the data files or in the mappings
+    def _check(self, year, fc_codes, ic_codes):
+        fc_codes = set(fc_codes)
+        for _, mapping in PROGRAMME_MAPPING_RULES:
+            fc_codes.update(mapping)
+        fc_codes = sorted(fc_codes)
+        expected_codes = [self._map_functional_code(code, year) for code in fc_codes]
+        if [MadridUtils.map_functional_code(code, year) for code in fc_codes] != expected_codes:
+            raise CommandError(u"Códigos de programa distintos en %s" % year)
+        if MadridUtils.map_functional_codes(fc_codes, year) != expected_codes:
+            raise CommandError(u"Códigos de programa distintos en %s (por columnas)" % year)
+
+        # Institutional mappings apply to converted codes, so we make up raw codes for them
+        # (the institution is the third digit of the raw code, see get_institution_code)
+        ic_codes = set(ic_codes)
+        for _, mapping in INSTITUTIONAL_MAPPING_RULES:
+            for code in mapping:
+                ic_codes.add('10' + code[0] + code[1:4])
+        ic_codes = sorted(ic_codes)
+        expected_codes = [self._map_institutional_code(code, year) for code in ic_codes]
+        if [MadridUtils.map_institutional_code(code, year) for code in ic_codes] != expected_codes:
+            raise CommandError(u"Códigos orgánicos distintos en %s" % year)
+        if MadridUtils.map_institutional_codes(ic_codes, year) != expected_codes:
+            raise CommandError(u"Códigos orgánicos distintos en %s (por columnas)" % year)
+
+    def _time(self, repeat, function):
+        start_time = time.time()
+        for _ in range(repeat):
+            function()
+        return (time.time() - start_time) * 1000 / repeat
+
+    # The way we used to do it
+    def _map_functional_code(self, fc_code, year):
+        if year == 2011:
+            fc_code = PROGRAMME_MAPPING_2011.get(fc_code, fc_code)
+        if year == 2012:
+            fc_code = PROGRAMME_MAPPING_2012.get(fc_code, fc_code)
+        if year == 2013:
+            fc_code = PROGRAMME_MAPPING_2013.get(fc_code, fc_code)
+        if year == 2015:
+            fc_code = PROGRAMME_MAPPING_2015.get(fc_code, fc_code)
+        if year < 2015:
+            fc_code = PROGRAMME_MAPPING_PRE_2015.get(fc_code, fc_code)
+        if year < 2019:
+            fc_code = PROGRAMME_MAPPING_PRE_2019.get(fc_code, fc_code)
+        return fc_code
+
+    def _map_institutional_code(self, raw_ic_code, year):
+        institution = MadridUtils.get_institution_code(raw_ic_code[0:3])
+        ic_code = institution + (raw_ic_code[3:6] if institution == '0' else '00')
+
+        if year <= 2015:
+            ic_code = INSTITUTIONAL_MAPPING_2015.get(ic_code, ic_code)
+        if year < 2019:
+            ic_code = INSTITUTIONAL_MAPPING_PRE_2019.get(ic_code, ic_code)
+        if year < 2020:
+            ic_code = INSTITUTIONAL_MAPPING_PRE_2020.get(ic_code, ic_code)
+        if year >= 2023:
+            ic_code = INSTITUTIONAL_MAPPING_2023.get(ic_code, ic_code)
+        return ic_code
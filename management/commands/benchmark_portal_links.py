@@ -0,0 +1,91 @@
+# -*- coding: UTF-8 -*-
+
+# Compare the extraction of the CSV links of the open data portal pages (see admin_links.py)
+# with the full BeautifulSoup parse we used to do, both in time and in results.
+#
+# Usage: python manage.py benchmark_portal_links [page.html ...] [--repeat=20]
+#
+# Without files, it uses the portal pages saved in the HTTP cache of the admin, fetching
+# the missing ones.
+
+import re
+import time
+
+from bs4 import BeautifulSoup
+from django.core.management.base import BaseCommand, CommandError
+
+from ...views import admin_links
+
+
+class Command(BaseCommand):
+    help = u"Compara la extracción de enlaces de las páginas del portal de datos con BeautifulSoup"
+
+    def add_arguments(self, parser):
+        parser.add_argument('pages', nargs='*', help=u"Copias guardadas de páginas del portal")
+        parser.add_argument('--repeat', type=int, default=20, help=u"Veces que se lee cada página")
+
+    def handle(self, *args, **options):
+        pages = self._read_pages(options['pages']) if options['pages'] else self._fetch_pages()
+
+        self.stdout.write(u"%-40s %8s %12s %12s %12s" % (u"Página", u"Tamaño", u"BeautifulSoup", u"Extracción", u"En caché"))
+        for name, page in pages:
+            self._check(name, page)
+            self.stdout.write(u"%-40s %8d %10.2fms %10.2fms %10.3fms" % (
+                name[-40:],
+                len(page),
+                self._time(options['repeat'], lambda: self._get_bs4_links(page)),
+                self._time(options['repeat'], lambda: admin_links._extract_links(page)),
+                self._time(options['repeat'], lambda: admin_links.get_links(page))))
+
+    def _read_pages(self, file_paths):
+        pages = []
+        for file_path in file_paths:
+            with open(file_path, 'rb') as page_file:
+                pages.append((file_path, page_file.read().decode('utf-8', 'replace')))
+        return pages
+
+    def _fetch_pages(self):
+        from ...views import admin
+
+        urls = list(admin.GENERAL_URL.values()) + list(admin.EXECUTION_URL.values()) + \
+            [admin.MONITORING_URL, admin.MAIN_INVESTMENTS_URL, admin.PAYMENTS_URL]
+        return [(url.split('=')[-1], admin._fetch(url)) for url in sorted(set(urls))]
+
+    # Same links, and same links for each year block, as BeautifulSoup
+    def _check(self, name, page):
+        links = admin_links.get_links(page)
+        if links != self._get_bs4_links(page):
+            raise CommandError(u"Enlaces distintos en %s" % name)
+
+        for title, _ in admin_links._get_page_links(page)['years']:
+            for year in re.findall(r'\d{4}', title):
+                if admin_links.get_year_links(page, year) != self._get_bs4_year_links(page, year):
+                    raise CommandError(u"Enlaces del año %s distintos en %s" % (year, name))
+
+    def _time(self, repeat, function):
+        start_time = time.time()
+        for _ in range(repeat):
+            function()
+        return (time.time() - start_time) * 1000 / repeat
+
+    # The way we used to do it
+    def _parse_with_bs4(self, page):
+        page = re.sub("!function\(t,e\).*", "", page)
+        page = re.sub("window.NREUM.*", "", page)
+        return BeautifulSoup(page, "html.parser")
+
+    def _get_bs4_links(self, page):
+        doc = self._parse_with_bs4(page)
+        return [link["href"] for link in doc.find_all("a", class_="ico-csv")]
+
+    # None if there's no title for the year, as get_year_links. Note BeautifulSoup doesn't
+    # find titles with markup inside, so those show up as differences.
+    def _get_bs4_year_links(self, page, year):
+        doc = self._parse_with_bs4(page)
+        title = doc.find("p", class_="info-title", text=re.compile(year))
+        if title is None:
+            return None
+        year_block = title.parent.findNext("ul")
+        if year_block is None:
+            return []
+        return [link["href"] for link in year_block.find_all("a", class_="ico-csv")]
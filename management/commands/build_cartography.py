@@ -0,0 +1,46 @@
+# -*- coding: UTF-8 -*-
+
+# Build the district shapes of the main investments map, as quantized TopoJSON files,
+# one per zoom level, and commit the result. See MadridCartography.
+#
+# Usage: python manage.py build_cartography
+#
+# Sizes, and parse times, are compared with those of the original GeoJSON.
+
+import json
+import os
+import time
+import zlib
+
+from django.core.management.base import BaseCommand
+from project.settings import THEME_PATH
+
+from ...loaders.madrid_cartography import MadridCartography
+
+
+class Command(BaseCommand):
+    help = u"Genera la cartografía de distritos del mapa de inversiones principales"
+
+    def handle(self, *args, **options):
+        cartography = MadridCartography(THEME_PATH)
+        index = cartography.build()
+
+        self.stdout.write(u"%-36s %10s %10s %10s" % (u"Fichero", u"Tamaño", u"gzip", u"Lectura"))
+        self._print_file_stats(cartography.source_filename, lambda data: data)
+        for level in index['levels']:
+            self._print_file_stats(cartography.get_file_path(level['filename']), MadridCartography.to_geojson)
+
+    # Reading a TopoJSON file includes decoding it back into GeoJSON, as the map does
+    def _print_file_stats(self, file_path, decode):
+        with open(file_path, 'rb') as input_file:
+            content = input_file.read()
+
+        start_time = time.time()
+        decode(json.loads(content.decode('utf-8')))
+        parse_time = time.time() - start_time
+
+        self.stdout.write(u"%-36s %10d %10d %8.1fms" % (
+            os.path.basename(file_path),
+            len(content),
+            len(zlib.compress(content, 9)),
+            parse_time * 1000))
@@ -0,0 +1,32 @@
+# -*- coding: UTF-8 -*-
+
+# Build the bundles of the main investments map, from the main investments in the database.
+# They're built when loading the data, but this is handy after a deploy, or if they're
+# missing for some reason. See MadridMainInvestmentsBundle.
+#
+# Usage: python manage.py build_main_investments_bundles [--language=es,en]
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import translation
+from project.settings import THEME_PATH
+
+from budget_app.models import Entity
+
+from ...loaders.madrid_main_investments_bundle import MadridMainInvestmentsBundle
+
+
+class Command(BaseCommand):
+    help = u"Genera los ficheros de datos del mapa de inversiones principales"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--language', help=u"Idiomas, separados por comas. Por defecto, todos")
+
+    def handle(self, *args, **options):
+        languages = options['language'].split(',') if options['language'] else [code for code, _ in settings.LANGUAGES]
+        entity = Entity.objects.get(level=settings.MAIN_ENTITY_LEVEL, name=settings.MAIN_ENTITY_NAME)
+
+        for language in languages:
+            with translation.override(language):
+                index = MadridMainInvestmentsBundle(THEME_PATH, language).build(entity)
+            self.stdout.write(u"%s: %s" % (language, u", ".join(sorted(index.values()))))
@@ -0,0 +1,173 @@
+# -*- coding: UTF-8 -*-
+
+# Load the budget data for several years at once, e.g. when rebuilding the database.
+# Years are independent from each other, so data files are parsed in parallel, using
+# a pool of worker processes, and the results are then written to the database in order,
+# one year at a time.
+#
+# Usage: python manage.py load_budgets 2011 2025 --language=es,en --workers=4 [--force] [--timeout=600]
+#
+# Years whose data files haven't changed since the last successful load are skipped,
+# unless --force is given. See MadridLoadManifest. A year whose data files take longer
+# than the timeout to be parsed, once we start waiting for it, counts as failed.
+
+import multiprocessing
+import os
+import six
+import sys
+import time
+import traceback
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import translation
+from project.settings import THEME_PATH
+
+from budget_app.models import Entity
+
+from ...loaders import MadridBudgetLoader
+from ...loaders.madrid_load_manifest import MadridLoadManifest
+
+
+class Command(BaseCommand):
+    help = u"Carga los datos de presupuesto de un rango de años, leyendo los ficheros en paralelo"
+
+    def add_arguments(self, parser):
+        parser.add_argument('first_year', type=int)
+        parser.add_argument('last_year', type=int, nargs='?')
+        parser.add_argument('--language', default='es', help=u"Idiomas a cargar, separados por comas")
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help=u"Número de procesos")
+        parser.add_argument('--force', action='store_true', help=u"Cargar los datos aunque no hayan cambiado")
+        parser.add_argument('--timeout', type=int, default=600, help=u"Segundos de espera máxima por cada año")
+
+    def handle(self, *args, **options):
+        first_year = options['first_year']
+        last_year = options['last_year'] or first_year
+        languages = options['language'].split(',')
+        is_forced = options['force'] or MadridLoadManifest.is_forced()
+        entity = Entity.objects.get(level=settings.MAIN_ENTITY_LEVEL, name=settings.MAIN_ENTITY_NAME)
+        loader = MadridBudgetLoader()
+        filenames = loader._get_manifest_filenames()
+
+        # One task per year. All the languages of a year are parsed by the same worker, so
+        # byte-identical data files are parsed only once (see MadridDataFileCache).
+        # Fingerprints are kept to be recorded once the data is loaded.
+        tasks = []
+        fingerprints = {}
+        for year in range(first_year, last_year + 1):
+            paths = []
+            for language in languages:
+                path = get_data_path(language, year)
+                if not os.path.isdir(path):
+                    self.stdout.write(u"No hay datos para %s (%s), lo ignoramos." % (year, language))
+                    continue
+
+                fingerprint, files = MadridLoadManifest.get_fingerprint(loader, path, filenames)
+                if not is_forced and MadridLoadManifest(path).is_up_to_date(entity, year, 'budget', fingerprint):
+                    self.stdout.write(u"Los datos de %s (%s) no han cambiado desde la última carga, los ignoramos." % (year, language))
+                    continue
+
+                paths.append((language, path))
+                fingerprints[(year, language)] = (fingerprint, files)
+            if paths:
+                tasks.append((year, paths))
+
+        if not tasks:
+            return
+
+        # Worker processes are forked, so make sure they don't share our database connections
+        connections.close_all()
+        pool = multiprocessing.Pool(max(1, min(options['workers'], len(tasks))))
+        results = [pool.apply_async(parse_budget_data, task) for task in tasks]
+        pool.close()
+
+        # Write the results to the database in order, as they become available.
+        # A failure in a year doesn't stop the rest from being loaded.
+        failed_tasks = []
+        try:
+            for (year, paths), result in zip(tasks, results):
+                try:
+                    budget_items_by_language, output, error, parse_time = result.get(options['timeout'])
+                except multiprocessing.TimeoutError:
+                    self.stderr.write(u"Se ha agotado el tiempo de espera leyendo los datos de %s." % year)
+                    failed_tasks.append(year)
+                    continue
+                self.stdout.write(output)
+
+                if error:
+                    self.stderr.write(u"Error leyendo los datos de %s:\n%s" % (year, error))
+                    failed_tasks.append(year)
+                    continue
+
+                self.stdout.write(u"Leídos los datos de %s en %.1fs. Cargando..." % (year, parse_time))
+                start_time = time.time()
+                try:
+                    for language, path in paths:
+                        fingerprint, files = fingerprints[(year, language)]
+                        load_budget_items(entity, year, language, path, budget_items_by_language[language], fingerprint, files)
+                except Exception:
+                    self.stderr.write(u"Error cargando los datos de %s:\n%s" % (year, traceback.format_exc()))
+                    failed_tasks.append(year)
+                    continue
+                self.stdout.write(u"Cargado %s en %.1fs." % (year, time.time() - start_time))
+        finally:
+            pool.terminate()
+            pool.join()
+
+        if failed_tasks:
+            raise CommandError(u"No se han podido cargar: %s" % ", ".join(str(year) for year in failed_tasks))
+
+
+def get_data_path(language, year):
+    return os.path.join(THEME_PATH, 'data', language, settings.MAIN_ENTITY_LEVEL, str(year))
+
+
+def get_budget_status(path):
+    status_filename = os.path.join(path, '.budget_status')
+    if not os.path.isfile(status_filename):
+        return ''
+    with open(status_filename, 'r') as status_file:
+        return status_file.read().strip()
+
+
+# Runs in a worker process: parse the data files of a year, without touching the database.
+# The output is captured, so the logs of different years don't get mixed up.
+def parse_budget_data(year, paths):
+    start_time = time.time()
+    budget_items_by_language = {}
+    error = None
+
+    stdout = sys.stdout
+    sys.stdout = output = six.StringIO()
+    try:
+        for language, path in paths:
+            budget_items = []
+            MadridBudgetLoader().parse_budget_data(budget_items, path)
+            budget_items_by_language[language] = budget_items
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        sys.stdout = stdout
+
+    return (budget_items_by_language, output.getvalue(), error, time.time() - start_time)
+
+
+# Runs in the main process: write the already parsed items for a language, in its own
+# transaction. Descriptions of the classifications are read from the language folder.
+# The fingerprint and files are the ones worked out before parsing, see get_fingerprint.
+def load_budget_items(entity, year, language, path, budget_items, fingerprint, files):
+    loader = MadridBudgetLoader()
+    manifest = MadridLoadManifest(path)
+
+    # Keep our own copy of the items, in case the loader modifies them
+    items = [dict(item) for item in budget_items]
+
+    with translation.override(language), transaction.atomic():
+        loader.load_budget(path, entity, year, get_budget_status(path), budget_items)
+
+    manifest.record(year, 'budget', fingerprint, files, MadridLoadManifest.get_budget_id(entity, year),
+                    *MadridLoadManifest.get_totals(items))
+
+    # So next execution updates can be loaded as a delta
+    loader._get_execution_delta(manifest, year).save_snapshot(entity, year, items)
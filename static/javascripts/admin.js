@@ -82,3 +82,127 @@ function showError(command_name, command_response) {
 
   showResult(command_name, message);
 }
+
+// Long actions run as jobs on the server (see admin_jobs.py): the first response tells
+// where to poll the status of the job, showing its progress meanwhile, until it's finished.
+// Options are those of $.ajax, with success/error getting the final result of the job.
+var JOB_POLLING_INTERVAL = 2000;
+
+// The log of the job can also be followed as it's written, but each open stream holds a
+// web server worker, so only do it when the server has async workers. If the browser can't,
+// or the connection fails, we poll the status of the job instead.
+var JOB_LOG_STREAMING = false;
+
+// Lines of the log we show while following a job
+var JOB_LOG_LINES = 200;
+
+// Times in a row we tolerate not getting the job status, e.g. because of the firewall
+var JOB_POLLING_RETRIES = 5;
+
+function runJob(command_name, options) {
+  var onSuccess = options.success;
+  var onError = options.error;
+  var onComplete = options.complete || function () {};
+
+  $.ajax($.extend({}, options, {
+    success: function (response) {
+      if (response && response.job && JOB_LOG_STREAMING && window.EventSource) {
+        streamJob(command_name, response, onSuccess, onError, onComplete);
+      } else if (response && response.job) {
+        pollJob(command_name, response.url, onSuccess, onError, onComplete, 0);
+      } else {
+        onSuccess(response);
+        onComplete();
+      }
+    },
+    error: function (response) {
+      onError(response);
+      onComplete();
+    },
+    complete: null
+  }));
+}
+
+function streamJob(command_name, response, onSuccess, onError, onComplete) {
+  var source = new EventSource(response.log_url);
+  var lines = [];
+  var isFinished = false;
+
+  source.onmessage = function (e) {
+    lines = lines.concat(e.data.split('\n')).slice(-JOB_LOG_LINES);
+    showLog(command_name, lines.join('\n'));
+  };
+  source.addEventListener('finished', function (e) {
+    isFinished = true;
+    source.close();
+    finishJob(JSON.parse(e.data), onSuccess, onError, onComplete);
+  });
+
+  // The stream ends every now and then, and the browser reconnects by itself,
+  // but if it gives up, e.g. because of the firewall, we poll instead
+  source.onerror = function () {
+    if (source.readyState === EventSource.CLOSED && !isFinished) {
+      pollJob(command_name, response.url, onSuccess, onError, onComplete, 0);
+    }
+  };
+}
+
+function finishJob(job, onSuccess, onError, onComplete) {
+  if (job.http_status < 400) {
+    onSuccess(job.result);
+  } else {
+    onError({ responseJSON: job.result, responseText: job.log });
+  }
+  onComplete();
+}
+
+function pollJob(command_name, url, onSuccess, onError, onComplete, failures) {
+  function retry(response) {
+    if (failures >= JOB_POLLING_RETRIES) {
+      onError(response);
+      onComplete();
+    } else {
+      setTimeout(function () {
+        pollJob(command_name, url, onSuccess, onError, onComplete, failures + 1);
+      }, JOB_POLLING_INTERVAL);
+    }
+  }
+
+  $.ajax({
+    url: url,
+    cache: false,
+    success: function (job) {
+      if (typeof job !== 'object') {
+        retry({ responseText: job });
+      } else if (job.status === 'finished') {
+        finishJob(job, onSuccess, onError, onComplete);
+      } else {
+        showProgress(command_name, job);
+        setTimeout(function () {
+          pollJob(command_name, url, onSuccess, onError, onComplete, 0);
+        }, JOB_POLLING_INTERVAL);
+      }
+    },
+    error: retry
+  });
+}
+
+function showLog(command_name, log) {
+  var output = getOutput(command_name);
+
+  output.html('<pre>' + $('<span>').text(log).html() + '</pre>');
+  output.show();
+  output.parent().show();
+}
+
+function showProgress(command_name, job) {
+  var output = getOutput(command_name);
+  var stage = (job.status === 'queued' ? 'En espera' : (job.stage || job.action));
+
+  output.html(
+    '<p><b>' + $('<span>').text(stage).html() + '</b> (' + job.elapsed + ' s)</p>' +
+    (job.log ? '<pre>' + $('<span>').text(job.log).html() + '</pre>' : '')
+  );
+  output.show();
+  output.parent().show();
+}
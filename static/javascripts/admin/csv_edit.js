@@ -103,7 +103,7 @@ function renderTable(resource, config) {
     clearResult('load');
     showSpinner('load');
 
-    $.ajax({
+    runJob('load', {
       url: resource + '/load',
       success: onLoadSuccess,
       error: onLoadError,
@@ -8,7 +8,7 @@ $(document).ready(function () {
     clearResult('load');
     showSpinner('download');
 
-    $.ajax({
+    runJob('download', {
       url: "execution/retrieve",
       data: {
         month: $('#month').val(),
@@ -31,7 +31,7 @@ $(document).ready(function () {
     clearResult('load');
     showSpinner('download');
 
-    $.ajax({
+    runJob('download', {
       type: 'POST',
       url: `execution/retrieve_manual?month=${$('#month').val()}&year=${$('#year').val()}&scrap=false`,
       data: JSON.stringify({
@@ -56,7 +56,7 @@ $(document).ready(function () {
     clearResult('load');
     showSpinner('review');
 
-    $.ajax({
+    runJob('review', {
       url: "execution/review",
       contentType: 'application/json; charset=utf-8',
       success: onReviewSuccess,
@@ -72,7 +72,7 @@ $(document).ready(function () {
     clearResult('load');
     showSpinner('load');
 
-    $.ajax({
+    runJob('load', {
       url: "execution/load",
       contentType:    'application/json; charset=utf-8',
       success: onLoadSuccess,
@@ -8,7 +8,7 @@ $(document).ready(function () {
     clearResult('load');
     showSpinner('download');
 
-    $.ajax({
+    runJob('download', {
       url: "general/retrieve",
       data: {
         year:  $('#year').val()
@@ -28,7 +28,7 @@ $(document).ready(function () {
     clearResult('load');
     showSpinner('review');
 
-    $.ajax({
+    runJob('review', {
       url: "general/review",
       contentType: 'application/json; charset=utf-8',
       success: onReviewSuccess,
@@ -44,7 +44,7 @@ $(document).ready(function () {
     clearResult('load');
     showSpinner('load');
 
-    $.ajax({
+    runJob('load', {
       url: "general/load",
       contentType:    'application/json; charset=utf-8',
       success: onLoadSuccess,
@@ -8,7 +8,7 @@ $(document).ready(function () {
     clearResult('load');
     showSpinner('download');
 
-    $.ajax({
+    runJob('download', {
       url: "main-investments/retrieve",
       data: {
         year:  $('#year').val()
@@ -27,7 +27,7 @@ $(document).ready(function () {
     clearResult('load');
     showSpinner('load');
 
-    $.ajax({
+    runJob('load', {
       url: "main-investments/load",
       contentType:    'application/json; charset=utf-8',
       success: onLoadSuccess,
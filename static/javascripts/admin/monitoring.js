@@ -8,7 +8,7 @@ $(document).ready(function () {
     clearResult('load');
     showSpinner('download');
 
-    $.ajax({
+    runJob('download', {
       url: "monitoring/retrieve",
       data: {
         year:  $('#year').val(),
@@ -28,7 +28,7 @@ $(document).ready(function () {
     clearResult('load');
     showSpinner('load');
 
-    $.ajax({
+    runJob('load', {
       url: "monitoring/load",
       contentType:    'application/json; charset=utf-8',
       success: onLoadSuccess,
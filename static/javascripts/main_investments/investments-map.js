@@ -1,9 +1,15 @@
-// Note: the list of features MUST be sorted by year ascending for this to work.
-// We're stacking features points for a given project on top of each other, and we need
-// the most recent one to be on top. We could sort the data ourselves here, but
-// for now we ask the caller to ensure that.
+// An investment shows up once per year, so besides the list of records, data, we get
+// an index of the records of each project, projects, as built by MadridMainInvestmentsBundle:
+// the position in data of the record for each year, by project id and year. We stack the
+// points of a project on top of each other, and we need the most recent one to be on top.
 //
-function InvestmentsMap(_mapSelector, _legendSelector, data, _token) {
+// District shapes are loaded lazily from _cartographyUrl, which lists the levels of detail
+// available, as TopoJSON files, by zoom level. See MadridCartography.
+//
+// Text search uses a trigram index of the records, loaded from _searchUrl the first time
+// it's needed. See MadridMainInvestmentsSearch.
+//
+function InvestmentsMap(_mapSelector, _legendSelector, data, projects, _token, _cartographyUrl, _searchUrl) {
   mapboxgl.accessToken = _token;
   const map = new mapboxgl.Map({
     container: _mapSelector,
@@ -28,6 +34,15 @@ function InvestmentsMap(_mapSelector, _legendSelector, data, _token) {
   let selectedYear = 'all';
   let selectedSearchQuery = '';
 
+  let cartographyLevels = null;
+  let cartographyLevel = null;
+  const cartographyRequests = {};
+
+  // Ids of the features in the map, and of those matching the search query (or null, if none)
+  const investmentIds = [];
+  let searchIndexRequest = null;
+  let searchMatches = null;
+
   // Create map object
   this.setup = function () {
     const mapNode = document.querySelector(`#${_mapSelector}`);
@@ -56,15 +71,9 @@ function InvestmentsMap(_mapSelector, _legendSelector, data, _token) {
 
     // Try to update the tooltip, if stuck, if the selected investment exists across the years
     if (hoveredFeature !== null) {
-      const pinProject = function () {
-        return data.find(
-          (d) =>
-            d.year === (Array.isArray(selectedYear) ? selectedYear[1] : selectedYear) &&
-            d.project_id === hoveredFeature.properties.project_id
-        );
-      }
-
-      const obj = pinProject()
+      const years = projects[hoveredFeature.properties.project_id] || {};
+      const i = years[Array.isArray(selectedYear) ? selectedYear[1] : selectedYear];
+      const obj = (i !== undefined ? data[i] : null);
       if (obj) {
         const tooltip = document.querySelector('#tooltip');
         populateTooltip(tooltip, obj); // The investment exists across the years
@@ -74,6 +83,11 @@ function InvestmentsMap(_mapSelector, _legendSelector, data, _token) {
     }
   };
 
+  // Whether the record in the given position of data matches the search query
+  this.isSearchMatch = function (i) {
+    return searchMatches === null || searchMatches.has(i);
+  };
+
   // Return current applied filters
   this.getFilters = function () {
     return {
@@ -92,33 +106,43 @@ function InvestmentsMap(_mapSelector, _legendSelector, data, _token) {
       type: 'FeatureCollection',
       features: [],
     };
-    data.forEach((d, i) => {
+    Object.keys(projects).forEach((projectId) => {
+      // Oldest year first, so the most recent one ends up on top
+      const years = projects[projectId];
+      const positions = Object.keys(years).sort().map((year) => years[year]);
+
       // Keep track of completed investments, we'll need this for filtering later on.
       // Note that the same investment shows up in multiple years, first as 'in progress',
       // finally as 'completed'.
-      if (d.status === 'FINALIZADO') {
-        completedInvestments.push(d.project_id);
+      if (positions.some((i) => data[i].status === 'FINALIZADO')) {
+        completedInvestments.push(projectId);
       }
 
-      if (d.longitude !== '') {
-        investments.features.push({
-          type: 'Feature',
-          geometry: {
-            type: 'Point',
-            coordinates: [Number(d.longitude), Number(d.latitude)],
-          },
-          properties: d,
-          id: i,
-        });
-      }
+      positions.forEach((i) => {
+        const d = data[i];
+        if (d.longitude !== '') {
+          investmentIds.push(i);
+          investments.features.push({
+            type: 'Feature',
+            geometry: {
+              type: 'Point',
+              coordinates: [Number(d.longitude), Number(d.latitude)],
+            },
+            properties: d,
+            id: i,
+          });
+        }
+      });
     });
 
     // Create map SOURCES
-    // Districts polygons
+    // Districts polygons, empty until loaded
     map.addSource('areas', {
       type: 'geojson',
-      data: CARTOGRAPHY,
+      data: { type: 'FeatureCollection', features: [] },
     });
+    loadCartography();
+    map.on('zoomend', updateCartography);
     // Investments circles
     map.addSource('investments', {
       type: 'geojson',
@@ -204,6 +228,100 @@ function InvestmentsMap(_mapSelector, _legendSelector, data, _token) {
     });
   }
 
+  // The map is still usable without the districts, so if they can't be fetched we just go on
+  function loadCartography() {
+    fetchJSON(_cartographyUrl)
+      .then((index) => {
+        cartographyLevels = index.levels;
+        updateCartography();
+      })
+      .catch((error) => console.error('Could not load the districts', error));
+  }
+
+  // Show the level of detail for the current zoom, fetching it the first time
+  function updateCartography() {
+    if (cartographyLevels === null) {
+      return;
+    }
+
+    const zoom = map.getZoom();
+    const level = cartographyLevels.find((l) => l.max_zoom === null || zoom <= l.max_zoom);
+    if (level === cartographyLevel) {
+      return;
+    }
+    cartographyLevel = level;
+
+    if (!(level.url in cartographyRequests)) {
+      cartographyRequests[level.url] = fetchJSON(level.url)
+        .then((topology) => topologyToGeoJSON(topology, 'districts'));
+    }
+    cartographyRequests[level.url]
+      .then((districts) => {
+        // Zoom may have changed in the meantime
+        if (level === cartographyLevel) {
+          map.getSource('areas').setData(districts);
+        }
+      })
+      .catch((error) => {
+        // Try again on the next zoom change
+        delete cartographyRequests[level.url];
+        if (level === cartographyLevel) {
+          cartographyLevel = null;
+        }
+        console.error('Could not load the districts', error);
+      });
+  }
+
+  // Fetch rejects only on network errors, so reject on HTTP errors too
+  function fetchJSON(url) {
+    return fetch(url).then((response) => {
+      if (!response.ok) {
+        throw new Error(response.status + ' ' + response.statusText);
+      }
+      return response.json();
+    });
+  }
+
+  // Decode a TopoJSON object, quantized and delta-encoded, into a GeoJSON feature collection
+  function topologyToGeoJSON(topology, objectName) {
+    const [scaleX, scaleY] = topology.transform.scale;
+    const [translateX, translateY] = topology.transform.translate;
+
+    const arcs = topology.arcs.map((encodedArc) => {
+      let x = 0;
+      let y = 0;
+      return encodedArc.map(([dx, dy]) => {
+        x += dx;
+        y += dy;
+        return [x * scaleX + translateX, y * scaleY + translateY];
+      });
+    });
+
+    // Negative ids refer to arcs used backwards
+    function getRing(arcIds) {
+      const ring = [];
+      arcIds.forEach((arcId) => {
+        const arc = arcId >= 0 ? arcs[arcId] : arcs[~arcId].slice().reverse();
+        ring.push(...(ring.length > 0 ? arc.slice(1) : arc));
+      });
+      return ring;
+    }
+
+    return {
+      type: 'FeatureCollection',
+      features: topology.objects[objectName].geometries.map((geometry) => ({
+        type: 'Feature',
+        geometry: {
+          type: geometry.type,
+          coordinates: geometry.type === 'Polygon'
+            ? geometry.arcs.map(getRing)
+            : geometry.arcs.map((polygon) => polygon.map(getRing)),
+        },
+        properties: geometry.properties,
+      })),
+    };
+  }
+
   function populateTooltip(tooltip, obj) {
     function formatAmount(amount) {
       return Math.round(amount).toLocaleString('es-ES') + ' €';
@@ -534,18 +652,84 @@ function InvestmentsMap(_mapSelector, _legendSelector, data, _token) {
   // keep calling this all the time, and there was some race condition or something
   // generating some weird behaviour I couldn't fix easily.)
   function filterSearchResults(searchQuery) {
-    const sourceFeatures = map.querySourceFeatures('investments');
-    sourceFeatures.forEach((d) => {
-      let search =
-        normalizeString(d.properties.description).includes(searchQuery) ||
-        normalizeString(d.properties.area_name).includes(searchQuery);
-      map.setFeatureState(
-        { source: 'investments', id: d.id },
-        { search: search }
-      );
-    });
     selectedSearchQuery = searchQuery;
-    throwVisibleDataChangedEvent();
+    loadSearchIndex().then((searchIndex) => {
+      // The query may have changed while loading the index
+      if (searchQuery !== selectedSearchQuery) {
+        return;
+      }
+
+      const previousMatches = searchMatches;
+      searchMatches = (searchQuery !== '' ? search(searchIndex, searchQuery) : null);
+      investmentIds.forEach((id) => {
+        const search = (searchMatches === null || searchMatches.has(id));
+        if (search !== (previousMatches === null || previousMatches.has(id))) {
+          map.setFeatureState(
+            { source: 'investments', id: id },
+            { search: search }
+          );
+        }
+      });
+      throwVisibleDataChangedEvent();
+    });
+  }
+
+  function loadSearchIndex() {
+    if (searchIndexRequest === null) {
+      searchIndexRequest = fetch(_searchUrl)
+        .then((response) => response.json())
+        .then((searchIndex) => {
+          // Lists of ids come as the differences between consecutive ids
+          Object.values(searchIndex.trigrams).forEach((ids) => {
+            for (let i = 1; i < ids.length; i++) {
+              ids[i] += ids[i - 1];
+            }
+          });
+          return searchIndex;
+        });
+    }
+    return searchIndexRequest;
+  }
+
+  // Ids of the records matching the (normalized) query, as a set
+  function search(searchIndex, searchQuery) {
+    let candidates = null;
+    if (searchQuery.length >= 3) {
+      // Records with all the trigrams of the query, starting with the rarest ones
+      const trigrams = new Set();
+      for (let i = 0; i + 3 <= searchQuery.length; i++) {
+        trigrams.add(searchQuery.substring(i, i + 3));
+      }
+      const idLists = [...trigrams]
+        .map((trigram) => searchIndex.trigrams[trigram] || [])
+        .sort((a, b) => a.length - b.length);
+      candidates = idLists.reduce(intersectSortedLists);
+    } else {
+      candidates = data.map((d, i) => i);
+    }
+
+    // Having all the trigrams doesn't mean having all the query, so check the actual texts
+    return new Set(candidates.filter((i) =>
+      searchIndex.fields.some((field) => normalizeString(data[i][field]).includes(searchQuery))
+    ));
+  }
+
+  function intersectSortedLists(a, b) {
+    const intersection = [];
+    let i = 0;
+    let j = 0;
+    while (i < a.length && j < b.length) {
+      if (a[i] < b[j]) {
+        i++;
+      } else if (a[i] > b[j]) {
+        j++;
+      } else {
+        intersection.push(a[i]);
+        i++;
+        j++;
+      }
+    }
+    return intersection;
   }
 
   function setupInputText(mapNode) {
@@ -10,8 +10,16 @@ EXTRA_URLS = (
     url(r'^visita-guiada$', theme_views.guidedvisit, name='guidedvisit'),
     url(r'^inflacion\.(?P<format>.+)$', theme_views.inflation_stats, name='inflation_stats'),
     url(r'^poblacion\.(?P<format>.+)$', theme_views.population_stats, name='population_stats'),
+    url(r'^inversiones-principales/datos\.json$', theme_views.main_investments_data, name='main_investments_data'),
+    url(r'^inversiones-principales/datos-(?P<year>\d+)\.json$', theme_views.main_investments_data, name='main_investments_year_data'),
+    url(r'^inversiones-principales/busqueda\.json$', theme_views.main_investments_search, name='main_investments_search'),
+    url(r'^inversiones-principales/datos/(?P<filename>main_investments[\w.-]+\.json)$', theme_views.main_investments_bundle, name='main_investments_bundle'),
+    url(r'^inversiones-principales/distritos\.json$', theme_views.main_investments_cartography, name='main_investments_cartography'),
+    url(r'^inversiones-principales/distritos/(?P<filename>districts[\w.-]+\.json)$', theme_views.main_investments_cartography_file, name='main_investments_cartography_file'),
 
     url(r'^admin/?$', theme_views.admin, name='admin'),
+    url(r'^admin/jobs/(?P<job_id>[0-9a-f]{32})$', theme_views.admin_job, name='admin_job'),
+    url(r'^admin/jobs/(?P<job_id>[0-9a-f]{32})/log$', theme_views.admin_job_log, name='admin_job_log'),
 
     url(r'^admin/general$', theme_views.admin_general, name='admin_general'),
     url(r'^admin/general/retrieve$', theme_views.admin_general_retrieve),
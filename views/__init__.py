@@ -3,8 +3,12 @@ import six
 if six.PY2:
     from guidedvisit import guidedvisit
     from csv_xls import inflation_stats, population_stats
+    from main_investments import main_investments_data, main_investments_bundle, main_investments_search, \
+        main_investments_cartography, main_investments_cartography_file
     from admin import *
 else:
     from .guidedvisit import guidedvisit
     from .csv_xls import inflation_stats, population_stats
+    from .main_investments import main_investments_data, main_investments_bundle, main_investments_search, \
+        main_investments_cartography, main_investments_cartography_file
     from .admin import *
@@ -4,14 +4,22 @@
 # See https://github.com/civio/presupuesto-management/issues/1235#issuecomment-1614674582 for details.
 
 import urllib.parse
-from bs4 import BeautifulSoup
 from datetime import datetime
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import redirect, render
+from django.urls import reverse
 from django.utils.translation import ugettext as _
 from django.views.decorators.cache import never_cache
 from project.settings import ROOT_PATH, THEME_PATH, HTTPS_PROXY, HTTP_PROXY
 from budget_app.views.helpers import _set_meta_fields
+from decimal import Decimal
+from ..loaders.madrid_utils import MadridUtils
+from .admin_cache import HTTPCache
+from .admin_downloads import DownloadManager, DownloadError
+from .admin_files import FileBatch, FileOperationError
+from .admin_jobs import enqueue_job, get_job, set_job_stage, finish_job_stage, log_to_job, get_job_log, on_job_finished, \
+    stream_job_log
+from .admin_links import get_links, get_year_links
 from pprint import pprint
 import base64
 import cgi
@@ -24,12 +32,12 @@ import re
 import six
 import subprocess
 import urllib
-import chardet
 
 # urllib2 has changed significantly in Python 3
 if six.PY2:
-    from urllib2 import Request, urlopen
+    from urllib2 import HTTPError, Request, urlopen
 else:
+    from urllib.error import HTTPError
     from urllib.request import Request, urlopen
 
 DATA_BASE_URL = "https://datos.madrid.es"
@@ -60,6 +68,13 @@ PAYMENTS_URL = "https://datos.madrid.es/sites/v/index.jsp?vgnextoid=2fd903751cd5
 
 TEMP_BASE_PATH = "/tmp/budget_app"
 
+# Pages and files retrieved from the portal, to download them again only if they changed.
+# No dots in the name, so it's not taken for a temp folder (see _get_most_recent_temp_folder).
+HTTP_CACHE_PATH = os.path.join(TEMP_BASE_PATH, "http_cache")
+
+# Backups of the files changed when arranging data files, and how to undo the changes
+FILE_BACKUPS_PATH = os.path.join(TEMP_BASE_PATH, "file_backups")
+
 # Select the Python interpreter for external commands based on the version we're running
 
 if six.PY2:
@@ -102,18 +117,15 @@ def admin_general(request):
 @never_cache
 def admin_general_retrieve(request):
     year = _get_year(request.GET)
-    body, status = _retrieve_general(year)
-    return _json_response(body, status)
+    return _job_response(u"Descarga del presupuesto general", _retrieve_general, year)
 
 @never_cache
 def admin_general_review(request):
-    body, status = _review_general()
-    return _json_response(body, status)
+    return _job_response(u"Revisión del presupuesto general", _review_general)
 
 @never_cache
 def admin_general_load(request):
-    body, status = _load_general()
-    return _json_response(body, status)
+    return _job_response(u"Carga del presupuesto general", _load_general)
 
 
 # Execution
@@ -136,8 +148,7 @@ def admin_execution_retrieve(request):
     month = _get_month(request.GET)
     year = _get_year(request.GET)
     is_scrap = _get_is_scrap(request.GET)
-    body, status = _retrieve_execution(month, year)
-    return _json_response(body, status)
+    return _job_response(u"Descarga de la ejecución mensual", _retrieve_execution, month, year)
 
 @never_cache
 def admin_execution_retrieve_manual(request):
@@ -146,18 +157,15 @@ def admin_execution_retrieve_manual(request):
     is_scrap = _get_is_scrap(request.GET)
     files_json = json.loads(request.body)
     files_json = {k:v for k, v in files_json.items() if v} # clean empty values
-    body, status = _retrieve_execution_manual(month, year, files_json)
-    return _json_response(body, status)
+    return _job_response(u"Descarga de la ejecución mensual", _retrieve_execution_manual, month, year, files_json)
 
 @never_cache
 def admin_execution_review(request):
-    body, status = _review_execution()
-    return _json_response(body, status)
+    return _job_response(u"Revisión de la ejecución mensual", _review_execution)
 
 @never_cache
 def admin_execution_load(request):
-    body, status = _load_execution()
-    return _json_response(body, status)
+    return _job_response(u"Carga de la ejecución mensual", _load_execution)
 
 
 # Inflation
@@ -179,8 +187,7 @@ def admin_inflation_save(request):
 
 @never_cache
 def admin_inflation_load(request):
-    body, status = _load_stats()
-    return _json_response(body, status)
+    return _job_response(u"Carga de los datos estadísticos", _load_stats)
 
 
 # Population
@@ -202,8 +209,7 @@ def admin_population_save(request):
 
 @never_cache
 def admin_population_load(request):
-    body, status = _load_stats()
-    return _json_response(body, status)
+    return _job_response(u"Carga de los datos estadísticos", _load_stats)
 
 
 # Monitoring
@@ -225,13 +231,11 @@ def admin_monitoring(request):
 def admin_monitoring_retrieve(request):
     year = _get_year(request.GET)
     is_year_completed = request.GET.get("yearCompleted", "No")==u'Sí'
-    body, status = _retrieve_monitoring(year, is_year_completed)
-    return _json_response(body, status)
+    return _job_response(u"Descarga de objetivos", _retrieve_monitoring, year, is_year_completed)
 
 @never_cache
 def admin_monitoring_load(request):
-    body, status = _load_monitoring()
-    return _json_response(body, status)
+    return _job_response(u"Carga de objetivos", _load_monitoring)
 
 
 # Main investments
@@ -252,13 +256,11 @@ def admin_main_investments(request):
 @never_cache
 def admin_main_investments_retrieve(request):
     year = _get_year(request.GET)
-    body, status = _retrieve_main_investments(year)
-    return _json_response(body, status)
+    return _job_response(u"Descarga de inversiones principales", _retrieve_main_investments, year)
 
 @never_cache
 def admin_main_investments_load(request):
-    body, status = _load_main_investments()
-    return _json_response(body, status)
+    return _job_response(u"Carga de inversiones principales", _load_main_investments)
 
 
 # Third party payments
@@ -279,18 +281,15 @@ def admin_payments(request):
 @never_cache
 def admin_payments_retrieve(request):
     year = _get_year(request.GET)
-    body, status = _retrieve_payments(year)
-    return _json_response(body, status)
+    return _job_response(u"Descarga de pagos a terceros", _retrieve_payments, year)
 
 @never_cache
 def admin_payments_review(request):
-    body, status = _review_payments()
-    return _json_response(body, status)
+    return _job_response(u"Revisión de pagos a terceros", _review_payments)
 
 @never_cache
 def admin_payments_load(request):
-    body, status = _load_payments()
-    return _json_response(body, status)
+    return _job_response(u"Carga de pagos a terceros", _load_payments)
 
 
 # Glossary
@@ -316,8 +315,7 @@ def admin_glossary_es_save(request):
 
 @never_cache
 def admin_glossary_es_load(request):
-    body, status = _load_glossary_es()
-    return _json_response(body, status)
+    return _job_response(u"Carga del glosario en español", _load_glossary_es)
 
 @never_cache
 def admin_glossary_en(request):
@@ -337,8 +335,30 @@ def admin_glossary_en_save(request):
 
 @never_cache
 def admin_glossary_en_load(request):
-    body, status = _load_glossary_en()
-    return _json_response(body, status)
+    return _job_response(u"Carga del glosario en inglés", _load_glossary_en)
+
+
+# Jobs
+@never_cache
+def admin_job(request, job_id):
+    job = get_job(job_id)
+    if job is None:
+        return _json_response({"result": "error", "message": "<p>No existe la tarea.</p>"}, 404)
+    return _json_response(job)
+
+# The log of a job, as it's written, as server-sent events. When reconnecting, browsers
+# tell the id of the last event they got, which is where the log has to carry on from.
+@never_cache
+def admin_job_log(request, job_id):
+    if get_job(job_id, with_log=False) is None:
+        return _json_response({"result": "error", "message": "<p>No existe la tarea.</p>"}, 404)
+
+    last_event_id = request.META.get("HTTP_LAST_EVENT_ID", "")
+    offset = int(last_event_id) if last_event_id.isdigit() else 0
+
+    response = StreamingHttpResponse(stream_job_log(job_id, offset), content_type="text/event-stream")
+    response["X-Accel-Buffering"] = "no"  # Don't let nginx hold the events
+    return response
 
 
 # Actions
@@ -417,7 +437,8 @@ def _load_execution():
         "load_main_investments %s --language=es,en" % year,
         "load_monitoring %s --language=es,en" % year,
     )
-    return _execute_loading_task(cue, *management_commands)
+    # Monthly updates change only part of the data, so load just the differences
+    return _execute_loading_task(cue, *management_commands, MADRID_DELTA_LOAD="1")
 
 
 def _retrieve_monitoring(year, is_year_completed):
@@ -620,9 +641,11 @@ def _scrape_general(url, year):
         temp_folder_path = _create_temp_folder()
 
         # We assume a constant page layout: ingresos, gastos, inversiones
-        _download(files[0], temp_folder_path, "ingresos.csv")
-        _download(files[1], temp_folder_path, "gastos.csv")
-        _download(files[2], temp_folder_path, "inversiones.csv")
+        changes = _download_all(temp_folder_path, [
+            (files[0], "ingresos.csv"),
+            (files[1], "gastos.csv"),
+            (files[2], "inversiones.csv"),
+        ])
 
         _write_temp(temp_folder_path, ".budget_year", year)
         _write_temp(temp_folder_path, ".budget_type", "general")
@@ -637,8 +660,8 @@ def _scrape_general(url, year):
             "<p>Puedes ver la página desde la que hemos hecho la descarga <a href='%s' target='_blank'>aquí</a>, "
             "y para tu referencia los ficheros han sido almacenados en <b>%s</b>.</p>"
             % (url, temp_folder_path)
-        )
-        body = {"result": "success", "message": message}
+        ) + _get_changes_message(changes)
+        body = {"result": "success", "message": message, "changed_files": _get_changed_files(changes)}
         status = 200
     except AdminException as error:
         message = (
@@ -691,11 +714,13 @@ def _scrape_execution(url, month, year, files_json={}):
         temp_folder_path = _create_temp_folder()
 
         # We assume a constant page layout: ingresos, gastos, inversiones
-        _download(files[0], temp_folder_path, "ingresos.csv")
-        _download(files[1], temp_folder_path, "gastos.csv")
-        _download(files[2], temp_folder_path, "inversiones.csv")
-        _download(files[3], temp_folder_path, "ingresos_eliminaciones_bruto.csv")
-        _download(files[4], temp_folder_path, "gastos_eliminaciones_bruto.csv")
+        changes = _download_all(temp_folder_path, [
+            (files[0], "ingresos.csv"),
+            (files[1], "gastos.csv"),
+            (files[2], "inversiones.csv"),
+            (files[3], "ingresos_eliminaciones_bruto.csv"),
+            (files[4], "gastos_eliminaciones_bruto.csv"),
+        ])
 
         _write_temp(temp_folder_path, ".budget_month", month)
         _write_temp(temp_folder_path, ".budget_year", year)
@@ -726,8 +751,8 @@ def _scrape_execution(url, month, year, files_json={}):
             "<p>Puedes ver la página desde la que hemos hecho la descarga <a href='%s' target='_blank'>aquí</a>, "
             "y para tu referencia los ficheros han sido almacenados en <b>%s</b>.</p>"
             % (url, temp_folder_path)
-        )
-        body = {"result": "success", "message": message}
+        ) + _get_changes_message(changes)
+        body = {"result": "success", "message": message, "changed_files": _get_changed_files(changes)}
         status = 200
     except AdminException as error:
         message = (
@@ -759,8 +784,10 @@ def _scrape_monitoring(url, year, is_year_completed):
         temp_folder_path = _create_temp_folder()
 
         # We assume a constant page layout
-        _download(files[0], temp_folder_path, "objetivos_e_indicadores.csv")
-        _download(files[1], temp_folder_path, "objetivos_y_actividades.csv")
+        changes = _download_all(temp_folder_path, [
+            (files[0], "objetivos_e_indicadores.csv"),
+            (files[1], "objetivos_y_actividades.csv"),
+        ])
 
         # Based on the two denormalized source files, create three nicer normalized final ones
         _csv_cut_columns(temp_folder_path,
@@ -790,8 +817,8 @@ def _scrape_monitoring(url, year, is_year_completed):
             "<p>Puedes ver la página desde la que hemos hecho la descarga <a href='%s' target='_blank'>aquí</a>, "
             "y para tu referencia los ficheros han sido almacenados en <b>%s</b>.</p>"
             % (url, temp_folder_path)
-        )
-        body = {"result": "success", "message": message}
+        ) + _get_changes_message(changes)
+        body = {"result": "success", "message": message, "changed_files": _get_changed_files(changes)}
         status = 200
     except AdminException as error:
         message = (
@@ -823,7 +850,9 @@ def _scrape_main_investments(url, year):
         temp_folder_path = _create_temp_folder()
 
         # We assume a constant page layout
-        _download(files[0], temp_folder_path, "inversiones_principales.csv")
+        changes = _download_all(temp_folder_path, [
+            (files[0], "inversiones_principales.csv"),
+        ])
 
         _write_temp(temp_folder_path, ".budget_year", year)
 
@@ -832,8 +861,8 @@ def _scrape_main_investments(url, year):
             "<p>Puedes ver la página desde la que hemos hecho la descarga <a href='%s' target='_blank'>aquí</a>, "
             "y para tu referencia los ficheros han sido almacenados en <b>%s</b>.</p>"
             % (url, temp_folder_path)
-        )
-        body = {"result": "success", "message": message}
+        ) + _get_changes_message(changes)
+        body = {"result": "success", "message": message, "changed_files": _get_changed_files(changes)}
         status = 200
     except AdminException as error:
         message = (
@@ -865,8 +894,10 @@ def _scrape_payments(url, year):
         temp_folder_path = _create_temp_folder()
 
         # We assume a constant page layout: areas y distritos, organismos autónomos
-        _download(files[0], temp_folder_path, "areas_y_distritos.csv")
-        _download(files[1], temp_folder_path, "organismos.csv")
+        changes = _download_all(temp_folder_path, [
+            (files[0], "areas_y_distritos.csv"),
+            (files[1], "organismos.csv"),
+        ])
 
         _write_temp(temp_folder_path, ".budget_year", year)
 
@@ -875,8 +906,8 @@ def _scrape_payments(url, year):
             "<p>Puedes ver la página desde la que hemos hecho la descarga <a href='%s' target='_blank'>aquí</a>, "
             "y para tu referencia los ficheros han sido almacenados en <b>%s</b>.</p>"
             % (url, temp_folder_path)
-        )
-        body = {"result": "success", "message": message}
+        ) + _get_changes_message(changes)
+        body = {"result": "success", "message": message, "changed_files": _get_changed_files(changes)}
         status = 200
     except AdminException as error:
         message = (
@@ -902,7 +933,9 @@ def _review(data_files_path):
     cmd += "cd %s && " % script_path
     cmd += "%s madrid_check_datafiles.py %s" % (PYTHON, data_files_path)
 
+    set_job_stage("madrid_check_datafiles.py")
     output, error = _execute_cmd(cmd)
+    finish_job_stage(error)
 
     if error:
         message = (
@@ -981,14 +1014,14 @@ def _review_payments_data(data_files_path):
                     key = tuple(columns_to_write[:-1])
                     amount = _parse_spanish_number(columns_to_write[-1])
 
-                    payments[key] = payments.get(key, 0.0) + amount
+                    payments[key] = payments.get(key, 0) + amount
 
         with open(target_filename, write_mode, **write_params) as target:
             writer = csv.writer(target, delimiter=',')
 
             for key, amount in payments.items():
                 row_data = list(key)
-                row_data.append(amount)
+                row_data.append(_format_cents(amount))
                 writer.writerow(row_data)
 
         with open(target_filename, read_mode, **read_params) as target:
@@ -996,14 +1029,14 @@ def _review_payments_data(data_files_path):
 
             for index, line in enumerate(reader):
                 number_of_payments += 1
-                amount_of_payments += float(line[6])
+                amount_of_payments += MadridUtils.parse_amount(line[6], False)
 
     except Exception as error:
         error = str(error)
 
     output = "Hay %s pagos que suman un total de %s euros en %s" % (
         _format_number_as_spanish(number_of_payments),
-        _format_number_as_spanish(amount_of_payments),
+        _format_number_as_spanish(amount_of_payments / 100.0),
         year
     )
 
@@ -1061,18 +1094,27 @@ def _save(target_path, filename, content, commit_message):
     return (body, status)
 
 
-def _execute_loading_task(cue, *management_commands):
+def _execute_loading_task(cue, *management_commands, **environment):
     # IO encoding is a nightmare. See https://stackoverflow.com/a/4027726
-    cmd = (
+    setup_cmd = (
         "export PYTHONIOENCODING=utf-8 "
         "&& cd %s "
         "&& . %s/bin/activate "
     )% (ROOT_PATH, PYTHON_VENV)
 
+    # Commands are run one at a time, so we can tell which one is running, stopping at
+    # the first one that fails, as if they were chained with &&
+    cmd = setup_cmd
+    output = ""
+    error = False
     for management_command in management_commands:
-        cmd += "&& %s manage.py %s " % (PYTHON, management_command)
-
-    output, error = _execute_cmd(cmd)
+        management_cmd = "&& %s manage.py %s " % (PYTHON, management_command)
+        cmd += management_cmd
+        if not error:
+            set_job_stage(management_command)
+            management_output, error = _execute_cmd(setup_cmd + management_cmd, environment)
+            finish_job_stage(error)
+            output += management_output
 
     if error:
         message = (
@@ -1083,8 +1125,8 @@ def _execute_loading_task(cue, *management_commands):
         status = 500
         return (body, status)
 
-    # Touch project/wsgi.py so the app restarts
-    _touch(os.path.join(ROOT_PATH, "project", "wsgi.py"))
+    # Touch project/wsgi.py so the app restarts, once the job is done
+    on_job_finished(_touch, os.path.join(ROOT_PATH, "project", "wsgi.py"))
 
     message = (
         u"<p>%s.</p>"
@@ -1104,20 +1146,22 @@ def _arrange_general(data_files_path):
     # Copy files around
     try:
         _reset_git_status()
+        batch = _create_file_batch()
         for language in ["es", "en"]:
             target_path = os.path.join(THEME_PATH, "data", language, "municipio", year)
 
             source = data_files_path
             destination = target_path
 
-            _copy(source, destination, ".budget_status")
-            _copy(source, destination, "gastos.csv")
-            _copy(source, destination, "ingresos.csv")
-            _copy(source, destination, "inversiones.csv")
+            batch.copy(source, destination, ".budget_status")
+            batch.copy(source, destination, "gastos.csv")
+            batch.copy(source, destination, "ingresos.csv")
+            batch.copy(source, destination, "inversiones.csv")
 
-            _remove(destination, "ejecucion_gastos.csv")
-            _remove(destination, "ejecucion_ingresos.csv")
-            _remove(destination, "ejecucion_inversiones.csv")
+            batch.remove(destination, "ejecucion_gastos.csv")
+            batch.remove(destination, "ejecucion_ingresos.csv")
+            batch.remove(destination, "ejecucion_inversiones.csv")
+        _apply_file_batch(batch)
 
         data_path = os.path.join(THEME_PATH, "data")
         _commit(data_path, "Add %s budget data" % year)
@@ -1136,23 +1180,25 @@ def _arrange_execution(data_files_path):
     # Copy files around
     try:
         _reset_git_status()
+        batch = _create_file_batch()
         for language in ["es", "en"]:
             target_path = os.path.join(THEME_PATH, "data", language, "municipio", year)
 
             source = data_files_path
             destination = target_path
 
-            _copy(source, destination, ".budget_status")
-            _copy(source, destination, "gastos.csv")
-            _copy(source, destination, "gastos_eliminaciones.csv")
-            _copy(source, destination, "gastos.csv", "ejecucion_gastos.csv")
-            _copy(source, destination, "gastos_eliminaciones.csv", "ejecucion_gastos_eliminaciones.csv")
-            _copy(source, destination, "ingresos.csv")
-            _copy(source, destination, "ingresos_eliminaciones.csv")
-            _copy(source, destination, "ingresos.csv", "ejecucion_ingresos.csv")
-            _copy(source, destination, "ingresos_eliminaciones.csv", "ejecucion_ingresos_eliminaciones.csv")
-            _copy(source, destination, "inversiones.csv")
-            _copy(source, destination, "inversiones.csv", "ejecucion_inversiones.csv")
+            batch.copy(source, destination, ".budget_status")
+            batch.copy(source, destination, "gastos.csv")
+            batch.copy(source, destination, "gastos_eliminaciones.csv")
+            batch.copy(source, destination, "gastos.csv", "ejecucion_gastos.csv")
+            batch.copy(source, destination, "gastos_eliminaciones.csv", "ejecucion_gastos_eliminaciones.csv")
+            batch.copy(source, destination, "ingresos.csv")
+            batch.copy(source, destination, "ingresos_eliminaciones.csv")
+            batch.copy(source, destination, "ingresos.csv", "ejecucion_ingresos.csv")
+            batch.copy(source, destination, "ingresos_eliminaciones.csv", "ejecucion_ingresos_eliminaciones.csv")
+            batch.copy(source, destination, "inversiones.csv")
+            batch.copy(source, destination, "inversiones.csv", "ejecucion_inversiones.csv")
+        _apply_file_batch(batch)
 
         data_path = os.path.join(THEME_PATH, "data")
         _commit(data_path, "Update %s execution data" % year)
@@ -1171,6 +1217,7 @@ def _arrange_monitoring(data_files_path):
     # Copy files around
     try:
         _reset_git_status()
+        batch = _create_file_batch()
         for language in ["es", "en"]:
             target_path = os.path.join(THEME_PATH, "data", language, "municipio", year)
 
@@ -1179,9 +1226,10 @@ def _arrange_monitoring(data_files_path):
 
             action = "Update" if _exists_temp(destination, "objetivos.csv") else action
 
-            _copy(source, destination, "objetivos.csv")
-            _copy(source, destination, "actividades.csv")
-            _copy(source, destination, "indicadores.csv")
+            batch.copy(source, destination, "objetivos.csv")
+            batch.copy(source, destination, "actividades.csv")
+            batch.copy(source, destination, "indicadores.csv")
+        _apply_file_batch(batch)
 
         data_path = os.path.join(THEME_PATH, "data")
         _commit(data_path, "%s %s monitoring data" % (action, year))
@@ -1200,6 +1248,7 @@ def _arrange_main_investments(data_files_path):
     # Copy files around
     try:
         _reset_git_status()
+        batch = _create_file_batch()
         for language in ["es", "en"]:
             target_path = os.path.join(THEME_PATH, "data", language, "municipio", year)
 
@@ -1208,7 +1257,8 @@ def _arrange_main_investments(data_files_path):
 
             action = "Update" if _exists_temp(destination, "inversiones_principales.csv") else action
 
-            _copy(source, destination, "inversiones_principales.csv")
+            batch.copy(source, destination, "inversiones_principales.csv")
+        _apply_file_batch(batch)
 
         data_path = os.path.join(THEME_PATH, "data")
         _commit(data_path, "%s %s main investments data" % (action, year))
@@ -1228,6 +1278,7 @@ def _arrange_payments(data_files_path):
     # Copy files around
     try:
         _reset_git_status()
+        batch = _create_file_batch()
         for language in ["es", "en"]:
             target_path = os.path.join(THEME_PATH, "data", language, "municipio", year)
 
@@ -1236,7 +1287,8 @@ def _arrange_payments(data_files_path):
 
             action = "Update" if _exists_temp(destination, "pagos.csv") else action
 
-            _copy(source, destination, "pagos.csv")
+            batch.copy(source, destination, "pagos.csv")
+        _apply_file_batch(batch)
 
         data_path = os.path.join(THEME_PATH, "data")
         _commit(data_path, "%s %s payments data" % (action, year))
@@ -1249,15 +1301,29 @@ def _arrange_payments(data_files_path):
 
 # Network helpers
 def _fetch(url):
+    cache = _get_http_cache()
     response = None
     try:
-        request = Request(url, headers={'User-Agent': 'Mozilla'})
-        response = urlopen(request)
+        headers = dict(cache.get_conditional_headers(url), **{'User-Agent': 'Mozilla'})
+        request = Request(url, headers=headers)
+        try:
+            response = urlopen(request)
+            content = response.read()
+            cache.store_content(url, content, {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            })
+        except HTTPError as error:
+            # Not modified since the last time
+            if error.code != 304:
+                raise
+            content = cache.read(url)
+
         # Convert to string based on Python version
         if six.PY2:
-            page = response.read()
+            page = content
         else:
-            page = response.read().decode('utf-8', errors='replace')
+            page = content.decode('utf-8', errors='replace')
             print("retrieved HTTP page 2025 ...")
             print(page[:500])
             print(f"'page' is {str(type(page))}")
@@ -1270,50 +1336,49 @@ def _fetch(url):
     return page
 
 
-def _download(url, temp_folder_path, filename):
+# Download the given (url, filename) pairs into the temp folder, all at once, each with
+# its metadata file. See DownloadManager. Returns whether each file changed since the
+# last time it was downloaded, as (filename, changed) pairs.
+def _download_all(temp_folder_path, downloads):
+    set_job_stage(u"Descargando %s" % ", ".join(filename for _, filename in downloads))
     try:
-        response_rb = None
-        response    = urlopen(Request(url, headers={'User-Agent': 'Mozilla'}))
+        results = DownloadManager(log=get_job_log(), cache=_get_http_cache()).download([
+            (url, os.path.join(temp_folder_path, filename)) for url, filename in downloads
+        ])
+    except DownloadError as error:
+        raise AdminException(str(error))
 
-        # In the old Python 2 code we used the same method to create a temporary file
-        # with some minor content (text) and to save a downloaded file. Not anymore.
-        if six.PY2:
-            _write_temp(temp_folder_path, filename, response.read(), 'iso-8859-1')
-        else:
-            # Con python3.6 no se puede usar la libreria chardet. Hay que detectar los 
-            # encodings a mano
-            response_rb  = response.read()
-            enc = chardet.detect(response_rb)
-            enc = enc["encoding"]
-            print(f"File {filename} has encoding: {enc}")
-            _            = response_rb.decode('utf-8') # Si es iso-8859-1 UnicodeError
-            if response_rb[:3] == b'\xef\xbb\xbf':  # Caso de utf-8 con BOM
-                response_rb = response_rb[3:]
-    except UnicodeDecodeError: # Encoding no es utf-8, probable iso-8859-1
-        if response_rb is not None:
-            response_r  = response_rb.decode('iso-8859-1')
-            response_rb = response_r.encode('iso-8859-1')
-        else:
-            pass
-    except IOError as error:
-        raise AdminException(
-            "File at '%s' couldn't be downloaded: %s" % (url, str(error))
+    # The encoding of each file is in the job log, and in its metadata (see admin_downloads.py)
+    return [
+        (filename, results[os.path.join(temp_folder_path, filename)]['changed'])
+        for _, filename in downloads
+    ]
+
+
+def _get_http_cache():
+    return HTTPCache(HTTP_CACHE_PATH)
+
+
+def _get_changed_files(changes):
+    return [filename for filename, changed in changes if changed]
+
+
+# Tell the admin whether it's worth reviewing and loading the downloaded files
+def _get_changes_message(changes):
+    changed_files = _get_changed_files(changes)
+    if not changed_files:
+        return (
+            "<p>Ningún fichero ha cambiado desde la última descarga, "
+            "así que no hace falta revisar ni cargar los datos de nuevo.</p>"
         )
-    except Exception:
-        if response_rb is not None:
-            enc = chardet.detect(response_rb)
-            enc = enc["encoding"]
-            print(f"Exceptional --> file {filename} has encoding: {enc}")
-            response_r  = response_rb.decode(enc)
-            response_rb = response_r.encode(enc)
-            print(f"{filename} decoded properly!")
- 
-    finally:
-        if response_rb is not None:
-            with open(os.path.join(temp_folder_path, filename), "wb") as f:
-                f.write(response_rb)
-            response.close()
-            
+    if len(changed_files) == len(changes):
+        return "<p>Todos los ficheros son nuevos o han cambiado desde la última descarga.</p>"
+    return (
+        "<p>Han cambiado desde la última descarga: <b>%s</b>. El resto de ficheros siguen igual.</p>"
+        % ", ".join(changed_files)
+    )
+
+
 # Filesystem helpers
 def _create_temp_folder():
     base_path = TEMP_BASE_PATH
@@ -1374,18 +1439,6 @@ def _write(target_path, filename, content):
     _copy(temp_folder_path, os.path.join(THEME_PATH, target_path), filename)
 
 
-def _remove(folder_path, filename):
-    target = os.path.join(folder_path, filename)
-
-    # The scripts/rm executable must be manually deployed and setuid'ed
-    cmd = ("cd %s " "&& scripts/rm -f %s") % (THEME_PATH, target)
-
-    output, error = _execute_cmd(cmd)
-
-    if error:
-        raise AdminException("File %s couldn't be removed: %s\n\n%s" % (target, error, output))
-
-
 def _copy(source_path, destination_path, source_filename, destination_filename=None):
     if not destination_filename:
         destination_filename = source_filename
@@ -1405,6 +1458,19 @@ def _copy(source_path, destination_path, source_filename, destination_filename=N
         raise AdminException("File %s couldn't be copied: %s\n\n%s" % (source_filename, error, output))
 
 
+# Copies, renames and removals of theme files, all at once. See admin_files.py
+def _create_file_batch():
+    return FileBatch(THEME_PATH, _execute_cmd, FILE_BACKUPS_PATH, log=log_to_job)
+
+
+# Returns the batch that undoes the changes
+def _apply_file_batch(batch):
+    try:
+        return batch.apply()
+    except FileOperationError as error:
+        raise AdminException(str(error))
+
+
 # Git helpers
 # The scripts/git and scripts/git-* executables must be manually deployed and setuid'ed
 def _reset_git_status():
@@ -1469,8 +1535,13 @@ def _format_number_as_spanish(number):
 
 
 def _parse_spanish_number(number):
-    # Read number in Spanish format (123.456,78), and return it as English format
-    return float(number.strip().replace('.', '').replace(',', '.'))
+    # Read number in Spanish format (123.456,78), and return it as number of cents
+    return MadridUtils.parse_amount(number)
+
+
+def _format_cents(cents):
+    # Write a number of cents in English format (123456.78), as expected by the payments loader
+    return str(Decimal(cents) / 100)
 
 
 def _get_content(params):
@@ -1511,25 +1582,15 @@ def _get_payments_url(year):
     return PAYMENTS_URL
 
 
-def _parse_HTML_file(page):
-    # There's a weird line that's breaking BeautifulSoup in the PRE/PROD environment,
-    # but not in development. Is it the Python version? See civio/presupuesto-management#1234
-    # Deleting it is a hacky way of getting rid of the issue, but the best I could find.
-    page = re.sub("!function\(t,e\).*", "", page)
-    page = re.sub("window.NREUM.*", "", page)
-    return BeautifulSoup(page, "html.parser")
-
+# See admin_links.py
 def _get_files(page):
-    doc = _parse_HTML_file(page)
-    links = doc.find_all("a", class_="ico-csv")
-    return [DATA_BASE_URL + link["href"] for link in links]
+    return [DATA_BASE_URL + link for link in get_links(page)]
 
 def _get_files_historical(page, year):
-    doc = _parse_HTML_file(page)
-    # doc is BeautifulSoup(page, "html.parser")
-    year_block = doc.find("p", class_="info-title", text=re.compile(year)).parent.findNext("ul")
-    links = year_block.find_all("a", class_="ico-csv")
-    return [DATA_BASE_URL + link["href"] for link in links]
+    links = get_year_links(page, year)
+    if links is None:
+        raise AdminException("No files found for year %s in the page" % year)
+    return [DATA_BASE_URL + link for link in links]
 
 
 def _get_most_recent_temp_folder():
@@ -1543,12 +1604,18 @@ def _get_most_recent_temp_folder():
     return temp_folder
 
 
-def _execute_cmd(cmd):
+# The given environment variables, if any, are added to the ones of the command
+def _execute_cmd(cmd, environment=None):
     # IO encoding is a nightmare. See https://stackoverflow.com/a/4027726
     env = os.environ.copy()
+    env.update(environment or {})
     env['LANG'] = 'en_US.UTF-8'
     env['LC_ALL'] = 'en_US.UTF-8'
 
+    # Python buffers its output when not writing to a terminal, so it'd show up in the log
+    # of the job only at the end
+    env['PYTHONUNBUFFERED'] = '1'
+
     if HTTP_PROXY:
         env["http_proxy"] = HTTP_PROXY
 
@@ -1565,9 +1632,14 @@ def _execute_cmd(cmd):
         encoding="utf-8"
     )
 
-    output, _ = process.communicate()
-    if six.PY2:
-        output = output.decode("utf8", "backslashreplace")
+    # Read the output as it comes, so it shows up in the log of the job, if any
+    output = ""
+    for line in iter(process.stdout.readline, ""):
+        if six.PY2:
+            line = line.decode("utf8", "backslashreplace")
+        output += line
+        log_to_job(line)
+    process.wait()
 
     return_code = process.poll()
     error = return_code != 0
@@ -1579,6 +1651,17 @@ def _html_response(request, template_name, c):
     _set_meta_fields(c)
     return render(request, template_name, c)
 
+# Run an action as a job, see admin_jobs.py, returning its id, status URL and log stream URL
+def _job_response(action, function, *args):
+    job_id = enqueue_job(action, function, *args)
+    body = {
+        "result": "queued",
+        "job": job_id,
+        "url": reverse("admin_job", args=[job_id]),
+        "log_url": reverse("admin_job_log", args=[job_id]),
+    }
+    return _json_response(body, 202)
+
 def _json_response(data, status=200):
     return HttpResponse(
         json.dumps(data), content_type="application/json; charset=utf-8", status=status
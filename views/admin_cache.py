@@ -0,0 +1,119 @@
+# -*- coding: UTF-8 -*-
+
+# Local HTTP cache of the pages and data files retrieved from the open data portal, which
+# are often the same as the last time. For each URL we keep the validators given by the
+# server (ETag, Last-Modified), to ask for the file only if it has changed (conditional
+# GET), and the hash of its content, to tell whether it actually changed when the server
+# sends it anyway.
+#
+# Contents are kept by hash (objects/<sha256>), so the same file under different URLs,
+# or in different retrievals, is stored once. Entries (entries/<sha1 of the url>.json)
+# point each URL to its current content.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+
+class HTTPCache(object):
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.entries_path = os.path.join(path, "entries")
+        self.objects_path = os.path.join(path, "objects")
+        for folder_path in (self.entries_path, self.objects_path):
+            if not os.path.exists(folder_path):
+                os.makedirs(folder_path)
+
+    # The headers to ask for the given URL only if it has changed, if we have it
+    def get_conditional_headers(self, url):
+        entry = self._get_entry(url)
+        if entry is None:
+            return {}
+
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    # The metadata of the given URL, with its content copied to the given path, after
+    # the server said it hasn't changed (304)
+    def restore(self, url, file_path):
+        entry = self._get_entry(url)
+        shutil.copyfile(self._get_object_path(entry["sha256"]), file_path)
+        return dict(entry["metadata"])
+
+    # The cached content of the given URL, after the server said it hasn't changed (304)
+    def read(self, url):
+        entry = self._get_entry(url)
+        with open(self._get_object_path(entry["sha256"]), "rb") as object_file:
+            return object_file.read()
+
+    # Keep the downloaded file of the given URL. The metadata must include its sha256,
+    # and the etag and last_modified given by the server, if any. Returns whether the
+    # content changed since the last time.
+    def store(self, url, file_path, metadata):
+        object_path = self._get_object_path(metadata["sha256"])
+        if not os.path.exists(object_path):
+            self._write_file(object_path, lambda object_file: self._copy_file(file_path, object_file))
+        return self._set_entry(url, metadata)
+
+    # Same as store, for content we have in memory instead of in a file
+    def store_content(self, url, content, metadata):
+        metadata = dict(metadata, sha256=hashlib.sha256(content).hexdigest())
+        object_path = self._get_object_path(metadata["sha256"])
+        if not os.path.exists(object_path):
+            self._write_file(object_path, lambda object_file: object_file.write(content))
+        return self._set_entry(url, metadata)
+
+    def _get_entry_path(self, url):
+        return os.path.join(self.entries_path, "%s.json" % hashlib.sha1(url.encode("utf-8")).hexdigest())
+
+    def _get_object_path(self, sha256):
+        return os.path.join(self.objects_path, sha256)
+
+    # The entry of the given URL, as long as we still have its content
+    def _get_entry(self, url):
+        try:
+            with open(self._get_entry_path(url), "r") as entry_file:
+                entry = json.load(entry_file)
+        except (IOError, ValueError):
+            return None
+        if not os.path.exists(self._get_object_path(entry["sha256"])):
+            return None
+        return entry
+
+    def _set_entry(self, url, metadata):
+        previous_entry = self._get_entry(url)
+        entry = {
+            "url": url,
+            "etag": metadata.get("etag"),
+            "last_modified": metadata.get("last_modified"),
+            "sha256": metadata["sha256"],
+            "stored_at": time.time(),
+            "metadata": metadata,
+        }
+        self._write_file(self._get_entry_path(url), lambda entry_file: entry_file.write(json.dumps(entry).encode("utf-8")))
+        return previous_entry is None or previous_entry["sha256"] != entry["sha256"]
+
+    # Write to a temporary file first, so other threads or processes never see it half-written
+    def _write_file(self, file_path, write):
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as output_file:
+                write(output_file)
+            os.rename(temp_path, file_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def _copy_file(self, file_path, output_file):
+        with open(file_path, "rb") as input_file:
+            shutil.copyfileobj(input_file, output_file, self.CHUNK_SIZE)
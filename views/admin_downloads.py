@@ -0,0 +1,360 @@
+# -*- coding: UTF-8 -*-
+
+# Downloads of the data files of a retrieval from the open data portal. All the files are
+# downloaded at once, on a pool of threads, each one keeping its connections open between
+# files (keep-alive), instead of opening a new one for each file. Each file has a time
+# limit, and failed downloads are retried a few times, waiting longer each time. If some
+# files can't be downloaded in the end, we get a single error listing all of them.
+#
+# Files are written to disk as they arrive, chunk by chunk, never held whole in memory.
+# On the way, the UTF-8 BOM is removed and the encoding is found out (see EncodingSniffer),
+# which is saved, with the rest of details of the download, in a metadata file next to
+# the downloaded one (see get_metadata_path).
+#
+# Given an HTTPCache, files are only downloaded again if they changed since the last time,
+# and the metadata tells whether they did.
+
+import codecs
+import hashlib
+import json
+import os
+import six
+import threading
+import time
+
+if six.PY2:
+    import httplib as http_client
+    from urlparse import urljoin, urlsplit
+    from urllib import getproxies, proxy_bypass
+else:
+    import http.client as http_client
+    from urllib.parse import urljoin, urlsplit
+    from urllib.request import getproxies, proxy_bypass
+
+from chardet.universaldetector import UniversalDetector
+from concurrent.futures import ThreadPoolExecutor
+
+
+# The metadata file of a downloaded file, hidden as the rest of metadata of the temp folders
+def get_metadata_path(file_path):
+    folder_path, filename = os.path.split(file_path)
+    return os.path.join(folder_path, ".%s.json" % filename)
+
+
+def read_metadata(file_path):
+    with open(get_metadata_path(file_path), "r") as metadata_file:
+        return json.load(metadata_file)
+
+
+class HTTPStatusError(Exception):
+
+    def __init__(self, status, reason):
+        self.status = status
+        super(HTTPStatusError, self).__init__(u"HTTP %s %s" % (status, reason))
+
+
+class DownloadTimeout(Exception):
+
+    def __init__(self, timeout):
+        super(DownloadTimeout, self).__init__(u"No se ha completado en %d s" % timeout)
+
+
+class DownloadError(Exception):
+
+    # Errors is a list of (filename, url, message) tuples
+    def __init__(self, errors):
+        self.errors = errors
+        super(DownloadError, self).__init__(
+            u"No se han podido descargar %d fichero(s):\n%s" % (
+                len(errors),
+                u"\n".join(u"- %s (%s): %s" % error for error in errors)))
+
+
+# Finds out the encoding of a file as it's downloaded. Whether it's valid UTF-8 is checked
+# on the whole file, which is cheap; only when it's not, chardet guesses the encoding, but
+# from a sample, the first SAMPLE_SIZE bytes, since going through the whole file is slow.
+# feed() returns the chunk to be written, i.e. without the BOM, if the file starts with it.
+class EncodingSniffer(object):
+
+    SAMPLE_SIZE = 256 * 1024
+
+    # The open data files not in UTF-8 are usually in ISO-8859-1
+    DEFAULT_ENCODING = 'iso-8859-1'
+
+    def __init__(self):
+        self.has_bom = False
+        self._head = b''
+        self._sample_size = 0
+        self._detector = UniversalDetector()
+        self._utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._is_utf8 = True
+
+    def feed(self, chunk):
+        # The BOM may come split between chunks, so hold the start until we can tell
+        if self._head is not None:
+            self._head += chunk
+            if len(self._head) < len(codecs.BOM_UTF8) and codecs.BOM_UTF8.startswith(self._head):
+                return b''
+            chunk, self._head = self._head, None
+            if chunk.startswith(codecs.BOM_UTF8):
+                self.has_bom = True
+                chunk = chunk[len(codecs.BOM_UTF8):]
+
+        if self._is_utf8:
+            try:
+                self._utf8_decoder.decode(chunk)
+            except UnicodeDecodeError:
+                self._is_utf8 = False
+
+        if self._sample_size < self.SAMPLE_SIZE and not self._detector.done:
+            self._detector.feed(chunk[:self.SAMPLE_SIZE - self._sample_size])
+            self._sample_size += len(chunk)
+
+        return chunk
+
+    # Returns the rest of the file to be written, if any, and the encoding details
+    def close(self):
+        chunk = self._head or b''
+        self._head = None
+        if self._is_utf8:
+            try:
+                self._utf8_decoder.decode(chunk, final=True)
+            except UnicodeDecodeError:
+                self._is_utf8 = False
+        if chunk:
+            self._detector.feed(chunk)
+
+        self._detector.close()
+        guess = self._detector.result
+        if self._is_utf8:
+            encoding = 'utf-8'
+        elif guess['encoding'] and guess['encoding'].lower() not in ('ascii', 'utf-8'):
+            encoding = guess['encoding'].lower()
+        else:
+            encoding = self.DEFAULT_ENCODING
+
+        return (chunk, {
+            'encoding': encoding,
+            'is_utf8': self._is_utf8,
+            'has_bom': self.has_bom,
+            'guessed_encoding': guess['encoding'],
+            'guess_confidence': guess['confidence'],
+        })
+
+
+class DownloadManager(object):
+
+    # Network errors worth retrying, with a new connection, e.g. the server closing
+    # a connection we were keeping open, or a timeout
+    CONNECTION_ERRORS = (http_client.HTTPException, IOError, OSError)
+
+    # Server errors worth retrying
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+    MAX_REDIRECTS = 5
+
+    CHUNK_SIZE = 64 * 1024
+
+    # Timeout is the time limit for each file, in seconds. Retries are attempts after
+    # the first one, waiting backoff seconds, then twice that, and so on.
+    def __init__(self, workers=4, timeout=120, retries=3, backoff=1.0, headers=None, log=None, cache=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.headers = headers or {'User-Agent': 'Mozilla'}
+        self.log = log or (lambda text: None)
+        self.cache = cache
+
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self.connection_count = 0
+
+    # Download the given (url, file path) pairs, all at once, and return the metadata of
+    # each one, by file path. Raises a DownloadError if any of them fails, once the rest are done.
+    def download(self, downloads):
+        results = {}
+        errors = []
+        try:
+            executor = ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(downloads))))
+            try:
+                futures = [(url, file_path, executor.submit(self._download, url, file_path)) for url, file_path in downloads]
+                for url, file_path, future in futures:
+                    error = future.exception()
+                    if error is not None:
+                        errors.append((os.path.basename(file_path), url, self._get_error_message(error)))
+                    else:
+                        results[file_path] = future.result()
+            finally:
+                executor.shutdown(wait=True)
+        finally:
+            self._close_connections()
+
+        if errors:
+            raise DownloadError(errors)
+        return results
+
+    def _download(self, url, file_path):
+        filename = os.path.basename(file_path)
+        attempt = 0
+        while True:
+            start_time = time.time()
+            try:
+                metadata = self._download_once(url, file_path, start_time + self.timeout)
+                metadata.update({
+                    'url': url,
+                    'downloaded_at': time.time(),
+                    'duration': time.time() - start_time,
+                    'attempts': attempt + 1,
+                })
+                if self.cache is not None and not metadata['cached']:
+                    metadata['changed'] = self.cache.store(url, file_path, metadata)
+                self._write_metadata(file_path, metadata)
+                self.log(u"%s %s (%s bytes, %s, %.1f s)\n" % (
+                    u"Sin cambios" if metadata['cached'] else u"Descargado",
+                    filename, metadata['size'], metadata['encoding'], metadata['duration']))
+                return metadata
+            except Exception as error:
+                for path in (file_path, get_metadata_path(file_path)):
+                    if os.path.exists(path):
+                        os.remove(path)
+                if attempt >= self.retries or not self._is_retriable(error):
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                self.log(u"Error descargando %s, reintentando en %.1f s: %s\n" % (filename, delay, self._get_error_message(error)))
+                time.sleep(delay)
+                attempt += 1
+
+    # Returns the metadata of the downloaded file
+    def _download_once(self, url, file_path, deadline):
+        self._local.requested_url = url
+        try:
+            return self._download_and_follow(url, file_path, deadline)
+        except Exception:
+            # Whatever happened, the connection is not in a state to be reused. After a
+            # redirect, that's the one to the server we were redirected to.
+            self._drop_connection(self._local.requested_url)
+            raise
+
+    def _download_and_follow(self, url, file_path, deadline):
+        original_url = url
+        headers = self.cache.get_conditional_headers(url) if self.cache is not None else {}
+        for _ in range(self.MAX_REDIRECTS + 1):
+            response = self._request(url, deadline, headers)
+            if response.status == 304 and headers:
+                response.read()
+                return dict(self.cache.restore(original_url, file_path), cached=True, changed=False)
+            if response.status in self.REDIRECT_STATUSES:
+                response.read()
+                url = urljoin(url, response.getheader('Location'))
+                continue
+            if response.status != 200:
+                response.read()
+                raise HTTPStatusError(response.status, response.reason)
+
+            size = 0
+            sniffer = EncodingSniffer()
+            content_hash = hashlib.sha256()
+            with open(file_path, 'wb') as output_file:
+                while True:
+                    if time.time() > deadline:
+                        raise DownloadTimeout(self.timeout)
+                    chunk = response.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    chunk = sniffer.feed(chunk)
+                    content_hash.update(chunk)
+                    output_file.write(chunk)
+                chunk, metadata = sniffer.close()
+                content_hash.update(chunk)
+                output_file.write(chunk)
+
+            expected_size = response.getheader('Content-Length')
+            if expected_size is not None and expected_size.isdigit() and int(expected_size) != size:
+                raise http_client.IncompleteRead(b'', int(expected_size) - size)
+
+            metadata.update({
+                'size': size,
+                'sha256': content_hash.hexdigest(),
+                'content_type': response.getheader('Content-Type'),
+                'etag': response.getheader('ETag'),
+                'last_modified': response.getheader('Last-Modified'),
+                'cached': False,
+                'changed': True,
+            })
+            return metadata
+
+        raise HTTPStatusError(310, "Too many redirects")
+
+    def _write_metadata(self, file_path, metadata):
+        with open(get_metadata_path(file_path), 'w') as metadata_file:
+            json.dump(metadata, metadata_file, indent=2, sort_keys=True)
+
+    def _request(self, url, deadline, headers):
+        self._local.requested_url = url
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        connection, is_proxied = self._get_connection(parts.scheme, parts.hostname, parts.port)
+        connection.timeout = max(1, deadline - time.time())
+        if connection.sock is not None:
+            connection.sock.settimeout(connection.timeout)
+
+        # Plain HTTP proxies want the whole URL
+        connection.request('GET', url if is_proxied and parts.scheme == 'http' else path, headers=dict(self.headers, **headers))
+        return connection.getresponse()
+
+    # The open connection of this thread to the given server, or a new one
+    def _get_connection(self, scheme, host, port):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+
+        key = (scheme, host, port)
+        if key not in connections:
+            connections[key] = self._create_connection(scheme, host, port)
+            with self._connections_lock:
+                self._connections.append(connections[key][0])
+                self.connection_count += 1
+        return connections[key]
+
+    # Use the same proxies urlopen would
+    def _create_connection(self, scheme, host, port):
+        connection_class = http_client.HTTPSConnection if scheme == 'https' else http_client.HTTPConnection
+        proxy = getproxies().get(scheme)
+        if proxy and not proxy_bypass(host):
+            proxy_parts = urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+            connection = connection_class(proxy_parts.hostname, proxy_parts.port or 80, timeout=self.timeout)
+            if scheme == 'https':
+                connection.set_tunnel(host, port)
+            return (connection, True)
+        return (connection_class(host, port, timeout=self.timeout), False)
+
+    def _drop_connection(self, url):
+        parts = urlsplit(url)
+        connections = getattr(self._local, 'connections', {})
+        connection = connections.pop((parts.scheme, parts.hostname, parts.port), None)
+        if connection is not None:
+            connection[0].close()
+
+    def _close_connections(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+
+    def _is_retriable(self, error):
+        if isinstance(error, HTTPStatusError):
+            return error.status in self.RETRY_STATUSES
+        return isinstance(error, self.CONNECTION_ERRORS + (DownloadTimeout,))
+
+    def _get_error_message(self, error):
+        if isinstance(error, (HTTPStatusError, DownloadTimeout)):
+            return six.text_type(error)
+        return u"%s: %s" % (type(error).__name__, error)
+
@@ -0,0 +1,151 @@
+# -*- coding: UTF-8 -*-
+
+# Batches of file operations on the theme (copies, renames and removals), e.g. to put the
+# files of a retrieval in place. The theme belongs to another user, so the operations go
+# through the setuid'ed scripts/cp and scripts/rm executables, which keep the ownership of
+# the files, all in a single shell command, instead of one shell for each file.
+#
+# Files about to be overwritten or removed are backed up first, and applying a batch returns
+# the batch that undoes it (the undo list), which is also saved next to the backups. Backups
+# belong to the web server process, so it makes them by itself, reading the theme files.
+
+from datetime import datetime
+import json
+import os
+import shutil
+import time
+
+from six.moves import shlex_quote
+
+
+class FileOperationError(Exception):
+    pass
+
+
+class FileBatch(object):
+
+    UNDO_FILENAME = "undo.json"
+
+    # Commands run from the theme, for each operation
+    SCRIPTS = {
+        "copy": "scripts/cp -f {0} {1}",
+        "rename": "scripts/cp -f {0} {1} && scripts/rm -f {0}",
+        "remove": "scripts/rm -f {0}",
+    }
+
+    # Execute_cmd runs a shell command, returning its (output, error), as _execute_cmd
+    # in admin.py. Backups and undo lists are kept in a new folder under backups_path.
+    def __init__(self, theme_path, execute_cmd, backups_path, log=None):
+        self.theme_path = theme_path
+        self.execute_cmd = execute_cmd
+        self.backups_path = backups_path
+        self.log = log or (lambda text: None)
+        self.operations = []
+
+        # Where the batch is saved, if it's an undo list
+        self.undo_path = None
+
+    # A batch saved as an undo list, to apply it
+    @staticmethod
+    def load(file_path, theme_path, execute_cmd, backups_path, log=None):
+        batch = FileBatch(theme_path, execute_cmd, backups_path, log)
+        with open(file_path, "r") as batch_file:
+            batch.operations = [tuple(operation) for operation in json.load(batch_file)]
+        return batch
+
+    # Same arguments as _copy in admin.py
+    def copy(self, source_path, destination_path, source_filename, destination_filename=None):
+        self.operations.append(("copy",
+            os.path.join(source_path, source_filename),
+            os.path.join(destination_path, destination_filename or source_filename)))
+
+    def rename(self, source_path, destination_path, source_filename, destination_filename=None):
+        self.operations.append(("rename",
+            os.path.join(source_path, source_filename),
+            os.path.join(destination_path, destination_filename or source_filename)))
+
+    def remove(self, folder_path, filename):
+        self.operations.append(("remove", os.path.join(folder_path, filename)))
+
+    # Apply the operations, in order. Returns the batch that undoes them.
+    def apply(self):
+        start_time = time.time()
+
+        backup_folder_path = os.path.join(self.backups_path, datetime.now().strftime("%Y%m%d-%H%M%S-%f"))
+        os.makedirs(backup_folder_path)
+        undo_operations = self._make_backups(backup_folder_path)
+
+        for operation in self.operations:
+            if operation[0] in ("copy", "rename") and not os.path.exists(os.path.dirname(operation[2])):
+                os.makedirs(os.path.dirname(operation[2]))
+
+        self._apply_with_scripts(self.operations)
+
+        undo_batch = FileBatch(self.theme_path, self.execute_cmd, self.backups_path, self.log)
+        undo_batch.operations = list(reversed(undo_operations))
+        undo_batch.undo_path = os.path.join(backup_folder_path, self.UNDO_FILENAME)
+        with open(undo_batch.undo_path, "w") as undo_file:
+            json.dump(undo_batch.operations, undo_file, indent=2)
+
+        self.log(u"%d operaciones con ficheros en %.2f s. Para deshacerlas: %s\n" % (
+            len(self.operations),
+            time.time() - start_time,
+            undo_batch.undo_path))
+        return undo_batch
+
+    # Back up the files about to be overwritten or removed. Returns the operations to undo
+    # the batch, in the order it's applied.
+    def _make_backups(self, backup_folder_path):
+        undo_operations = []
+
+        # The files already backed up, and their backups
+        backups = {}
+
+        # Which file each one holds the content of, as it was before the batch, at each point
+        # of the batch, as it's applied. A file renamed or copied over another one earlier in
+        # the batch is what we back up then. None if the file doesn't exist.
+        contents = {}
+
+        def get_content(file_path):
+            if file_path in contents:
+                return contents[file_path]
+            return file_path if os.path.exists(file_path) else None
+
+        def backup(file_path):
+            if file_path not in backups:
+                backup_path = os.path.join(backup_folder_path, "%d-%s" % (len(backups), os.path.basename(file_path)))
+                try:
+                    shutil.copy2(file_path, backup_path)
+                except (IOError, OSError) as error:
+                    raise FileOperationError("Couldn't back up %s: %s" % (file_path, error))
+                backups[file_path] = backup_path
+            return backups[file_path]
+
+        for operation in self.operations:
+            target = operation[-1]
+            content = get_content(target)
+            if content is not None:
+                undo_operations.append(("copy", backup(content), target))
+
+            if operation[0] == "copy":
+                if content is None:
+                    undo_operations.append(("remove", target))
+                contents[target] = get_content(operation[1])
+            elif operation[0] == "rename":
+                undo_operations.append(("rename", target, operation[1]))
+                contents[target] = get_content(operation[1])
+                contents[operation[1]] = None
+            else:
+                contents[target] = None
+
+        return undo_operations
+
+    def _apply_with_scripts(self, operations):
+        cmd = " && ".join(
+            ["cd %s" % shlex_quote(self.theme_path)] +
+            [self.SCRIPTS[operation[0]].format(*[shlex_quote(path) for path in operation[1:]]) for operation in operations])
+
+        output, error = self.execute_cmd(cmd)
+
+        if error:
+            raise FileOperationError("Files couldn't be arranged: %s\n\n%s" % (error, output))
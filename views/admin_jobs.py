@@ -0,0 +1,329 @@
+# -*- coding: UTF-8 -*-
+
+# Admin actions (downloading, reviewing and loading data) can take minutes, too long for
+# an HTTP request, so they run as jobs in a background thread, and the admin pages poll
+# their status until they're finished. Jobs run one at a time, also across web server
+# processes, so two loads never overlap.
+#
+# The state of each job is kept in a file under JOBS_PATH, together with its log, so any
+# web server process can tell how a job is doing, not just the one running it. The log
+# can also be followed as it's written, as a stream of server-sent events (see stream_job_log).
+#
+# Jobs run in a daemon thread of the web server process, so the server must allow threads
+# in the app, e.g. uWSGI needs --enable-threads (or enable-threads = true in its ini file),
+# otherwise the thread never runs and jobs stay queued.
+
+from datetime import datetime
+import cgi
+import errno
+import fcntl
+import json
+import os
+import six
+import threading
+import time
+import traceback
+import uuid
+
+if six.PY2:
+    from Queue import Queue
+else:
+    from queue import Queue
+
+JOBS_PATH = "/tmp/budget_app_jobs"
+
+# Lines of the log returned with the job status
+LOG_TAIL_LINES = 40
+
+# Jobs older than this, in seconds, are removed
+MAX_JOB_AGE = 7 * 24 * 60 * 60
+
+# Log streams end after this many seconds, so they don't hold a web server process for
+# the whole job. Browsers reconnect by themselves, after the given milliseconds, and
+# carry on from where they were. Streams are off by default in admin.js, since each one
+# holds a worker of the web server meanwhile.
+LOG_STREAM_DURATION = 15
+LOG_STREAM_RECONNECT_DELAY = 1000
+
+# Seconds between checks for new lines, and between messages to keep the connection alive
+LOG_STREAM_INTERVAL = 0.5
+LOG_STREAM_KEEPALIVE = 15
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+
+_queue = Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+# The job being run by the current thread, if any, and what to do once it's finished
+_local = threading.local()
+
+
+# Queue a job, calling the given function with the given arguments. The function returns
+# a (body, status) tuple, as the rest of admin actions. Returns the job id.
+def enqueue_job(action, function, *args):
+    global _worker
+
+    if not os.path.exists(JOBS_PATH):
+        os.makedirs(JOBS_PATH)
+    _remove_old_jobs()
+
+    job = {
+        "id": uuid.uuid4().hex,
+        "action": action,
+        "status": QUEUED,
+        "stage": None,
+        "stages": [],
+        "pid": os.getpid(),
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "result": None,
+        "http_status": None,
+    }
+    _write_job(job)
+    _queue.put((job, function, args))
+
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run_worker, name="admin-jobs")
+            _worker.daemon = True
+            _worker.start()
+
+    return job["id"]
+
+
+# The state of a job, with its elapsed time and the tail of its log, or None
+def get_job(job_id, with_log=True):
+    job = _read_job(job_id)
+    if job is None:
+        return None
+
+    # The process running the job may have died, e.g. when the app is restarted
+    if job["status"] != FINISHED and not _is_process_alive(job["pid"]):
+        job.update({
+            "status": FINISHED,
+            "finished_at": time.time(),
+            "result": {"result": "error", "message": u"<p>El proceso se ha interrumpido.</p>"},
+            "http_status": 500,
+        })
+        _write_job(job)
+
+    start_time = job["started_at"] or job["created_at"]
+    job["elapsed"] = int((job["finished_at"] or time.time()) - start_time)
+    if with_log:
+        job["log"] = _read_log_tail(job_id)
+    return job
+
+
+# The log of a job from the given byte offset, only complete lines unless the job is
+# finished, and the offset to carry on from
+def read_job_log(job_id, offset=0, is_finished=False):
+    try:
+        with open(_get_log_filename(job_id), "rb") as log_file:
+            log_file.seek(offset)
+            content = log_file.read()
+    except IOError:
+        return (u"", offset)
+
+    if not is_finished:
+        content = content[:content.rfind(b"\n") + 1]
+    return (content.decode("utf-8", "replace"), offset + len(content))
+
+
+# The log of a job, from the given byte offset, as server-sent events: one event per
+# bunch of new lines, with the offset as id, and a 'finished' event with the job state
+# once it's done.
+def stream_job_log(job_id, offset=0):
+    start_time = last_event_time = time.time()
+    yield "retry: %d\n\n" % LOG_STREAM_RECONNECT_DELAY
+
+    while True:
+        job = get_job(job_id, with_log=False)
+        if job is None:
+            return
+        is_finished = (job["status"] == FINISHED)
+
+        text, offset = read_job_log(job_id, offset, is_finished)
+        if text:
+            yield "id: %d\n%s\n" % (offset, "".join("data: %s\n" % line for line in text.splitlines()))
+            last_event_time = time.time()
+
+        if is_finished:
+            yield "event: finished\ndata: %s\n\n" % json.dumps(job)
+            return
+        if time.time() - start_time > LOG_STREAM_DURATION:
+            return
+        if time.time() - last_event_time > LOG_STREAM_KEEPALIVE:
+            yield ": keepalive\n\n"
+            last_event_time = time.time()
+        time.sleep(LOG_STREAM_INTERVAL)
+
+
+# Set the current stage of the running job, if any, finishing the previous one
+def set_job_stage(stage):
+    job = _get_current_job()
+    if job is None:
+        return
+    finish_job_stage()
+    job["stage"] = stage
+    job["stages"].append({"name": stage, "started_at": time.time(), "finished_at": None, "error": False})
+    _write_job(job)
+    _log_time(u"Inicio: %s" % stage)
+
+
+# Finish the current stage of the running job, if any, logging how long it took
+def finish_job_stage(error=False):
+    job = _get_current_job()
+    if job is None or not job["stages"]:
+        return
+    stage = job["stages"][-1]
+    if stage["finished_at"] is not None:
+        return
+    stage.update({"finished_at": time.time(), "error": error})
+    _write_job(job)
+    _log_time(u"%s: %s (%d s)" % (
+        u"Error" if error else u"Fin",
+        stage["name"],
+        stage["finished_at"] - stage["started_at"]))
+
+
+# Append some text to the log of the running job, if any
+def log_to_job(text):
+    job = _get_current_job()
+    if job is not None:
+        _append_to_log(job["id"], text)
+
+
+# A function appending text to the log of the running job, if any, as log_to_job. It
+# keeps logging to that job when called from other threads, e.g. those downloading files.
+def get_job_log():
+    job = _get_current_job()
+    if job is None:
+        return lambda text: None
+    return lambda text: _append_to_log(job["id"], text)
+
+
+def _get_current_job():
+    return getattr(_local, "job", None)
+
+
+def _append_to_log(job_id, text):
+    with open(_get_log_filename(job_id), "ab") as log_file:
+        log_file.write(text.encode("utf-8"))
+
+
+def _log_time(text):
+    log_to_job(u"[%s] %s\n" % (datetime.now().strftime("%H:%M:%S"), text))
+
+
+# Call the given function once the running job is finished and its result saved, e.g.
+# to restart the app, which would kill the job otherwise. If no job is running, call it now.
+def on_job_finished(function, *args):
+    if _get_current_job() is None:
+        function(*args)
+    else:
+        _local.finish_callbacks.append((function, args))
+
+
+def _run_worker():
+    while True:
+        job, function, args = _queue.get()
+        try:
+            _run_job(job, function, args)
+        finally:
+            _queue.task_done()
+
+
+def _run_job(job, function, args):
+    # One job at a time, across processes
+    with open(os.path.join(JOBS_PATH, ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            _local.job = job
+            _local.finish_callbacks = []
+            job.update({"status": RUNNING, "pid": os.getpid(), "started_at": time.time()})
+            _write_job(job)
+
+            try:
+                body, status = function(*args)
+            except Exception:
+                error = traceback.format_exc()
+                log_to_job(error)
+                body = {
+                    "result": "error",
+                    "message": u"<p>Se ha producido un error inesperado: <pre>%s</pre></p>" % cgi.escape(error),
+                }
+                status = 500
+
+            finish_job_stage(status >= 400)
+            job.update({
+                "status": FINISHED,
+                "finished_at": time.time(),
+                "result": body,
+                "http_status": status,
+            })
+            _write_job(job)
+        finally:
+            callbacks = _local.finish_callbacks
+            _local.job = None
+            _local.finish_callbacks = []
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    for callback, callback_args in callbacks:
+        callback(*callback_args)
+
+
+def _get_job_filename(job_id):
+    return os.path.join(JOBS_PATH, "%s.json" % job_id)
+
+
+def _get_log_filename(job_id):
+    return os.path.join(JOBS_PATH, "%s.log" % job_id)
+
+
+def _read_job(job_id):
+    try:
+        with open(_get_job_filename(job_id), "r") as job_file:
+            return json.load(job_file)
+    except IOError:
+        return None
+
+
+# Write to a temporary file first, so a job is never seen half-written
+def _write_job(job):
+    filename = _get_job_filename(job["id"])
+    temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    with open(temp_filename, "w") as job_file:
+        json.dump(job, job_file)
+    os.rename(temp_filename, filename)
+
+
+def _read_log_tail(job_id):
+    try:
+        with open(_get_log_filename(job_id), "rb") as log_file:
+            # The tail is at the end, no need to read the whole log
+            log_file.seek(0, os.SEEK_END)
+            log_file.seek(max(0, log_file.tell() - 64 * 1024))
+            lines = log_file.read().decode("utf-8", "replace").splitlines()
+    except IOError:
+        return ""
+    return "\n".join(lines[-LOG_TAIL_LINES:])
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def _remove_old_jobs():
+    now = time.time()
+    for filename in os.listdir(JOBS_PATH):
+        file_path = os.path.join(JOBS_PATH, filename)
+        if not filename.startswith(".") and now - os.path.getmtime(file_path) > MAX_JOB_AGE:
+            os.remove(file_path)
@@ -0,0 +1,144 @@
+# -*- coding: UTF-8 -*-
+
+# Links to the CSV files of the pages of the open data portal. We only need a few elements
+# of each page: the CSV links (a.ico-csv) and, in historical pages, the titles of the
+# blocks of each year (p.info-title) and the list (ul) of links that follows each one.
+# So instead of building a tree of the whole page, it goes through a streaming parser
+# which only keeps those. What we get out of a page is kept by its hash, since the same
+# page is read again and again, e.g. in each retrieval of a year.
+
+import collections
+import hashlib
+import re
+import six
+import threading
+
+if six.PY2:
+    from HTMLParser import HTMLParser
+else:
+    from html.parser import HTMLParser
+
+# Pages whose links are kept
+MAX_CACHED_PAGES = 16
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+# The links to all the CSV files of the page, in order
+def get_links(page):
+    return list(_get_page_links(page)["links"])
+
+
+# The links to the CSV files of the first block of the page whose title mentions the
+# given year, or None if there isn't one
+def get_year_links(page, year):
+    for title, links in _get_page_links(page)["years"]:
+        if re.search(year, title):
+            return list(links)
+    return None
+
+
+def _get_page_links(page):
+    key = hashlib.sha1(page.encode("utf-8")).hexdigest()
+    with _cache_lock:
+        if key in _cache:
+            return _cache[key]
+
+    page_links = _extract_links(page)
+
+    with _cache_lock:
+        _cache[key] = page_links
+        while len(_cache) > MAX_CACHED_PAGES:
+            _cache.popitem(last=False)
+    return page_links
+
+
+def _extract_links(page):
+    # There's a weird line that's breaking BeautifulSoup in the PRE/PROD environment,
+    # but not in development. Is it the Python version? See civio/presupuesto-management#1234
+    # Deleting it is a hacky way of getting rid of the issue, but the best I could find.
+    page = re.sub("!function\(t,e\).*", "", page)
+    page = re.sub("window.NREUM.*", "", page)
+
+    parser = _PortalLinksParser()
+    parser.feed(page)
+    parser.close()
+    return {
+        "links": parser.links,
+        "years": [
+            ("".join(text), parser.lists[list_index] if list_index < len(parser.lists) else [])
+            for text, list_index in parser.titles
+        ],
+    }
+
+
+# The block of a title is the first list after the start of the element containing the
+# title, as BeautifulSoup's findNext("ul") on the title's parent. So each open element
+# remembers how many lists had started by then; the block is the next one.
+class _PortalLinksParser(HTMLParser):
+
+    VOID_ELEMENTS = set([
+        "area", "base", "br", "col", "embed", "hr", "img", "input",
+        "link", "meta", "param", "source", "track", "wbr",
+    ])
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.links = []
+        self.lists = []
+        self.titles = []
+
+        # (tag, lists started so far, list index if it's a ul, title text if it's a title)
+        self._open_elements = []
+        self._open_lists = []
+        self._title_text = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get("class") or "").split()
+
+        if tag == "a" and "ico-csv" in classes and attrs.get("href"):
+            self.links.append(attrs["href"])
+            for list_index in self._open_lists:
+                self.lists[list_index].append(attrs["href"])
+
+        title_text = None
+        if tag == "p" and "info-title" in classes:
+            lists_before_parent = self._open_elements[-1][1] if self._open_elements else 0
+            title_text = []
+            self.titles.append((title_text, lists_before_parent))
+            self._title_text = title_text
+
+        list_index = None
+        if tag == "ul":
+            list_index = len(self.lists)
+            self.lists.append([])
+            self._open_lists.append(list_index)
+
+        if tag not in self.VOID_ELEMENTS:
+            self._open_elements.append((tag, len(self.lists), list_index, title_text))
+
+    def handle_endtag(self, tag):
+        # Close everything up to the matching element, if it's open at all
+        if not any(element[0] == tag for element in self._open_elements):
+            return
+        while True:
+            element_tag, _, list_index, title_text = self._open_elements.pop()
+            if list_index is not None:
+                self._open_lists.remove(list_index)
+            if title_text is not None:
+                self._title_text = None
+            if element_tag == tag:
+                return
+
+    def handle_data(self, data):
+        if self._title_text is not None:
+            self._title_text.append(data)
+
+    # Character references, when they're not converted (Python 2)
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape("&%s;" % name))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape("&#%s;" % name))
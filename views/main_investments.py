@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+
+import os
+
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import redirect
+from django.urls import reverse
+from django.utils import translation
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from project.settings import THEME_PATH
+
+from ..loaders.madrid_cartography import MadridCartography
+from ..loaders.madrid_main_investments_bundle import MadridMainInvestmentsBundle
+
+#
+# MAIN INVESTMENTS DATA
+#
+# Redirect to the current bundle of main investments, for all years or the given one.
+# Bundles are built when loading the data, or with the build_main_investments_bundles command.
+def main_investments_data(request, year=None):
+    return _redirect_to_bundle(request, year or MadridMainInvestmentsBundle.ALL_YEARS)
+
+# Redirect to the current text search index of main investments
+def main_investments_search(request):
+    return _redirect_to_bundle(request, MadridMainInvestmentsBundle.SEARCH)
+
+def _redirect_to_bundle(request, name):
+    filename = _get_bundle().get_filename(name)
+    if filename is None:
+        raise Http404
+
+    response = redirect('main_investments_bundle', filename)
+    patch_cache_control(response, public=True, max_age=300)
+    return response
+
+# Bundle names change with their content, so they can be cached forever
+def main_investments_bundle(request, filename):
+    return _serve_immutable_file(request, _get_bundle().get_file_path(filename))
+
+# The levels of detail of the district shapes, with the URL of their current file.
+# Files are built with the build_cartography command.
+def main_investments_cartography(request):
+    index = MadridCartography(THEME_PATH).get_index()
+    if index is None:
+        raise Http404
+
+    response = JsonResponse({
+        'levels': [
+            {
+                'max_zoom': level['max_zoom'],
+                'url': reverse('main_investments_cartography_file', args=[level['filename']]),
+            }
+            for level in index['levels']
+        ],
+    })
+    patch_cache_control(response, public=True, max_age=300)
+    return response
+
+# File names change with their content, so they can be cached forever
+def main_investments_cartography_file(request, filename):
+    return _serve_immutable_file(request, MadridCartography(THEME_PATH).get_file_path(filename))
+
+# Serve the gzipped copy of the file, if the browser takes it and it's there
+def _serve_immutable_file(request, file_path):
+    if file_path is None:
+        raise Http404
+
+    is_gzipped = _accepts_gzip(request) and os.path.isfile(file_path + '.gz')
+    if not is_gzipped and not os.path.isfile(file_path):
+        raise Http404
+    with open(file_path + '.gz' if is_gzipped else file_path, 'rb') as input_file:
+        response = HttpResponse(input_file.read(), content_type='application/json')
+
+    if is_gzipped:
+        response['Content-Encoding'] = 'gzip'
+    patch_vary_headers(response, ['Accept-Encoding'])
+    patch_cache_control(response, public=True, max_age=31536000, immutable=True)
+    return response
+
+# Whether the Accept-Encoding header of the request allows gzip: it's listed, or '*' is,
+# with a quality value other than 0
+def _accepts_gzip(request):
+    qualities = {}
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = coding.split(';')
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[params[0].strip().lower()] = quality
+    return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
+def _get_bundle():
+    return MadridMainInvestmentsBundle(THEME_PATH, translation.get_language().split('-')[0])